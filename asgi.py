@@ -10,6 +10,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'a_core.settings')
 django_asgi_app = get_asgi_application()
 
 from a_rtchat import routing
+from a_rtchat.deflate import enable_deflate
+
+# permessage-deflate is up to the server, see a_rtchat.deflate
+enable_deflate()
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
@@ -71,6 +71,7 @@ INSTALLED_APPS = [
 SITE_ID = 1
 
 MIDDLEWARE = [
+    'a_rtchat.querycount.QueryCountMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -116,6 +117,17 @@ if ENVIRONMENT == 'development':
             "BACKEND": "channels.layers.InMemoryChannelLayer",
         }
     }
+elif env.list('REDIS_SHARDS', default=[]):
+    # groups spread over several Redis hosts by consistent hashing, one
+    # PUBLISH per group_send
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
+            "CONFIG": {
+                "hosts": env.list('REDIS_SHARDS'),
+            },
+        },
+    }
 else:
     CHANNEL_LAYERS = {
         "default": {
@@ -126,6 +138,110 @@ else:
         },
     }
 
+if ENVIRONMENT == 'development':
+    CHAT_PRESENCE = {
+        'BACKEND': 'a_rtchat.presence.InMemoryPresence',
+        'CONFIG': {
+            'timeout': 60,
+        },
+    }
+else:
+    CHAT_PRESENCE = {
+        'BACKEND': 'a_rtchat.presence.RedisPresence',
+        'CONFIG': {
+            'url': env('REDIS_URL'),
+            'timeout': 60,
+        },
+    }
+
+# token buckets for messages sent over the chat sockets, (per second,
+# burst) per connection, user and room, see a_rtchat.ratelimit
+if ENVIRONMENT == 'development':
+    CHAT_RATE_LIMIT = {
+        'BACKEND': 'a_rtchat.ratelimit.InMemoryRateLimit',
+    }
+else:
+    CHAT_RATE_LIMIT = {
+        'BACKEND': 'a_rtchat.ratelimit.RedisRateLimit',
+        'CONFIG': {
+            'url': env('REDIS_URL'),
+        },
+    }
+
+# layer events queued for a chat socket that falls behind before the
+# rest are dropped, see a_rtchat.backpressure
+CHAT_EVENT_BACKLOG = 200
+
+# days messages stay in a room before archive_chat_messages moves them to
+# the archive, for rooms without their own. None keeps them, see
+# a_rtchat.retention
+CHAT_RETENTION_DAYS = None
+
+# cached room memberships for access checks, see a_rtchat.membership
+if ENVIRONMENT == 'development':
+    CHAT_MEMBERSHIP = {
+        'timeout': 3600,
+    }
+else:
+    CHAT_MEMBERSHIP = {
+        'url': env('REDIS_URL'),
+        'timeout': 3600,
+    }
+
+# rendered message fragments, an LRU per process shared through Redis in
+# production, see a_rtchat.fragments
+if ENVIRONMENT == 'development':
+    CHAT_FRAGMENTS = {
+        'max_entries': 5000,
+    }
+else:
+    CHAT_FRAGMENTS = {
+        'max_entries': 5000,
+        'url': env('REDIS_URL'),
+        'timeout': 86400,
+    }
+
+# per request and per websocket event query counts, see manage.py
+# query_report. The log is opt-in here, and each process should get its
+# own path since the file is rotated by the process writing it
+QUERY_COUNT_LOG = env('QUERY_COUNT_LOG', default=None)
+QUERY_COUNT_LOG_MAX_BYTES = 10 * 1024 ** 2
+QUERY_COUNT_LOG_BACKUPS = 3
+QUERY_BUDGETS = {
+    'chat_view': 10,
+    'ChatroomConsumer.websocket.receive': 5,
+}
+
+# seconds over which presence changes in a room are merged into one online count update
+CHAT_ONLINE_COUNT_WINDOW = 0.25
+
+# chunked attachment uploads, see a_rtchat.uploads
+CHAT_UPLOAD_MAX_SIZE = 1024 ** 3
+CHAT_UPLOAD_CHUNK_SIZE = 8 * 1024 ** 2
+# mime type prefixes allowed, None allows everything
+CHAT_UPLOAD_TYPES = None
+
+# pages speak the compact chat.json websocket protocol and render events
+# in the browser, instead of swapping in fragments rendered by the server
+CHAT_CLIENT_RENDERING = False
+
+# permessage-deflate on the chat sockets, see a_rtchat.deflate. None
+# leaves frames uncompressed
+CHAT_WEBSOCKET_DEFLATE = {
+    'window_bits': 11,
+    'mem_level': 4,
+}
+
+# batched message writes, see a_rtchat.writebehind
+if env.bool('CHAT_WRITE_BEHIND', default=False):
+    CHAT_WRITE_BEHIND = {
+        'journal': env('CHAT_JOURNAL_DIR', default=str(BASE_DIR / 'chat_journal')),
+        'batch_size': 100,
+        'interval': 0.05,
+    }
+else:
+    CHAT_WRITE_BEHIND = None
+
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
@@ -135,6 +251,10 @@ if ENVIRONMENT == 'development':
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            # transactions that read before they write (archiving, read
+            # cursors) take the write lock up front, so concurrent workers
+            # wait for it instead of failing to upgrade
+            'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
         }
     }
 else:
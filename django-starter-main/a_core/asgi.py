@@ -20,9 +20,15 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'a_core.settings')
 django_asgi_app = get_asgi_application()
 
 from a_rtchat import routing
+from a_rtchat.deflate import enable_deflate
+from a_rtchat.uploads import ChunkSizeLimit
+
+# permessage-deflate is up to the server, see a_rtchat.deflate
+enable_deflate()
 
 application = ProtocolTypeRouter({
-    "http": django_asgi_app,
+    # upload chunks are refused before Django reads their body
+    "http": ChunkSizeLimit(django_asgi_app),
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
     ),
@@ -53,6 +53,7 @@ INSTALLED_APPS = [
 SITE_ID = 1
 
 MIDDLEWARE = [
+    'a_rtchat.querycount.QueryCountMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -97,6 +98,81 @@ CHANNEL_LAYERS = {
     }
 }
 
+CHAT_PRESENCE = {
+    'BACKEND': 'a_rtchat.presence.InMemoryPresence',
+    'CONFIG': {
+        'timeout': 60,
+    },
+}
+
+# token buckets for messages sent over the chat sockets, (per second,
+# burst) per connection, user and room, see a_rtchat.ratelimit
+CHAT_RATE_LIMIT = {
+    'BACKEND': 'a_rtchat.ratelimit.InMemoryRateLimit',
+    'CONFIG': {
+        'rates': {
+            'connection': (2, 10),
+            'user': (3, 20),
+            'room': (20, 60),
+        },
+    },
+}
+
+# layer events queued for a chat socket that falls behind before the
+# rest are dropped, see a_rtchat.backpressure
+CHAT_EVENT_BACKLOG = 200
+
+# days messages stay in a room before archive_chat_messages moves them to
+# the archive, for rooms without their own. None keeps them, see
+# a_rtchat.retention
+CHAT_RETENTION_DAYS = None
+
+# cached room memberships for access checks, see a_rtchat.membership.
+# Without a url the cache is kept in the process
+CHAT_MEMBERSHIP = {
+    'timeout': 3600,
+}
+
+# rendered message fragments, see a_rtchat.fragments. Without a url each
+# process keeps its own
+CHAT_FRAGMENTS = {
+    'max_entries': 5000,
+}
+
+# per request and per websocket event query counts, see manage.py query_report
+QUERY_COUNT_LOG = BASE_DIR / 'querycount.jsonl'
+# the log rolls over at this size, keeping this many old files
+QUERY_COUNT_LOG_MAX_BYTES = 10 * 1024 ** 2
+QUERY_COUNT_LOG_BACKUPS = 3
+QUERY_BUDGETS = {
+    'chat_view': 10,
+    'ChatroomConsumer.websocket.receive': 5,
+}
+
+# seconds over which presence changes in a room are merged into one online count update
+CHAT_ONLINE_COUNT_WINDOW = 0.25
+
+# chunked attachment uploads, see a_rtchat.uploads
+CHAT_UPLOAD_MAX_SIZE = 1024 ** 3
+CHAT_UPLOAD_CHUNK_SIZE = 8 * 1024 ** 2
+# mime type prefixes allowed, None allows everything
+CHAT_UPLOAD_TYPES = None
+
+# pages speak the compact chat.json websocket protocol and render events
+# in the browser, instead of swapping in fragments rendered by the server
+CHAT_CLIENT_RENDERING = False
+
+# permessage-deflate on the chat sockets, see a_rtchat.deflate. None
+# leaves frames uncompressed
+CHAT_WEBSOCKET_DEFLATE = {
+    'window_bits': 11,
+    'mem_level': 4,
+}
+
+# batched message writes, see a_rtchat.writebehind. None saves each
+# message in its own transaction
+CHAT_WRITE_BEHIND = None
+
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
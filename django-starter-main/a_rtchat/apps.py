@@ -0,0 +1,18 @@
+from django.apps import AppConfig
+
+
+class ARtchatConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'a_rtchat'
+    
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_migrate
+        from .querycount import install, start_scope_log
+        from .search import install_index
+        from .writebehind import check_vendor
+        check_vendor()
+        connection_created.connect(install)
+        start_scope_log()
+        post_migrate.connect(install_index, sender=self)
+        import a_rtchat.signals
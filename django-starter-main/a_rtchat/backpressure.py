@@ -0,0 +1,152 @@
+"""
+A bounded queue between the channel layer and each chat socket.
+
+Channels hands a consumer one event at a time and waits for its handler
+before taking the next, so a socket whose handlers are slow (a thread
+pool hop under load, a render) leaves its events in the layer's channel.
+That channel holds ``capacity`` events and then loses the rest without a
+word, and a large capacity just queues more stale work.
+
+BackpressureMixin takes layer events off the channel as they arrive and
+handles them from a queue of its own, with explicit rules when the
+socket falls behind:
+
+    merged   events listed in ``merged_events`` only carry the latest
+             state of something, a newer one replaces the queued one and
+             moves to the back. They never count against the bound.
+    dropped  other events past CHAT_EVENT_BACKLOG queued for the socket
+             are dropped and counted.
+
+Once the queue drains after a drop the consumer's resync() runs, which
+sends the socket the current state in place of what it missed. Both
+counts are in backpressure_metrics, per consumer and event.
+
+Frames the socket itself sends (websocket.*) are handled as before.
+Daphne writes outgoing frames without waiting for the client, so a
+client that reads slowly isn't seen here, only a consumer that handles
+slowly.
+"""
+import asyncio
+import logging
+import threading
+from collections import Counter, defaultdict, deque
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BackpressureMetrics:
+    def __init__(self):
+        self.counts = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def record(self, consumer, event, outcome, amount=1):
+        with self.lock:
+            self.counts[consumer, event][outcome] += amount
+
+    def stats(self):
+        with self.lock:
+            consumers = {}
+            for (consumer, event), counts in sorted(self.counts.items()):
+                consumers.setdefault(consumer, {})[event] = dict(counts)
+            return consumers
+
+
+backpressure_metrics = BackpressureMetrics()
+
+
+class EventQueue:
+    """ Layer events for one socket, in order, with the merge and drop rules above. """
+    def __init__(self, limit, merge_key):
+        self.limit = limit
+        self.merge_key = merge_key
+        # [event] entries, a merged event empties its old entry
+        self.entries = deque()
+        self.merging = {}
+        self.bounded = 0
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+    def put(self, event):
+        """ 'queued', 'merged' or 'dropped' """
+        key = self.merge_key(event)
+        outcome = 'queued'
+        if key is not None:
+            old = self.merging.pop(key, None)
+            if old is not None:
+                old[0] = None
+                outcome = 'merged'
+        elif self.bounded >= self.limit:
+            self.dropped += 1
+            return 'dropped'
+        else:
+            self.bounded += 1
+        entry = [event]
+        self.entries.append(entry)
+        if key is not None:
+            self.merging[key] = entry
+        self.ready.set()
+        return outcome
+
+    async def get(self):
+        while True:
+            while self.entries:
+                event = self.entries.popleft()[0]
+                if event is None:
+                    continue
+                key = self.merge_key(event)
+                if key is None:
+                    self.bounded -= 1
+                else:
+                    del self.merging[key]
+                return event
+            self.ready.clear()
+            await self.ready.wait()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class BackpressureMixin:
+    # handler -> the event fields whose latest value wins
+    merged_events = {}
+
+    def merge_key(self, event):
+        fields = self.merged_events.get(event['type'])
+        if fields is None:
+            return None
+        return (event['type'], *[event.get(field) for field in fields])
+
+    async def dispatch(self, message):
+        if message['type'].startswith('websocket.'):
+            try:
+                await super().dispatch(message)
+            finally:
+                if message['type'] == 'websocket.disconnect' and hasattr(self, 'event_worker'):
+                    self.event_worker.cancel()
+            return
+        if not hasattr(self, 'event_queue'):
+            self.event_queue = EventQueue(getattr(settings, 'CHAT_EVENT_BACKLOG', 200), self.merge_key)
+            self.event_worker = asyncio.create_task(self.handle_events())
+        outcome = self.event_queue.put(message)
+        if outcome != 'queued':
+            backpressure_metrics.record(type(self).__name__, message['type'], outcome)
+
+    async def handle_events(self):
+        queue = self.event_queue
+        while True:
+            event = await queue.get()
+            try:
+                await super().dispatch(event)
+                if queue.dropped and not len(queue):
+                    backpressure_metrics.record(type(self).__name__, 'resync', 'sent')
+                    queue.dropped = 0
+                    await self.resync()
+            except Exception:
+                # as when the handler ran in dispatch, the socket goes
+                logger.exception('%s failed handling %s', type(self).__name__, event['type'])
+                await self.close(code=1011)
+                return
+
+    async def resync(self):
+        """ Send the socket the current state, after it missed events. """
@@ -0,0 +1,183 @@
+"""
+Helpers shared by the chat load test and benchmark management commands.
+
+Every run seeds under its own name prefix, bench- plus a random tag, and
+remembers the ids it created. cleanup deletes those ids and nothing else,
+so real users or rooms whose names happen to start with bench- survive.
+"""
+import asyncio
+import base64
+import os
+import struct
+import time
+import uuid
+import zlib
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.utils import timezone
+from a_users.models import Profile
+from .models import *
+
+BENCH_PREFIX = 'bench-'
+RUN_PREFIX = f'{BENCH_PREFIX}{uuid.uuid4().hex[:8]}-'
+
+# ids created by this process, the only rows cleanup deletes
+_seeded_users = set()
+_seeded_rooms = set()
+
+
+def disable_rate_limit():
+    """ The benchmarks set their own pace, which the chat rate limits would cut short. """
+    from . import ratelimit
+    ratelimit._rate_limit = ratelimit.InMemoryRateLimit(rates={scope: None for scope in ratelimit.DEFAULT_RATES})
+
+
+def seed_users(count, prefix=RUN_PREFIX):
+    # bulk_create skips the post_save signal, so profiles are added by hand
+    User.objects.bulk_create([
+        User(username=f'{prefix}user-{i}') for i in range(count)
+    ])
+    users = User.objects.filter(username__startswith=f'{prefix}user-').order_by('id')
+    Profile.objects.bulk_create([Profile(user=user) for user in users], ignore_conflicts=True)
+    users = list(users.select_related('profile'))
+    _seeded_users.update(user.id for user in users)
+    return users
+
+
+def seed_rooms(count, members=(), prefix=RUN_PREFIX):
+    rooms = ChatGroup.objects.bulk_create([
+        ChatGroup(group_name=f'{prefix}room-{i}', groupchat_name=f'{prefix}room-{i}') for i in range(count)
+    ])
+    rooms = list(ChatGroup.objects.filter(group_name__startswith=f'{prefix}room-').order_by('id'))
+    _seeded_rooms.update(room.id for room in rooms)
+    if members:
+        for room in rooms:
+            room.members.add(*members)
+    return rooms
+
+
+def seed_room(**fields):
+    """ One room made outside seed_rooms, still deleted by cleanup. """
+    room = ChatGroup.objects.create(**fields)
+    _seeded_rooms.add(room.id)
+    return room
+
+
+def cleanup():
+    ChatGroup.all_objects.filter(id__in=_seeded_rooms).delete()
+    User.objects.filter(id__in=_seeded_users).delete()
+    _seeded_rooms.clear()
+    _seeded_users.clear()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def seed_messages(room, authors, count, start=None, batch_size=5000, body=None):
+    """
+    Bulk insert ``count`` messages one second apart, ending now. ``body``
+    makes the text of message i, 'bench message i' by default.
+    """
+    start = start or timezone.now() - timedelta(seconds=count)
+    for offset in range(0, count, batch_size):
+        GroupMessage.objects.bulk_create([
+            GroupMessage(
+                group=room,
+                author=authors[i % len(authors)],
+                body=body(i) if body else f'bench message {i}',
+                created=start + timedelta(seconds=i),
+            )
+            for i in range(offset, min(count, offset + batch_size))
+        ])
+
+
+class WebsocketClient:
+    """
+    A bare websocket client on asyncio streams, for opening thousands of
+    sockets against real server processes. Text frames only, and it can
+    offer permessage-deflate. wire_bytes counts payload bytes as they
+    arrived, before any inflating.
+    """
+    def __init__(self, reader, writer, deflate=False):
+        self.reader = reader
+        self.writer = writer
+        self.inflater = zlib.decompressobj(-15) if deflate else None
+        self.wire_bytes = 0
+
+    @classmethod
+    async def connect(cls, host, port, path, cookies=None, deflate=False):
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        headers = [
+            f'GET {path} HTTP/1.1',
+            f'Host: {host}:{port}',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            f'Sec-WebSocket-Key: {key}',
+            'Sec-WebSocket-Version: 13',
+            f'Origin: http://{host}:{port}',
+        ]
+        if cookies:
+            headers.append('Cookie: ' + '; '.join(f'{name}={value}' for name, value in cookies.items()))
+        if deflate:
+            headers.append('Sec-WebSocket-Extensions: permessage-deflate')
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        if b' 101 ' not in response.split(b'\r\n')[0]:
+            writer.close()
+            raise ConnectionError(response.split(b'\r\n')[0].decode())
+        return cls(reader, writer, deflate and b'permessage-deflate' in response.lower())
+
+    def send(self, text):
+        self.write_frame(0x1, text.encode())
+
+    def write_frame(self, opcode, data):
+        header = bytearray([0x80 | opcode])
+        if len(data) < 126:
+            header.append(0x80 | len(data))
+        elif len(data) < 65536:
+            header += struct.pack('!BH', 0x80 | 126, len(data))
+        else:
+            header += struct.pack('!BQ', 0x80 | 127, len(data))
+        mask = os.urandom(4)
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(data))
+        self.writer.write(bytes(header) + mask + masked)
+
+    async def receive(self):
+        """ The next text frame, or None once the server closes. """
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7f
+            if length == 126:
+                length, = struct.unpack('!H', await self.reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', await self.reader.readexactly(8))
+            data = await self.reader.readexactly(length)
+            self.wire_bytes += length
+            if first & 0x40:
+                data = self.inflater.decompress(data + b'\x00\x00\xff\xff')
+            opcode = first & 0x0f
+            if opcode == 0x1:
+                return data.decode()
+            if opcode == 0x8:
+                return None
+            if opcode == 0x9:
+                # the pong has to echo the ping's payload
+                self.write_frame(0xa, data)
+
+    def close(self):
+        self.writer.close()
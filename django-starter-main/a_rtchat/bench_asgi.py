@@ -0,0 +1,22 @@
+"""
+The ASGI application for the worker processes chat_bench_cluster starts.
+It is the project's application with the channel layer the benchmark
+passes in CHAT_BENCH_CHANNEL_LAYERS.
+"""
+import json
+import os
+import django
+
+django.setup()
+
+from django.conf import settings
+
+settings.CHANNEL_LAYERS = json.loads(os.environ['CHAT_BENCH_CHANNEL_LAYERS'])
+# every worker appending to one log would measure the log, not the chat
+settings.QUERY_COUNT_LOG = None
+
+from a_rtchat.bench import disable_rate_limit
+
+disable_rate_limit()
+
+from a_core.asgi import application
@@ -0,0 +1,288 @@
+import asyncio
+import contextvars
+import logging
+from collections import defaultdict
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.urls import reverse
+from .models import *
+from .history import message_json
+from .presence import get_presence
+from .querycount import count_queries
+from .roomcache import room_cache
+from .unread import unread_counts
+
+logger = logging.getLogger(__name__)
+
+
+def chat_message_event(message_id):
+    """
+    Load a message once, with author and profile, and render its fragment
+    once. The finished html travels in the event, so subscribers only
+    forward it instead of each running their own query and render.
+    """
+    message = GroupMessage.objects.select_related('author__profile', 'group').get(id=message_id)
+    return message_event(message, get_presence().online(message.group.group_name))
+
+
+def message_event(message, online_ids):
+    context = {
+        'message': message,
+        'chat_group': message.group,
+        'online_ids': online_ids,
+    }
+    html = render_to_string("a_rtchat/partials/chat_message_p.html", context=context)
+    return {
+        'type': 'message_handler',
+        'message_id': message.id,
+        'author_id': message.author_id,
+        'html': html,
+        # for sockets on a compact protocol, see a_rtchat.protocols
+        'data': {'t': 'message', 'message': message_json(message)},
+    }
+
+
+def online_count_event(room):
+    """ ``room`` is a RoomContext, see a_rtchat.roomcache """
+    online_ids = get_presence().online(room.chatroom.group_name)
+    online_count = len(online_ids) -1
+    context = {
+        'online_count' : online_count,
+        'chat_group' : room.chatroom,
+        'members': room.members,
+        'author_ids': room.author_ids,
+        'online_ids': online_ids,
+    }
+    html = render_to_string("a_rtchat/partials/online_count.html", context)
+    return {
+        'type': 'online_count_handler',
+        'online_count': online_count,
+        'online_ids': list(online_ids),
+        'html': html,
+    }
+
+
+async def broadcast_online_count(group_name):
+    with count_queries('broadcast_online_count'):
+        try:
+            room = await database_sync_to_async(room_cache.get)(group_name)
+        except ChatGroup.DoesNotExist:
+            # deleted since the update was scheduled
+            return
+        event = await database_sync_to_async(online_count_event)(room)
+    room_cache.online_changed(group_name, event['online_ids'])
+    await get_channel_layer().group_send(group_name, event)
+
+
+def user_status_group(user_id):
+    return f'online-status-{user_id}'
+
+
+def chat_status_groups(room):
+    """
+    The groups whose chats-list shows this room: the members of a private
+    or group chat, or everyone for the public chat.
+    """
+    chat_group = room.chatroom
+    if chat_group.is_private or chat_group.groupchat_name:
+        return [user_status_group(user_id) for user_id in room.member_ids]
+    return ['online-status']
+
+
+async def broadcast_chat_status(room, user_id):
+    """
+    Tell the users who list this room that its presence changed. Each of
+    them works out its own dot from presence and only sends a diff when
+    it flips.
+    """
+    groups = chat_status_groups(room)
+    event = {
+        'type': 'chat_status_handler',
+        'room': room.chatroom.group_name,
+    }
+    channel_layer = get_channel_layer()
+    for group in groups:
+        if group != user_status_group(user_id):
+            await channel_layer.group_send(group, event)
+
+
+async def broadcast_offline(room, user_id):
+    """ A user's last connection to ``room`` expired instead of disconnecting. """
+    if room == 'online-status':
+        presence = get_presence()
+        await get_channel_layer().group_send(room, online_users_event(await presence.acount(room) - 1))
+        return
+    online_count_coalescer.schedule(room, lambda: broadcast_online_count(room))
+    try:
+        context = await database_sync_to_async(room_cache.get)(room)
+    except ChatGroup.DoesNotExist:
+        return
+    await broadcast_chat_status(context, user_id)
+
+
+async def sweep_presence():
+    """
+    Expire presence every heartbeat interval and broadcast who went
+    offline, for connections that stopped without a disconnect: a worker
+    that died, a client that dropped off the network.
+    """
+    presence = get_presence()
+    while True:
+        await asyncio.sleep(presence.heartbeat_interval)
+        try:
+            for room, user_id in await presence.asweep():
+                await broadcast_offline(room, user_id)
+        except Exception:
+            logger.exception('Could not sweep presence')
+
+
+_sweeper = None
+
+
+def start_presence_sweep():
+    """ One sweep_presence task per process, on the running loop. """
+    global _sweeper
+    loop = asyncio.get_running_loop()
+    if _sweeper is None or _sweeper.done() or _sweeper.get_loop() is not loop:
+        _sweeper = loop.create_task(sweep_presence(), context=contextvars.Context())
+
+
+def unread_group(group_name):
+    """ The status sockets of users with a read cursor in the room. """
+    return f'unread-{group_name}'
+
+
+async def broadcast_unread(room, author_id):
+    """
+    One more message in ``room``, one send for all the users who count
+    it. Each of them adds it to their own count unless they wrote it or
+    have the room open, see a_rtchat.unread.
+    """
+    await get_channel_layer().group_send(unread_group(room.chatroom.group_name), {
+        'type': 'unread_handler',
+        'room': room.chatroom.group_name,
+        'author_id': author_id,
+        'online_ids': list(room.online_ids),
+    })
+
+
+async def broadcast_read(user_id, group_name):
+    """ The user read the room, their other pages drop its count. """
+    await get_channel_layer().group_send(user_status_group(user_id), {
+        'type': 'read_handler',
+        'room': group_name,
+    })
+
+
+def online_status_context(user):
+    """
+    What the header status shows for one user. Its active_chats is the
+    set of their rooms that have other people online, unread their
+    unread counts by room.
+    """
+    presence = get_presence()
+    
+    my_chats = user.chat_groups.prefetch_related('members__profile')
+    active_chats = {
+        chat.group_name for chat in my_chats
+        if (chat.is_private or chat.groupchat_name) and presence.others_online(chat.group_name, user.id)
+    }
+    if presence.others_online('public-chat', user.id):
+        active_chats.add('public-chat')
+    
+    unread = unread_counts(user)
+    for chat in my_chats:
+        chat.unread = unread.get(chat.group_name, 0)
+    
+    return {
+        'online_users_count': presence.count('online-status') -1,
+        'active_chats': active_chats,
+        'unread': unread,
+        'public_unread': unread.get('public-chat', 0),
+        'my_chats': my_chats,
+        'user': user
+    }
+
+
+def online_status_html(user):
+    context = online_status_context(user)
+    html = render_to_string("a_rtchat/partials/online_status.html", context=context)
+    return html, context['active_chats'], context['unread']
+
+
+def online_status_data(user):
+    """ The compact version of online_status_html, with the chats-list as data. """
+    context = online_status_context(user)
+    chats = [{'room': 'public-chat', 'name': 'Public Chat', 'url': reverse('home')}]
+    # same order as the template, group chats then private chats
+    for chat in context['my_chats']:
+        if chat.groupchat_name:
+            chats.append({'room': chat.group_name, 'name': chat.groupchat_name[:30], 'url': reverse('chatroom', args=[chat.group_name])})
+    for chat in context['my_chats']:
+        if chat.is_private:
+            for member in chat.members.all():
+                if member != user:
+                    chats.append({'room': chat.group_name, 'name': member.profile.name, 'url': reverse('chatroom', args=[chat.group_name])})
+    data = {
+        't': 'status',
+        'online_users': context['online_users_count'],
+        'active_chats': sorted(context['active_chats']),
+        'unread': context['unread'],
+        'chats': chats,
+    }
+    return data, context['active_chats'], context['unread']
+
+
+def online_users_event(online_users_count):
+    html = render_to_string("a_rtchat/partials/online_users.html", {'online_users_count': online_users_count})
+    return {
+        'type': 'online_users_handler',
+        'html': html,
+        'data': {'t': 'online_users', 'count': online_users_count},
+    }
+
+
+class Coalescer:
+    """
+    Collapses bursts of per-room events into one callback per window. The
+    first event for a room schedules the callback, events that arrive
+    before it fires are merged into it.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.metrics = defaultdict(lambda: {'events': 0, 'broadcasts': 0, 'failures': 0})
+        
+    def schedule(self, room, callback):
+        self.metrics[room]['events'] += 1
+        if room not in self.pending:
+            # a fresh context, so the flush is not counted as part of
+            # whichever consumer event happened to schedule it
+            self.pending[room] = asyncio.create_task(self.flush(room, callback), context=contextvars.Context())
+            
+    async def flush(self, room, callback):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            del self.pending[room]
+        metrics = self.metrics[room]
+        metrics['broadcasts'] += 1
+        logger.debug('%s: %s events merged into %s broadcasts', room, metrics['events'], metrics['broadcasts'])
+        try:
+            await callback()
+        except Exception:
+            # nothing awaits this task, an error would only surface as
+            # "exception was never retrieved" when it is collected
+            metrics['failures'] += 1
+            logger.exception('%s: coalesced broadcast failed', room)
+        
+    def stats(self):
+        return {
+            room: {**metrics, 'merged': metrics['events'] - metrics['broadcasts']}
+            for room, metrics in self.metrics.items()
+        }
+
+
+online_count_coalescer = Coalescer(getattr(settings, 'CHAT_ONLINE_COUNT_WINDOW', 0.25))
@@ -1,144 +1,386 @@
-from channels.generic.websocket import WebsocketConsumer
-from django.shortcuts import get_object_or_404
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from django.conf import settings
 from django.template.loader import render_to_string
-from asgiref.sync import async_to_sync
-import json
+import asyncio
 from .models import *
+from .backpressure import BackpressureMixin
+from .broadcast import *
+from .history import history_page, message_json, messages_after
+from .membership import can_read
+from .roomcache import room_cache
+from .presence import get_presence
+from .protocols import *
+from .querycount import QueryCountMixin
+from .ratelimit import get_rate_limit, retry_seconds
+from .socketmetrics import SocketMetricsMixin
+from .unread import mark_read
+from .writebehind import get_writer, valid_body
 
-class ChatroomConsumer(WebsocketConsumer):
-    def connect(self):
+
+class PresenceMixin:
+    async def join_presence(self, room):
+        self.presence = get_presence()
+        self.presence_room = room
+        joined = await self.presence.ajoin(room, self.user.id, self.channel_name)
+        self.heartbeat = asyncio.create_task(self.keep_alive())
+        start_presence_sweep()
+        return joined
+    
+    async def leave_presence(self):
+        if not hasattr(self, 'heartbeat'):
+            return False
+        self.heartbeat.cancel()
+        return await self.presence.aleave(self.presence_room, self.user.id, self.channel_name)
+    
+    async def keep_alive(self):
+        while True:
+            await asyncio.sleep(self.presence.heartbeat_interval)
+            await self.presence.aheartbeat(self.presence_room, self.user.id, self.channel_name)
+
+
+class ProtocolMixin:
+    """ html fragments by default, compact events if the client asked, see a_rtchat.protocols """
+    async def accept_protocol(self):
+        self.protocol = negotiate(self.scope)
+        await self.accept(self.protocol)
+        
+    async def push(self, html, data):
+        if self.protocol is None:
+            await self.send(text_data=html)
+        else:
+            await self.send(**encode(self.protocol, data))
+
+
+class ChatroomConsumer(BackpressureMixin, QueryCountMixin, SocketMetricsMixin, PresenceMixin, ProtocolMixin, AsyncWebsocketConsumer):
+    # only the latest of these matters to a socket that fell behind
+    merged_events = {
+        'online_count_handler': (),
+        'room_cache_handler': ('room',),
+    }
+    
+    async def connect(self):
         self.user = self.scope['user']
         self.chatroom_name = self.scope['url_route']['kwargs']['chatroom_name'] 
-        self.chatroom = get_object_or_404(ChatGroup, group_name=self.chatroom_name)
+        try:
+            room = await database_sync_to_async(room_cache.acquire)(self.chatroom_name, self.user)
+        except ChatGroup.DoesNotExist:
+            await self.close()
+            return
+        if not await database_sync_to_async(can_read)(self.user, room.chatroom):
+            room_cache.release(self.chatroom_name)
+            await self.close()
+            return
+        self.room = room
+        self.chatroom = self.room.chatroom
+        self.online_ids_sent = None
+        self.resumed = False
         
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.chatroom_name, self.channel_name
         )
         
         # add and update online users
-        if self.user not in self.chatroom.users_online.all():
-            self.chatroom.users_online.add(self.user)
-            self.update_online_count()
+        if await self.join_presence(self.chatroom_name):
+            await self.update_online_count()
+            await broadcast_chat_status(self.room, self.user.id)
         
-        self.accept()
+        await self.accept_protocol()
         
         
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
-            self.chatroom_name, self.channel_name
-        )
-        # remove and update online users
-        if self.user in self.chatroom.users_online.all():
-            self.chatroom.users_online.remove(self.user)
-            self.update_online_count() 
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'room'):
+            return
+        try:
+            await self.channel_layer.group_discard(
+                self.chatroom_name, self.channel_name
+            )
+            # remove and update online users
+            left = await self.leave_presence()
+            if left:
+                await self.update_online_count()
+            try:
+                room = await database_sync_to_async(room_cache.get)(self.chatroom_name)
+            except ChatGroup.DoesNotExist:
+                # deleted while it was open, nothing left to update
+                return
+            if left:
+                await broadcast_chat_status(room, self.user.id)
+            # what came in while the room was open has been read
+            await database_sync_to_async(self.mark_read)()
+            await broadcast_read(self.user.id, self.chatroom_name)
+        finally:
+            room_cache.release(self.chatroom_name)
         
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        body = text_data_json['body']
+    async def receive(self, text_data=None, bytes_data=None):
+        # members removed while connected can't post, a cache hit each time
+        if not await database_sync_to_async(can_read)(self.user, self.chatroom):
+            await self.close()
+            return
+        data = decode(self.protocol, text_data, bytes_data)
+        if 'resume' in data:
+            # once per socket, right after it reconnected
+            if not self.resumed:
+                self.resumed = True
+                await self.resume(data['resume'])
+            return
+        # the connection's, the user's and the room's bucket, see a_rtchat.ratelimit
+        retry_after = await get_rate_limit().aallow(connection=self.channel_name, user=self.user.id, room=self.chatroom_name)
+        if retry_after:
+            await self.push(
+                render_to_string('a_rtchat/partials/chat_throttled.html', {'retry': retry_seconds(retry_after)}),
+                {'t': 'throttled', 'retry': retry_seconds(retry_after)},
+            )
+            return
+        body = data.get('body')
+        # checked before it's journaled, a row the database refuses would
+        # be broadcast and never saved
+        if not valid_body(body):
+            return
         
-        message = GroupMessage.objects.create(
+        message = GroupMessage(
             body = body,
             author = self.user, 
             group = self.chatroom 
         )
-        event = {
-            'type': 'message_handler',
-            'message_id': message.id,
-        }
-        async_to_sync(self.channel_layer.group_send)(
+        writer = get_writer()
+        if writer is not None:
+            # journaled now, saved with the next batch
+            await database_sync_to_async(writer.add)(message)
+        else:
+            await message.asave()
+        event = await self.render_message_event(message)
+        await self.channel_layer.group_send(
             self.chatroom_name, event
         )
+        room = await database_sync_to_async(room_cache.get)(self.chatroom_name)
+        await broadcast_unread(room, self.user.id)
         
-    def message_handler(self, event):
-        message_id = event['message_id']
-        message = GroupMessage.objects.get(id=message_id)
-        context = {
-            'message': message,
-            'user': self.user,
-            'chat_group': self.chatroom
-        }
-        html = render_to_string("a_rtchat/partials/chat_message_p.html", context=context)
-        self.send(text_data=html)
+    async def message_handler(self, event):
+        if 'author_id' in event:
+            room_cache.message_sent(self.chatroom_name, event['message_id'], event['author_id'])
+        # events rendered on the sending side carry the finished html
+        if 'html' not in event:
+            event = await self.render_message(event['message_id'])
+        await self.push(event['html'], event['data'])
         
         
-    def update_online_count(self):
-        online_count = self.chatroom.users_online.count() -1
+    async def update_online_count(self):
+        # joins and leaves within one window go out as a single update,
+        # rendered once for the whole room
+        chatroom_name = self.chatroom_name
+        online_count_coalescer.schedule(chatroom_name, lambda: broadcast_online_count(chatroom_name))
         
-        event = {
-            'type': 'online_count_handler',
-            'online_count': online_count
-        }
-        async_to_sync(self.channel_layer.group_send)(self.chatroom_name, event)
+    async def online_count_handler(self, event):
+        if 'online_ids' in event:
+            room_cache.online_changed(self.chatroom_name, event['online_ids'])
+        if self.protocol is not None:
+            # each socket gets who came and went since its last update
+            data, self.online_ids_sent = presence_delta(self.online_ids_sent, event['online_ids'], event['online_count'])
+            await self.send(**encode(self.protocol, data))
+            return
+        html = event.get('html')
+        if html is None:
+            html = await self.render_online_count()
+        await self.send(text_data=html) 
         
-    def online_count_handler(self, event):
-        online_count = event['online_count']
+    async def room_cache_handler(self, event):
+        room_cache.invalidate(event['room'], event['token'])
         
-        chat_messages = ChatGroup.objects.get(group_name=self.chatroom_name).chat_messages.all()[:30]
-        author_ids = set([message.author.id for message in chat_messages])
-        users = User.objects.filter(id__in=author_ids)
+    async def settle(self):
+        write_behind = getattr(settings, 'CHAT_WRITE_BEHIND', None)
+        if write_behind:
+            # other workers' messages reach the table within an interval
+            await asyncio.sleep(write_behind.get('interval', 0.05))
         
-        context = {
-            'online_count' : online_count,
-            'chat_group' : self.chatroom,
-            'users': users
-        }
-        html = render_to_string("a_rtchat/partials/online_count.html", context)
-        self.send(text_data=html) 
+    async def resync(self):
+        # messages were dropped, the latest page replaces what it has
+        await self.settle()
+        html, data = await self.render_latest()
+        await self.push(html, data)
+        if self.protocol is None:
+            # the history page comes without the authors' dots
+            await self.send(text_data=await self.render_online_count())
+        
+    async def resume(self, message_id):
+        # a reconnected socket sends the last message it has and gets what
+        # it missed and who is online in one frame, instead of reloading
+        # the page. Too far behind, it gets the latest page like resync
+        await self.settle()
+        html, data = await self.render_resume(message_id)
+        if data is not None:
+            # later presence events are deltas from this snapshot
+            self.online_ids_sent = set(data['presence']['online'])
+        await self.push(html, data)
+        
+    @database_sync_to_async
+    def render_message_event(self, message):
+        # author and room come from the room cache, nothing is read back
+        room = room_cache.get(self.chatroom_name)
+        message.author = room.user(self.user.id)
+        message.group = room.chatroom
+        return message_event(message, room.online_ids)
         
+    @database_sync_to_async
+    def render_message(self, message_id):
+        return chat_message_event(message_id)
+    
+    @database_sync_to_async
+    def render_latest(self):
+        chat_messages, next_cursor = history_page(self.chatroom)
+        context = {'chat_messages': chat_messages, 'next_cursor': next_cursor, 'chat_group': self.chatroom}
+        html = render_to_string('a_rtchat/partials/chat_resync.html', context)
+        return html, {'t': 'resync', 'messages': [message_json(message) for message in chat_messages], 'next': next_cursor}
+    
+    @database_sync_to_async
+    def render_resume(self, message_id):
+        try:
+            missed = messages_after(self.chatroom, int(message_id))
+        except (TypeError, ValueError):
+            missed = None
+        replace = missed is None
+        next_cursor = None
+        if replace:
+            missed, next_cursor = history_page(self.chatroom)
+        if self.protocol is not None:
+            online_ids = get_presence().online(self.chatroom_name)
+            presence = presence_delta(None, online_ids, len(online_ids) - 1)[0]
+            return None, {
+                't': 'resume',
+                'messages': [message_json(message) for message in missed],
+                'replace': replace,
+                'next': next_cursor,
+                'presence': presence,
+            }
+        context = {'chat_messages': missed, 'next_cursor': next_cursor, 'chat_group': self.chatroom}
+        template = 'a_rtchat/partials/chat_resync.html' if replace else 'a_rtchat/partials/chat_resume.html'
+        html = render_to_string(template, context)
+        return html + online_count_event(room_cache.get(self.chatroom_name))['html'], None
+    
+    def mark_read(self):
+        room = room_cache.get(self.chatroom_name)
+        mark_read(self.user.id, self.chatroom.id, room.recent_ids[0] if room.recent_ids else 0)
+    
+    @database_sync_to_async
+    def render_online_count(self):
+        return online_count_event(room_cache.get(self.chatroom_name))['html']
         
-class OnlineStatusConsumer(WebsocketConsumer):
-    def connect(self):
+        
+class OnlineStatusConsumer(BackpressureMixin, QueryCountMixin, SocketMetricsMixin, PresenceMixin, ProtocolMixin, AsyncWebsocketConsumer):
+    """
+    Keeps the header's online count and the chats-list dots and unread
+    counts current. The full chats-list is rendered once on connect, after
+    that each connection only hears about rooms it lists and sends a diff
+    when a dot flips or a count changes.
+    """
+    merged_events = {
+        'online_users_handler': (),
+        'chat_status_handler': ('room',),
+        'read_handler': ('room',),
+    }
+    
+    async def connect(self):
         self.user = self.scope['user']
         self.group_name = 'online-status'
-        self.group = get_object_or_404(ChatGroup, group_name=self.group_name)
+        self.user_group_name = user_status_group(self.user.id)
+        # filled in by send_online_status
+        self.active_chats, self.unread = set(), {}
         
-        if self.user not in self.group.users_online.all():
-            self.group.users_online.add(self.user)
+        joined = await self.join_presence(self.group_name)
             
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.group_name, self.channel_name
         )
+        await self.channel_layer.group_add(
+            self.user_group_name, self.channel_name
+        )
         
-        self.accept()
-        self.online_status()
+        await self.accept_protocol()
+        await self.send_online_status()
+        # a room's unread events come once to everyone counting it
+        self.unread_groups = [unread_group(room) for room in self.unread]
+        for group in self.unread_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        if joined:
+            await self.online_users()
         
         
-    def disconnect(self, close_code):
-        if self.user in self.group.users_online.all():
-            self.group.users_online.remove(self.user)
+    async def disconnect(self, close_code):
+        left = await self.leave_presence()
             
-        async_to_sync(self.channel_layer.group_discard)(
+        await self.channel_layer.group_discard(
             self.group_name, self.channel_name
         )
-        self.online_status()
+        await self.channel_layer.group_discard(
+            self.user_group_name, self.channel_name
+        )
+        for group in getattr(self, 'unread_groups', ()):
+            await self.channel_layer.group_discard(group, self.channel_name)
+        if left:
+            await self.online_users()
         
         
-    def online_status(self):
-        event = {
-            'type': 'online_status_handler'
-        }
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name, event
+    async def online_users(self):
+        # everyone sees the same count of other online users
+        online_users_count = await self.presence.acount(self.group_name) -1
+        await self.channel_layer.group_send(
+            self.group_name, online_users_event(online_users_count)
         ) 
         
-    def online_status_handler(self, event):
-        online_users = self.group.users_online.exclude(id=self.user.id)
-        public_chat_users = ChatGroup.objects.get(group_name='public-chat').users_online.exclude(id=self.user.id)
+    async def online_users_handler(self, event):
+        await self.push(event['html'], event['data'])
         
-        my_chats = self.user.chat_groups.all()
-        private_chats_with_users = [chat for chat in my_chats.filter(is_private=True) if chat.users_online.exclude(id=self.user.id)]
-        group_chats_with_users = [chat for chat in my_chats.filter(groupchat_name__isnull=False) if chat.users_online.exclude(id=self.user.id)]
+    async def chat_status_handler(self, event):
+        room = event['room']
+        active = await self.presence.aothers_online(room, self.user.id)
+        if active == (room in self.active_chats):
+            return
         
-        if public_chat_users or private_chats_with_users or group_chats_with_users:
-            online_in_chats = True
+        online_in_chats = bool(self.active_chats)
+        if active:
+            self.active_chats.add(room)
         else:
-            online_in_chats = False
+            self.active_chats.discard(room)
         
+        if self.protocol is not None:
+            data = {'t': 'chat_status', 'room': room, 'active': active, 'any': bool(self.active_chats)}
+            await self.send(**encode(self.protocol, data))
+            return
         context = {
-            'online_users': online_users,
-            'online_in_chats': online_in_chats,
-            'public_chat_users': public_chat_users,
-            'user': self.user
+            'room': room,
+            'active_chats': self.active_chats,
+            'online_in_chats_changed': online_in_chats != bool(self.active_chats),
         }
-        html = render_to_string("a_rtchat/partials/online_status.html", context=context)
-        self.send(text_data=html) 
+        html = render_to_string("a_rtchat/partials/chat_status.html", context=context)
+        await self.send(text_data=html)
+        
+    async def unread_handler(self, event):
+        room = event['room']
+        # no cursor, nothing to count against
+        if room not in self.unread or event['author_id'] == self.user.id or self.user.id in event['online_ids']:
+            return
+        self.unread[room] += 1
+        await self.send_unread(room)
+        
+    async def read_handler(self, event):
+        self.unread[event['room']] = 0
+        await self.send_unread(event['room'])
+        
+    async def send_unread(self, room):
+        if self.protocol is not None:
+            await self.send(**encode(self.protocol, {'t': 'unread', 'room': room, 'count': self.unread[room]}))
+            return
+        context = {'room': room, 'unread': self.unread[room]}
+        await self.send(text_data=render_to_string("a_rtchat/partials/unread_count.html", context=context))
+        
+    async def resync(self):
+        # unread events were dropped, the whole status is sent again
+        await self.send_online_status()
+        
+    async def send_online_status(self):
+        if self.protocol is None:
+            html, self.active_chats, self.unread = await database_sync_to_async(online_status_html)(self.user)
+            await self.send(text_data=html)
+        else:
+            data, self.active_chats, self.unread = await database_sync_to_async(online_status_data)(self.user)
+            await self.send(**encode(self.protocol, data))
@@ -0,0 +1,99 @@
+"""
+permessage-deflate for the chat websockets.
+
+Compression is negotiated by the server, the ASGI application never sees
+it. Autobahn, which Daphne speaks websockets with, lets each protocol
+instance carry its own perMessageCompressionAccept, so setting one on
+Daphne's protocol class turns deflate on for every socket that offers
+it. a_core.asgi calls enable_deflate() on import, and it does nothing
+unless CHAT_WEBSOCKET_DEFLATE is set:
+
+    CHAT_WEBSOCKET_DEFLATE = {
+        'window_bits': 11,
+        'mem_level': 4,
+        'meter_sample': 0.05,
+    }
+
+A compressed socket keeps its zlib stream while it is open, about
+2 ** (window_bits + 2) + 2 ** (mem_level + 9) bytes, which is what the
+two settings trade against how well repeated markup compresses.
+
+The server's compressed sizes aren't visible from here either, so a
+DeflateMeter compresses a socket's frames a second time to measure them.
+Only ``meter_sample`` of the deflate sockets get one, picked when they
+open, which keeps the doubled compression work and memory to that
+fraction. 0 turns metering off.
+"""
+import random
+import zlib
+from django.conf import settings
+
+# what enable_deflate() accepted with, None while deflate is off
+_options = None
+
+
+def enable_deflate():
+    global _options
+    config = getattr(settings, 'CHAT_WEBSOCKET_DEFLATE', None)
+    if not config:
+        return False
+    try:
+        from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+        from daphne.ws_protocol import WebSocketProtocol
+    except ImportError:
+        return False
+    window_bits = config.get('window_bits', 15)
+    mem_level = config.get('mem_level', 8)
+
+    def accept(offers):
+        for offer in offers:
+            if isinstance(offer, PerMessageDeflateOffer):
+                bits = window_bits
+                if offer.request_max_window_bits:
+                    bits = min(bits, offer.request_max_window_bits)
+                return PerMessageDeflateOfferAccept(offer, window_bits=bits, mem_level=mem_level)
+        return None
+
+    WebSocketProtocol.perMessageCompressionAccept = staticmethod(accept)
+    _options = {'window_bits': window_bits, 'mem_level': mem_level, 'meter_sample': config.get('meter_sample', 0.05)}
+    return True
+
+
+class DeflateMeter:
+    """
+    The size permessage-deflate makes of each frame on one socket, from a
+    zlib stream set up the way autobahn sets up the real one.
+    """
+    def __init__(self, window_bits, mem_level, context_takeover=True):
+        self.window_bits = window_bits
+        self.mem_level = mem_level
+        self.context_takeover = context_takeover
+        self.compressor = None
+
+    def size(self, data):
+        if self.compressor is None or not self.context_takeover:
+            self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -self.window_bits, self.mem_level)
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        # the 00 00 ff ff tail of the sync flush is left off the wire
+        return len(compressed) - 4
+
+
+def deflate_offered(scope):
+    """ The socket's permessage-deflate offer, '' if it didn't make one or deflate is off. """
+    if _options is None:
+        return ''
+    offered = b', '.join(value for name, value in scope.get('headers', ()) if name == b'sec-websocket-extensions').decode('latin-1')
+    return offered if 'permessage-deflate' in offered else ''
+
+
+def meter_for(scope):
+    """ A DeflateMeter for a sampled socket that negotiated deflate, otherwise None. """
+    offered = deflate_offered(scope)
+    if not offered or random.random() >= _options['meter_sample']:
+        return None
+    window_bits = _options['window_bits']
+    for param in offered.replace(',', ';').split(';'):
+        name, _, value = param.strip().partition('=')
+        if name == 'server_max_window_bits' and value.strip('"').isdigit():
+            window_bits = min(window_bits, int(value.strip('"')))
+    return DeflateMeter(window_bits, _options['mem_level'], 'server_no_context_takeover' not in offered)
@@ -0,0 +1,88 @@
+"""
+Resized WebP and JPEG copies of chat images and avatars.
+
+Resizing runs off the request path: an I/O thread reads the original from
+storage, a local process pool does the Pillow work, and the thread saves
+the results and records them on the row as {format: {width: name}}.
+Templates build srcset attributes from that record, so they never need
+to check storage.
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from .imaging import render_variants
+
+logger = logging.getLogger(__name__)
+
+CHAT_IMAGE_WIDTHS = (320, 640, 1280)
+AVATAR_WIDTHS = (64, 128, 288)
+FORMATS = ('webp', 'jpeg')
+
+
+class DerivativePipeline:
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.pool = None
+        self.io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='derivatives')
+
+    def process_pool(self):
+        if self.pool is None:
+            # spawn, the server process has threads and an event loop running
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.pool
+
+    def schedule(self, instance, file_field, variants_field, widths):
+        return self.io.submit(self.run, type(instance), instance.pk, file_field, variants_field, widths)
+
+    def run(self, model, pk, file_field, variants_field, widths):
+        try:
+            instance = model.objects.filter(pk=pk).first()
+            if instance is None:
+                return
+            file = getattr(instance, file_field)
+            with file.open('rb'):
+                data = file.read()
+            results = self.process_pool().submit(render_variants, data, widths, FORMATS).result()
+
+            base, ext = os.path.splitext(file.name)
+            variants = {}
+            for (format, width), content in sorted(results.items()):
+                name = default_storage.save(f'{base}_{width}w.{format}', ContentFile(content))
+                variants.setdefault(format, {})[str(width)] = name
+            # only store them if the file has not been replaced meanwhile
+            updated = model.objects.filter(pk=pk, **{file_field: file.name}).update(**{variants_field: variants})
+            if not updated:
+                delete_variants(variants)
+        except Exception:
+            logger.exception('Could not create derivatives for %s %s', model.__name__, pk)
+        finally:
+            close_old_connections()
+
+
+def delete_variants(variants):
+    for names in variants.values():
+        for name in names.values():
+            default_storage.delete(name)
+
+
+def srcset(variants, format='webp'):
+    names = (variants or {}).get(format, {})
+    return ', '.join(
+        f'{default_storage.url(name)} {width}w'
+        for width, name in sorted(names.items(), key=lambda item: int(item[0]))
+    )
+
+
+_pipeline = None
+
+
+def get_pipeline():
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = DerivativePipeline(getattr(settings, 'CHAT_IMAGE_WORKERS', 2))
+    return _pipeline
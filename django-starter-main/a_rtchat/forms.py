@@ -28,10 +28,18 @@ class NewGroupForm(ModelForm):
 class ChatRoomEditForm(ModelForm):
     class Meta:
         model = ChatGroup
-        fields = ['groupchat_name']
+        fields = ['groupchat_name', 'retention_days']
+        labels = {
+            'retention_days': 'Archive messages after (days)',
+        }
         widgets = {
             'groupchat_name' : forms.TextInput(attrs={
                 'class': 'p-4 text-xl font-bold mb-4', 
                 'maxlength' : '300', 
                 }),
+            'retention_days' : forms.NumberInput(attrs={
+                'class': 'p-4 mb-4',
+                'min': '1',
+                'placeholder': 'Keep them',
+                }),
         }
@@ -0,0 +1,159 @@
+"""
+Rendered chat_message.html fragments, so opening a room or paging its
+history doesn't render every message again.
+
+A message's fragment depends on the template, on the message's file
+metadata, which changes when its image variants arrive, and on its
+author's username and profile. Entries are keyed by the message id and
+three digests: the template source, the file fields the template reads
+and what the fragment shows of the author. A deploy that edits the
+template, or a new display name or avatar, gives new digests, so those
+fragments miss and render again while every other entry is still
+served. The stale entries are never read again and age out.
+
+Each process keeps an LRU of ``max_entries`` fragments. With a url the
+fragments are shared through Redis as well, looked up in one MGET for a
+page and kept for ``timeout`` seconds::
+
+    CHAT_FRAGMENTS = {
+        'max_entries': 5000,
+        'url': 'redis://localhost:6379/0',
+        'timeout': 86400,
+    }
+
+stats() has the hits of both tiers, the renders and the render time the
+hits saved, estimated from the average render.
+"""
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+FRAGMENT_TEMPLATE = 'a_rtchat/chat_message.html'
+
+
+def digest(shown):
+    return hashlib.blake2b(shown.encode(), digest_size=6).hexdigest()
+
+
+def profile_version(user):
+    profile = user.profile
+    return digest(f'{user.username}|{profile.displayname}|{profile.image.name}|{sorted_variants(profile.image_variants)}')
+
+
+def file_version(message):
+    if not message.file:
+        return ''
+    return digest(
+        f'{message.file.name}|{message.is_image}|{message.file_width}|{message.file_height}'
+        f'|{sorted_variants(message.file_variants)}'
+    )
+
+
+def sorted_variants(variants):
+    return sorted((format, sorted(names.items())) for format, names in (variants or {}).items())
+
+
+class FragmentCache:
+    def __init__(self, max_entries=5000, url=None, prefix='fragment', timeout=86400, client=None):
+        if client is None and url:
+            import redis
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+        self.prefix = prefix
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.metrics = Counter()
+        self.render_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def key(self, message, template_version):
+        return (
+            f'{self.prefix}:{message.id}:{template_version}:{file_version(message)}'
+            f':{profile_version(message.author)}'
+        )
+
+    def render(self, messages):
+        """ The fragments of ``messages``, in their order. """
+        # hashed on every call, with DEBUG the loader rereads an edited template
+        template = get_template(FRAGMENT_TEMPLATE)
+        template_version = digest(template.template.source)
+        keys = [self.key(message, template_version) for message in messages]
+        fragments = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    fragments[key] = self.entries[key]
+            self.metrics['local_hits'] += len(fragments)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in fragments]
+        if missing and self.client is not None:
+            shared = {key: html for key, html in zip(missing, self.client.mget(missing)) if html is not None}
+            fragments.update(shared)
+            self.store(shared)
+            self.count('shared_hits', len(shared))
+
+        rendered = {}
+        started = time.perf_counter()
+        for key, message in zip(keys, messages):
+            if key not in fragments and key not in rendered:
+                rendered[key] = template.render({'message': message})
+        elapsed = time.perf_counter() - started
+        if rendered:
+            fragments.update(rendered)
+            self.store(rendered)
+            if self.client is not None:
+                pipe = self.client.pipeline(transaction=False)
+                for key, html in rendered.items():
+                    pipe.set(key, html, ex=self.timeout)
+                pipe.execute()
+            with self.lock:
+                self.metrics['renders'] += len(rendered)
+                self.render_seconds += elapsed
+        return [mark_safe(fragments[key]) for key in keys]
+
+    def store(self, fragments):
+        with self.lock:
+            for key, html in fragments.items():
+                self.entries[key] = html
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.metrics[key] += amount
+
+    def stats(self):
+        with self.lock:
+            hits = self.metrics['local_hits'] + self.metrics['shared_hits']
+            lookups = hits + self.metrics['renders']
+            average = self.render_seconds / self.metrics['renders'] if self.metrics['renders'] else 0.0
+            return {
+                'local_hits': self.metrics['local_hits'],
+                'shared_hits': self.metrics['shared_hits'],
+                'renders': self.metrics['renders'],
+                'entries': len(self.entries),
+                'hit_rate': round(hits / lookups, 4) if lookups else None,
+                'render_ms': round(self.render_seconds * 1000, 1),
+                'saved_ms': round(hits * average * 1000, 1),
+            }
+
+
+_fragments = None
+
+
+def get_fragments():
+    global _fragments
+    if _fragments is None:
+        _fragments = FragmentCache(**getattr(settings, 'CHAT_FRAGMENTS', {}))
+    return _fragments
+
+
+def render_messages(messages):
+    return get_fragments().render(list(messages))
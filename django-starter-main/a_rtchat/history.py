@@ -0,0 +1,93 @@
+"""
+Keyset pagination over a room's messages.
+
+Pages are ordered by (created, id) descending and a cursor encodes the
+position of the last message on a page, so fetching any page is an index
+range scan on groupmessage_history_idx however deep in the history it is.
+"""
+import base64
+from datetime import datetime
+from django.db.models import Subquery
+from .models import *
+from .retention import archived_messages
+
+PAGE_SIZE = 30
+# messages a reconnecting socket gets as a delta, more and it gets the latest page
+RESUME_LIMIT = 100
+
+
+def encode_cursor(message):
+    raw = f'{message.created.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ Returns (created, id), raises ValueError for anything malformed. """
+    created, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created), int(message_id)
+
+
+def history_page(chat_group, before=None, limit=PAGE_SIZE):
+    """
+    Up to ``limit`` messages older than the ``before`` cursor, newest
+    first, and the cursor for the next page or None on the last one.
+    """
+    chat_messages = (
+        GroupMessage.objects
+        .filter(group=chat_group)
+        .select_related('author__profile')
+        .order_by('-created', '-id')
+    )
+    if before:
+        created, message_id = decode_cursor(before)
+        chat_messages = chat_messages.filter(created__lte=created).exclude(created=created, id__gte=message_id)
+    
+    page = list(chat_messages[:limit + 1])
+    if len(page) <= limit:
+        # older messages may have moved to the archive, see a_rtchat.retention
+        position = (page[-1].created, page[-1].id) if page else decode_cursor(before) if before else None
+        page += archived_messages(chat_group, position, limit + 1 - len(page))
+    if len(page) > limit:
+        page = page[:limit]
+        return page, encode_cursor(page[-1])
+    return page, None
+
+
+def messages_after(chat_group, message_id, limit=RESUME_LIMIT):
+    """
+    The messages after ``message_id`` in the room, newest first, in one
+    query from the message's position on groupmessage_history_idx. None
+    if the message isn't in the room's live history or more than
+    ``limit`` came after it.
+    """
+    created = Subquery(GroupMessage.objects.filter(id=message_id, group=chat_group).values('created'))
+    chat_messages = list(
+        GroupMessage.objects
+        .filter(group=chat_group, created__gte=created)
+        .exclude(created=created, id__lt=message_id)
+        .select_related('author__profile')
+        .order_by('created', 'id')[:limit + 2]
+    )
+    # the message itself comes first, if it's there
+    if not chat_messages or chat_messages[0].id != message_id or len(chat_messages) > limit + 1:
+        return None
+    return chat_messages[:0:-1]
+
+
+def message_json(message):
+    return {
+        'id': message.id,
+        'author_id': message.author_id,
+        'author': message.author.username,
+        'author_name': message.author.profile.name,
+        'author_avatar': message.author.profile.avatar,
+        'body': message.body,
+        'file': message.file.url if message.file else None,
+        'filename': message.filename,
+        'is_image': message.is_image,
+        'file_mime': message.file_mime,
+        'file_size': message.file_size,
+        'file_width': message.file_width,
+        'file_height': message.file_height,
+        'created': message.created.isoformat(),
+    }
@@ -0,0 +1,36 @@
+"""
+Image resizing run inside the derivative worker processes. Kept free of
+Django imports so spawned workers start quickly and never touch the ORM.
+"""
+import io
+from PIL import Image, ImageOps
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def render_variants(data, widths, formats):
+    """
+    Resize the image in ``data`` to each width narrower than the original.
+    Returns {(format, width): bytes}.
+    """
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    variants = {}
+    for width in widths:
+        if width >= image.width:
+            continue
+        height = round(image.height * width / image.width)
+        resized = image.resize((width, height), Image.LANCZOS)
+        for format in formats:
+            pil_format, options = FORMATS[format]
+            output = resized.convert('RGB') if pil_format == 'JPEG' else resized
+            buffer = io.BytesIO()
+            output.save(buffer, pil_format, **options)
+            variants[(format, width)] = buffer.getvalue()
+    return variants
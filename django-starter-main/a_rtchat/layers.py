@@ -0,0 +1,211 @@
+"""
+A channel layer on Redis pub/sub, sharded over several hosts.
+
+Each room's group lives on one host, picked by a consistent hash ring,
+so adding a host only moves the rooms that land on its new points. A
+group_send is a single PUBLISH to that host. Every process with a
+consumer in the group is subscribed there, and it hands the message to
+its own consumers. Consumer channels belong to their process: a send
+to one goes to the process inbox on the host its id hashes to, or
+straight onto the local queue when it's in the same process.
+
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'a_rtchat.layers.ShardedChannelLayer',
+            'CONFIG': {
+                'hosts': ['redis://127.0.0.1:7001', 'redis://127.0.0.1:7002'],
+            },
+        },
+    }
+
+This layer runs chat_bench_cluster against local chat_broker processes
+and isn't meant for production: its connections (see a_rtchat.resp)
+don't reconnect, time out, authenticate or use TLS. Deployments shard
+with channels_redis' RedisPubSubChannelLayer, which works the same way.
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import uuid
+import weakref
+from collections import defaultdict
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from .resp import RespConnection, Subscription
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self.points = sorted(
+            (self.hash(f'{node}#{i}'), index)
+            for index, node in enumerate(self.nodes)
+            for i in range(replicas)
+        )
+        self.keys = [point for point, index in self.points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def index(self, key):
+        """ The node index for ``key``, the first point clockwise from its hash. """
+        position = bisect.bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.points[position][1]
+
+
+class Shard:
+    """ The connections one event loop holds to one host. """
+    def __init__(self, url, on_message):
+        self.publisher = RespConnection(url)
+        self.subscription = Subscription(url, on_message)
+        self.topics = set()
+        self.connected = None
+
+    async def connect(self):
+        if self.connected is None:
+            self.connected = asyncio.ensure_future(self._connect())
+        await self.connected
+
+    async def _connect(self):
+        await self.publisher.connect()
+        await self.subscription.connect()
+
+    async def close(self):
+        await self.publisher.close()
+        await self.subscription.close()
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, hosts=None, prefix='asgi', capacity=100, replicas=100, **kwargs):
+        super().__init__(capacity=capacity, **kwargs)
+        self.hosts = hosts or ['redis://localhost:6379']
+        self.prefix = prefix
+        self.ring = HashRing(self.hosts, replicas)
+        self.client_id = uuid.uuid4().hex
+        self.channels = {}
+        self.groups = defaultdict(set)
+        # connections are tied to the event loop that opened them
+        self.loops = weakref.WeakKeyDictionary()
+        self.metrics = defaultdict(int)
+
+    # topics and shards
+
+    def inbox_topic(self, client_id):
+        return f'{self.prefix}:inbox:{client_id}'
+
+    def group_topic(self, group):
+        return f'{self.prefix}:group:{group}'
+
+    async def shard(self, key):
+        loop = asyncio.get_running_loop()
+        shards = self.loops.get(loop)
+        if shards is None:
+            shards = self.loops[loop] = [Shard(host, self.on_message) for host in self.hosts]
+        shard = shards[self.ring.index(key)]
+        await shard.connect()
+        return shard
+
+    async def subscribe(self, key, topic):
+        shard = await self.shard(key)
+        if topic not in shard.topics:
+            shard.topics.add(topic)
+            shard.subscription.subscribe(topic)
+
+    async def unsubscribe(self, key, topic):
+        shard = await self.shard(key)
+        if topic in shard.topics:
+            shard.topics.discard(topic)
+            shard.subscription.unsubscribe(topic)
+
+    async def publish(self, key, topic, message):
+        shard = await self.shard(key)
+        self.metrics['published'] += 1
+        await shard.publisher.execute('PUBLISH', topic, json.dumps(message))
+
+    def on_message(self, topic, payload):
+        message = json.loads(payload)
+        channel = message.pop('__channel__', None)
+        if channel is not None:
+            self.deliver(channel, message)
+            return
+        group = message.pop('__group__')
+        for channel in list(self.groups.get(group, ())):
+            self.deliver(channel, dict(message))
+
+    def deliver(self, channel, message):
+        queue = self.channels.get(channel)
+        if queue is None:
+            return
+        if queue.qsize() >= self.get_capacity(channel):
+            # like other layers, a full channel loses group messages
+            self.metrics['dropped'] += 1
+            return
+        self.metrics['delivered'] += 1
+        queue.put_nowait(message)
+
+    # channel layer API
+
+    async def new_channel(self, prefix='specific'):
+        channel = f'{prefix}.{self.client_id}!{uuid.uuid4().hex}'
+        self.channels[channel] = asyncio.Queue()
+        await self.subscribe(self.client_id, self.inbox_topic(self.client_id))
+        return channel
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        if channel in self.channels:
+            if self.channels[channel].qsize() >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+            self.channels[channel].put_nowait(message)
+            return
+        if '!' not in channel:
+            raise ValueError('Only channels made by new_channel can be sent to')
+        client_id = channel.split('!')[0].rsplit('.', 1)[-1]
+        await self.publish(client_id, self.inbox_topic(client_id), {**message, '__channel__': channel})
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        if channel not in self.channels:
+            raise ValueError('Only channels made by new_channel can be received from')
+        try:
+            return await self.channels[channel].get()
+        except asyncio.CancelledError:
+            # the consumer has stopped listening for good
+            self.channels.pop(channel, None)
+            raise
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self.groups[group].add(channel)
+        await self.subscribe(group, self.group_topic(group))
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if not members:
+            del self.groups[group]
+            await self.unsubscribe(group, self.group_topic(group))
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), 'Group name not valid'
+        await self.publish(group, self.group_topic(group), {**message, '__group__': group})
+
+    async def flush(self):
+        self.channels.clear()
+        self.groups.clear()
+        for loop, shards in list(self.loops.items()):
+            for shard in shards:
+                await shard.close()
+        self.loops.clear()
+
+    async def close(self):
+        await self.flush()
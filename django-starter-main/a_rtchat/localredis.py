@@ -0,0 +1,114 @@
+"""
+A small in-process stand-in for the parts of the redis-py client the chat
+uses. It lets the Redis-backed services run in development and in the
+benchmark commands without a Redis server. Values come back as str, like
+a client created with decode_responses=True.
+"""
+import threading
+import time
+
+
+class LocalRedis:
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.RLock()
+
+    # strings
+
+    def get(self, name):
+        with self.lock:
+            if name in self.expires and self.expires[name] <= time.monotonic():
+                del self.expires[name]
+                self.data.pop(name, None)
+            return self.data.get(name)
+
+    def mget(self, keys):
+        with self.lock:
+            return [self.get(key) for key in keys]
+
+    def set(self, name, value, ex=None):
+        with self.lock:
+            self.data[name] = str(value)
+            if ex is None:
+                self.expires.pop(name, None)
+            else:
+                self.expires[name] = time.monotonic() + ex
+            return True
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            value = int(self.get(name) or 0) + amount
+            self.data[name] = str(value)
+            return value
+
+    # hashes
+
+    def hincrby(self, name, key, amount=1):
+        with self.lock:
+            hash = self.data.setdefault(name, {})
+            value = int(hash.get(str(key), 0)) + amount
+            hash[str(key)] = str(value)
+            return value
+
+    def hsetnx(self, name, key, value):
+        with self.lock:
+            hash = self.data.setdefault(name, {})
+            if str(key) in hash:
+                return 0
+            hash[str(key)] = str(value)
+            return 1
+
+    def hdel(self, name, *keys):
+        with self.lock:
+            hash = self.data.get(name, {})
+            removed = sum(1 for key in keys if hash.pop(str(key), None) is not None)
+            if not hash:
+                self.data.pop(name, None)
+            return removed
+
+    def hexists(self, name, key):
+        with self.lock:
+            return str(key) in self.data.get(name, {})
+
+    def hlen(self, name):
+        with self.lock:
+            return len(self.data.get(name, {}))
+
+    def hkeys(self, name):
+        with self.lock:
+            return list(self.data.get(name, {}))
+
+    # sorted sets
+
+    def zadd(self, name, mapping, xx=False, ch=False):
+        with self.lock:
+            zset = self.data.setdefault(name, {})
+            added = changed = 0
+            for member, score in mapping.items():
+                if member not in zset:
+                    if xx:
+                        continue
+                    added += 1
+                elif zset[member] != float(score):
+                    changed += 1
+                zset[member] = float(score)
+            return added + changed if ch else added
+
+    def zrem(self, name, *members):
+        with self.lock:
+            zset = self.data.get(name, {})
+            return sum(1 for member in members if zset.pop(member, None) is not None)
+
+    def zrangebyscore(self, name, min, max):
+        with self.lock:
+            zset = self.data.get(name, {})
+            low = float(min)
+            high = float(max)
+            return [member for member, score in sorted(zset.items(), key=lambda item: item[1]) if low <= score <= high]
+
+    def delete(self, *names):
+        with self.lock:
+            for name in names:
+                self.expires.pop(name, None)
+            return sum(1 for name in names if self.data.pop(name, None) is not None)
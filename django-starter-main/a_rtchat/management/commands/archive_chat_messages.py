@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from a_rtchat.retention import *
+
+
+class Command(BaseCommand):
+    help = 'Move messages older than their room\'s retention into the compressed archive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH, help='messages per archive row and transaction')
+
+    def handle(self, *args, **options):
+        moved = archive_due(batch_size=options['batch_size'])
+        for group_name, count in moved.items():
+            self.stdout.write(f'{group_name}: {count}')
+        self.stdout.write(self.style.SUCCESS(f'Archived {sum(moved.values())} messages from {len(moved)} rooms'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from a_rtchat.models import *
+
+
+class Command(BaseCommand):
+    help = 'Read each file message once and store its image flag, MIME type, size and dimensions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        fields = ['is_image', 'file_mime', 'file_size', 'file_width', 'file_height']
+        pending = GroupMessage.objects.exclude(file='').filter(file__isnull=False, file_size__isnull=True).order_by('id')
+        last_id = 0
+        done = failed = 0
+        while True:
+            batch = list(pending.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            updated = []
+            for message in batch:
+                try:
+                    message.read_file_metadata()
+                except OSError as error:
+                    failed += 1
+                    self.stderr.write(f'message {message.id}: {error}')
+                    continue
+                finally:
+                    message.file.close()
+                updated.append(message)
+            GroupMessage.objects.bulk_update(updated, fields)
+            done += len(updated)
+            self.stdout.write(f'{done} messages updated')
+        self.stdout.write(self.style.SUCCESS(f'Done, {done} updated, {failed} failed'))
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from a_rtchat.bench import *
+
+STAMP = re.compile(r'bench (\d+) ')
+
+
+class Command(BaseCommand):
+    help = (
+        'Start broker shards and Daphne workers as separate processes, connect '
+        'simulated clients to ws/chatroom/<name> and ws/online-status/ across the '
+        'workers, and report message latency percentiles and throughput.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--shards', type=int, default=1)
+        parser.add_argument('--rooms', type=int, default=50)
+        parser.add_argument('--clients', type=int, default=2000, help='chatroom sockets across all rooms')
+        parser.add_argument('--users', type=int, default=500, help='each also opens an online-status socket')
+        parser.add_argument('--rate', type=float, default=1, help='messages per second per room')
+        parser.add_argument('--duration', type=float, default=20)
+        parser.add_argument('--base-port', type=int, default=8100)
+        parser.add_argument('--broker-port', type=int, default=6400)
+        parser.add_argument('--hosts', nargs='*', help='use these Redis hosts instead of starting brokers')
+        parser.add_argument('--deflate', action='store_true', help='offer permessage-deflate on every socket')
+
+    def handle(self, *args, **options):
+        cleanup()
+        users = seed_users(options['users'])
+        rooms = seed_rooms(options['rooms'])
+        # members are the users whose sockets open in the room
+        for i in range(options['clients']):
+            rooms[i % len(rooms)].members.add(users[i % len(users)])
+        cookies = self.sessions(users)
+        processes = []
+        try:
+            hosts = options['hosts']
+            if not hosts:
+                hosts = []
+                for i in range(options['shards']):
+                    port = options['broker_port'] + i
+                    processes.append(self.start([sys.executable, 'manage.py', 'chat_broker', '--port', str(port)]))
+                    hosts.append(f'redis://127.0.0.1:{port}')
+                    wait_for_port(port)
+            layers = {'default': {
+                'BACKEND': 'a_rtchat.layers.ShardedChannelLayer',
+                'CONFIG': {'hosts': hosts},
+            }}
+            ports = [options['base_port'] + i for i in range(options['workers'])]
+            workers = []
+            for port in ports:
+                workers.append(self.start(
+                    [sys.executable, '-m', 'daphne', '-e', f'tcp:port={port}:interface=127.0.0.1:backlog=4096', 'a_rtchat.bench_asgi:application'],
+                    CHAT_BENCH_CHANNEL_LAYERS=json.dumps(layers),
+                ))
+            processes += workers
+            for port in ports:
+                wait_for_port(port)
+
+            result = asyncio.run(self.run(ports, workers, rooms, users, cookies, options))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+            cleanup()
+        self.report(result, hosts, options)
+
+    def start(self, command, **env):
+        return subprocess.Popen(
+            command, cwd=settings.BASE_DIR, env={**os.environ, **env},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+    def sessions(self, users):
+        cookies = {}
+        for user in users:
+            client = Client()
+            client.force_login(user)
+            cookies[user.id] = {settings.SESSION_COOKIE_NAME: client.cookies[settings.SESSION_COOKIE_NAME].value}
+        return cookies
+
+    async def run(self, ports, workers, rooms, users, cookies, options):
+        semaphore = asyncio.Semaphore(100)
+        latencies = []
+        counts = {'status': 0, 'raw': 0}
+        readers = []
+
+        async def connect(index, path, user, read):
+            async with semaphore:
+                ws = await WebsocketClient.connect(
+                    '127.0.0.1', ports[index % len(ports)], path, cookies[user.id], deflate=options['deflate'],
+                )
+            # read from the start, a client that stops reading stalls the server
+            readers.append(asyncio.create_task(read(ws)))
+            return ws
+
+        with Timer() as connecting:
+            status_sockets = await asyncio.gather(*[
+                connect(i, '/ws/online-status/', user, lambda ws: self.read_status(ws, counts))
+                for i, user in enumerate(users)
+            ], return_exceptions=True)
+            room_sockets = await asyncio.gather(*[
+                connect(i, f'/ws/chatroom/{rooms[i % len(rooms)].group_name}', users[i % len(users)],
+                    lambda ws: self.read_room(ws, latencies, counts))
+                for i in range(options['clients'])
+            ], return_exceptions=True)
+        failed = sum(isinstance(ws, Exception) for ws in status_sockets + room_sockets)
+        if failed > len(status_sockets + room_sockets) // 10:
+            raise CommandError(f'{failed} sockets could not connect')
+        # let the join broadcasts drain before timing anything, many of
+        # them end without sending a frame so watch the workers instead
+        with Timer() as settling:
+            await wait_idle(workers)
+        counts['status'] = counts['raw'] = 0
+        sockets = [ws for ws in status_sockets + room_sockets if not isinstance(ws, Exception)]
+        wire_before = sum(ws.wire_bytes for ws in sockets)
+
+        # the first connected socket of each room sends
+        senders = {}
+        for i, ws in enumerate(room_sockets):
+            if not isinstance(ws, Exception):
+                senders.setdefault(i % len(rooms), ws)
+        connected = Counter(i % len(rooms) for i, ws in enumerate(room_sockets) if not isinstance(ws, Exception))
+        cpu_before = cpu_seconds(workers)
+        with Timer() as sending:
+            sent = await asyncio.gather(*[
+                self.send(ws, options['rate'], options['duration']) for ws in senders.values()
+            ])
+            await wait_idle(workers)
+
+        cpu = cpu_seconds(workers) - cpu_before
+        wire = sum(ws.wire_bytes for ws in sockets) - wire_before
+        for task in readers:
+            task.cancel()
+        for ws in status_sockets + room_sockets:
+            if not isinstance(ws, Exception):
+                ws.close()
+        return {
+            'connect': connecting.elapsed,
+            'settle': settling.elapsed,
+            'sockets': len(room_sockets) + len(status_sockets),
+            'failed': failed,
+            'elapsed': sending.elapsed,
+            'sent': sum(sent),
+            'expected': sum(count * connected[room] for room, count in zip(senders, sent)),
+            'latencies': latencies,
+            'status': counts['status'],
+            'cpu': cpu,
+            'raw': counts['raw'],
+            'wire': wire,
+        }
+
+    async def send(self, ws, rate, duration):
+        # spread the rooms over the interval instead of sending in bursts
+        await asyncio.sleep(random.random() / rate)
+        sent = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            ws.send(json.dumps({'body': f'bench {time.perf_counter_ns()} '}))
+            sent += 1
+            await asyncio.sleep(1 / rate)
+        return sent
+
+    async def read_room(self, ws, latencies, counts):
+        while True:
+            frame = await ws.receive()
+            if frame is None:
+                return
+            counts['raw'] += len(frame.encode())
+            match = STAMP.search(frame)
+            if match:
+                latencies.append((time.perf_counter_ns() - int(match.group(1))) / 1e6)
+
+    async def read_status(self, ws, counts):
+        while True:
+            frame = await ws.receive()
+            if frame is None:
+                return
+            counts['status'] += 1
+            counts['raw'] += len(frame.encode())
+
+    def report(self, result, hosts, options):
+        latencies = result['latencies']
+        self.stdout.write(f"workers x shards  {options['workers']} x {len(hosts)}")
+        self.stdout.write(f"sockets           {result['sockets']} ({options['clients']} chatroom, {options['users']} online-status)")
+        self.stdout.write(f"connect time      {result['connect']:.2f}s, {result['failed']} failed")
+        self.stdout.write(f"settle time       {result['settle']:.2f}s")
+        self.stdout.write(f"messages sent     {result['sent']} in {result['elapsed']:.2f}s")
+        self.stdout.write(f"deliveries        {len(latencies)} of {result['expected']}")
+        self.stdout.write(f"deliveries/sec    {len(latencies) / result['elapsed']:.1f}")
+        self.stdout.write(f"status frames     {result['status']}")
+        self.stdout.write(f"bytes received    {result['raw']} raw, {result['wire']} on the wire ({result['wire'] / max(result['raw'], 1):.2f})")
+        self.stdout.write(f"worker cpu        {result['cpu']:.2f}s, {result['cpu'] * 1000 / max(len(latencies), 1):.2f} ms per delivery")
+        for pct in (50, 90, 99):
+            self.stdout.write(f"latency p{pct:<2}       {percentile(latencies, pct):.1f} ms")
+        self.stdout.write(f"latency max       {max(latencies, default=0):.1f} ms")
+        if len(latencies) < result['expected']:
+            self.stdout.write(self.style.WARNING(f"missing deliveries {result['expected'] - len(latencies)}"))
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError(f'Nothing is listening on port {port}')
+
+
+def cpu_seconds(processes):
+    """ User and system time the processes have used so far, from /proc. """
+    total = 0
+    for process in processes:
+        try:
+            with open(f'/proc/{process.pid}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return total
+
+
+async def wait_idle(workers, timeout=120):
+    """ Wait until the workers use under a fifth of a core each. """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        before = cpu_seconds(workers)
+        await asyncio.sleep(1)
+        if cpu_seconds(workers) - before < 0.2 * len(workers):
+            return
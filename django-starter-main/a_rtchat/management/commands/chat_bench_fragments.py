@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from a_rtchat.bench import *
+from a_rtchat.fragments import FragmentCache
+from a_rtchat.history import *
+from a_rtchat import fragments
+
+
+class Command(BaseCommand):
+    help = (
+        'Time rendering history pages with the message fragment cache cold and '
+        'warm, and after one author changes their display name.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=20, help='history pages of the room to render')
+        parser.add_argument('--authors', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        cleanup()
+        authors = seed_users(options['authors'])
+        saved = fragments._fragments
+        try:
+            room, = seed_rooms(1)
+            seed_messages(room, authors, options['pages'] * PAGE_SIZE)
+            pages = self.load_pages(room, options['pages'])
+
+            fragments._fragments = FragmentCache()
+            cold = self.render(room, pages)
+            warm = min(self.render(room, pages) for _ in range(options['repeat']))
+            stats = fragments._fragments.stats()
+            self.stdout.write(f'{len(pages)} pages of {PAGE_SIZE} messages from {len(authors)} authors')
+            self.stdout.write(f'cold {cold:.1f} ms, warm {warm:.1f} ms, {cold / warm:.1f}x')
+
+            profile = authors[0].profile
+            profile.displayname = 'renamed'
+            profile.save()
+            renders = stats['renders']
+            renamed = self.render(room, self.load_pages(room, options['pages']))
+            stats = fragments._fragments.stats()
+            self.stdout.write(
+                f"after a rename {renamed:.1f} ms, {stats['renders'] - renders} fragments rendered again"
+            )
+            self.stdout.write(f'{stats}')
+        finally:
+            fragments._fragments = saved
+            cleanup()
+
+    def load_pages(self, room, count):
+        pages = []
+        cursor = None
+        for _ in range(count):
+            page, cursor = history_page(room, before=cursor)
+            pages.append((page, cursor))
+            if not cursor:
+                break
+        return pages
+
+    def render(self, room, pages):
+        with Timer() as timer:
+            for page, cursor in pages:
+                render_to_string('a_rtchat/partials/chat_history.html', {
+                    'chat_messages': page,
+                    'next_cursor': cursor,
+                    'chat_group': room,
+                })
+        return timer.elapsed * 1000
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from a_rtchat.bench import *
+from a_rtchat.history import *
+
+
+class Command(BaseCommand):
+    help = (
+        'Time history page fetches at several depths in rooms of growing size, '
+        'keyset cursor against OFFSET pagination.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        cleanup()
+        authors = seed_users(5)
+        try:
+            self.stdout.write(f"{'messages':>10} {'depth':>10} {'keyset ms':>10} {'offset ms':>10}")
+            for size in options['sizes']:
+                room, = seed_rooms(1)
+                seed_messages(room, authors, size)
+                for depth in (0, size // 2, size - PAGE_SIZE):
+                    keyset, offset = self.measure(room, depth, options['repeat'])
+                    self.stdout.write(f'{size:>10} {depth:>10} {keyset:>10.2f} {offset:>10.2f}')
+                room.delete()
+        finally:
+            cleanup()
+
+    def measure(self, room, depth, repeat):
+        cursor = None
+        if depth:
+            cursor = encode_cursor(room.chat_messages.order_by('-created', '-id')[depth - 1])
+
+        with Timer() as keyset:
+            for _ in range(repeat):
+                history_page(room, before=cursor)
+        with Timer() as offset:
+            for _ in range(repeat):
+                list(room.chat_messages.select_related('author__profile').order_by('-created', '-id')[depth:depth + PAGE_SIZE])
+        return keyset.elapsed / repeat * 1000, offset.elapsed / repeat * 1000
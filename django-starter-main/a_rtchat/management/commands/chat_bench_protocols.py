@@ -0,0 +1,168 @@
+import asyncio
+import json
+import time
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from a_rtchat import routing
+from a_rtchat.bench import *
+from a_rtchat.broadcast import message_event
+from a_rtchat.history import message_json
+from a_rtchat.protocols import *
+
+# how an html fragment is recognised, by the first id it swaps
+FRAGMENTS = (
+    ('chats-list', 'status'),
+    ('chat_messages', 'message'),
+    ('online-count', 'presence'),
+    ('online-user-count', 'online_users'),
+    ('chat-status-', 'chat_status'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the same room traffic over the html fragment protocol and the '
+        'compact ones, and report bytes per event by type and server CPU per '
+        'delivered event.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='each with a chatroom and an online-status socket')
+        parser.add_argument('--messages', type=int, default=100)
+        parser.add_argument('--churn', type=int, default=10, help='room sockets that leave and come back')
+
+    def handle(self, *args, **options):
+        application = URLRouter(routing.websocket_urlpatterns)
+        protocols = [None] + supported()
+        disable_rate_limit()
+        cleanup()
+        try:
+            users = seed_users(options['users'])
+            room, = seed_rooms(1, members=users)
+            room.groupchat_name = 'bench'
+            room.save()
+            results = {
+                protocol: asyncio.run(self.run(application, protocol, room, users, options))
+                for protocol in protocols
+            }
+        finally:
+            cleanup()
+
+        names = [protocol or 'html' for protocol in protocols]
+        self.stdout.write(f"{'bytes per event':<18}" + ''.join(f'{name:>14}' for name in names))
+        kinds = sorted({kind for result in results.values() for kind in result['bytes']})
+        for kind in kinds:
+            row = ''
+            for protocol in protocols:
+                sizes = results[protocol]['bytes'].get(kind, [])
+                row += f'{sum(sizes) / len(sizes):>14.0f}' if sizes else f"{'-':>14}"
+            self.stdout.write(f'{kind:<18}' + row)
+        for label, key in (('events', 'events'), ('total bytes', 'total')):
+            self.stdout.write(f'{label:<18}' + ''.join(f'{results[protocol][key]:>14}' for protocol in protocols))
+        self.stdout.write(f"{'cpu us per event':<18}" + ''.join(
+            f"{results[protocol]['cpu'] * 1e6 / max(results[protocol]['events'], 1):>14.0f}" for protocol in protocols
+        ))
+        self.stdout.write(
+            f"building one message event: html {results[None]['render_html'] * 1e6:.0f} us, "
+            f"compact data {results[None]['render_data'] * 1e6:.0f} us"
+        )
+
+    async def run(self, application, protocol, room, users, options):
+        frames = defaultdict(list)
+        readers = []
+        subprotocols = [protocol] if protocol else None
+
+        async def open_socket(path, user):
+            communicator = WebsocketCommunicator(application, path, subprotocols=subprotocols)
+            communicator.scope['user'] = user
+            connected, accepted = await communicator.connect()
+            assert connected and accepted == protocol, f'{path} did not speak {protocol}'
+            readers.append(asyncio.create_task(self.read(communicator, frames)))
+            return communicator
+
+        status_sockets = [await open_socket('/ws/online-status/', user) for user in users]
+        room_sockets = [await open_socket(f'/ws/chatroom/{room.group_name}', user) for user in users]
+        await self.settle(frames)
+        frames.clear()
+
+        start = time.process_time()
+        for i in range(options['messages']):
+            await self.send(room_sockets[i % len(room_sockets)], protocol, f'bench message {i}')
+            await asyncio.sleep(0)
+        for i in range(options['churn']):
+            for sockets, path in ((room_sockets, f'/ws/chatroom/{room.group_name}'), (status_sockets, '/ws/online-status/')):
+                await sockets[i].disconnect()
+                await self.settle(frames, 0.3)
+                sockets[i] = await open_socket(path, users[i])
+                await self.settle(frames, 0.3)
+        await self.settle(frames)
+        cpu = time.process_time() - start
+
+        render_html, render_data = await database_sync_to_async(self.render_costs)(room)
+
+        for task in readers:
+            task.cancel()
+        for communicator in status_sockets + room_sockets:
+            await communicator.disconnect()
+        sizes = defaultdict(list)
+        for kind, size in frames['all']:
+            sizes[kind].append(size)
+        return {
+            'bytes': sizes,
+            'events': len(frames['all']),
+            'total': sum(size for kind, size in frames['all']),
+            'cpu': cpu,
+            'render_html': render_html,
+            'render_data': render_data,
+        }
+
+    def render_costs(self, room, repeat=200):
+        """ What the sending side spends on each half of a message event. """
+        message = room.chat_messages.select_related('author__profile', 'group').first()
+        with Timer() as html:
+            for _ in range(repeat):
+                message_event(message, set())
+        with Timer() as data:
+            for _ in range(repeat):
+                {'t': 'message', 'message': message_json(message)}
+        # message_event builds the data too
+        return (html.elapsed - data.elapsed) / repeat, data.elapsed / repeat
+
+    async def send(self, communicator, protocol, body):
+        if protocol == MSGPACK:
+            await communicator.send_to(bytes_data=encode(protocol, {'body': body})['bytes_data'])
+        else:
+            await communicator.send_to(text_data=json.dumps({'body': body}))
+
+    async def read(self, communicator, frames):
+        while True:
+            output = await communicator.output_queue.get()
+            if output['type'] != 'websocket.send':
+                continue
+            if output.get('bytes') is not None:
+                data = output['bytes']
+                kind = msgpack.unpackb(data)['t']
+            else:
+                data = output['text'].encode()
+                kind = kind_of(output['text'])
+            frames['all'].append((kind, len(data)))
+
+    async def settle(self, frames, quiet=0.5):
+        """ Wait until no frame has arrived for ``quiet`` seconds. """
+        while True:
+            count = len(frames['all'])
+            await asyncio.sleep(quiet)
+            if len(frames['all']) == count:
+                return
+
+
+def kind_of(text):
+    if text.startswith('{'):
+        return json.loads(text)['t']
+    for marker, kind in FRAGMENTS:
+        if f'id="{marker}' in text:
+            return kind
+    return 'other'
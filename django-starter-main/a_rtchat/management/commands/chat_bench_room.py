@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from a_rtchat.bench import *
+from a_rtchat.querycount import count_queries
+
+
+class Command(BaseCommand):
+    help = 'Open group chat rooms of growing size through chat_view and report queries and render time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[30, 100, 1_000])
+        parser.add_argument('--members', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        cleanup()
+        setup_test_environment()
+        try:
+            users = seed_users(options['members'])
+            client = Client()
+            client.force_login(users[0])
+            self.stdout.write(f"{'messages':>10} {'queries':>8} {'duplicates':>11} {'ms':>8}")
+            for size in options['sizes']:
+                room, = seed_rooms(1, members=users)
+                seed_messages(room, users, size)
+                url = reverse('chatroom', args=[room.group_name])
+                client.get(url)
+                with count_queries('chat_view') as scope:
+                    client.get(url)
+                with Timer() as timer:
+                    for _ in range(options['repeat']):
+                        client.get(url)
+                milliseconds = timer.elapsed / options['repeat'] * 1000
+                self.stdout.write(f'{size:>10} {scope.count:>8} {scope.duplicates:>11} {milliseconds:>8.2f}')
+                room.delete()
+        finally:
+            teardown_test_environment()
+            cleanup()
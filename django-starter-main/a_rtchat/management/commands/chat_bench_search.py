@@ -0,0 +1,89 @@
+import itertools
+import random
+from django.core.management.base import BaseCommand
+from django.db import connection
+from a_rtchat.bench import *
+from a_rtchat.search import *
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed rooms with messages drawn from a skewed vocabulary, then time '
+        'searches in one room and across all of a user\'s rooms, through the '
+        'full-text index and through a plain scan.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000)
+        parser.add_argument('--rooms', type=int, default=200)
+        parser.add_argument('--member-of', type=int, default=20, help='rooms the searching user is in')
+        parser.add_argument('--words', type=int, default=5_000, help='vocabulary size, word n is 1/n as common as the first')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--scan-repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        cleanup()
+        try:
+            user, rooms = self.seed(options)
+            self.measure(user, rooms[0], options)
+        finally:
+            cleanup()
+
+    def seed(self, options):
+        users = seed_users(20)
+        rooms = seed_rooms(options['rooms'])
+        for room in rooms[:options['member_of']]:
+            room.members.add(users[0])
+
+        vocabulary = [f'w{n:04d}' for n in range(options['words'])]
+        cum_weights = list(itertools.accumulate(1 / (n + 1) for n in range(options['words'])))
+        rng = random.Random(0)
+        body = lambda i: ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=8))
+        per_room = options['messages'] // len(rooms)
+        # the index is written by the database as the rows go in
+        with Timer() as seeding:
+            for room in rooms:
+                seed_messages(room, users, per_room, body=body)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.stdout.write(
+            f'seeded {per_room * len(rooms)} messages in {seeding.elapsed:.1f} s '
+            f'({per_room * len(rooms) / seeding.elapsed:.0f}/s, {connection.vendor} index)'
+        )
+        return users[0], rooms
+
+    def measure(self, user, room, options):
+        queries = [
+            ('common word', 'w0000'),
+            ('frequent word', 'w0020'),
+            ('rare word', 'w4000'),
+            ('two words', 'w0001 w0030'),
+            # the 100 most common words, and 10 rarer ones
+            ('short prefix', 'w00'),
+            ('prefix', 'w012'),
+        ]
+        scopes = [('room', room, [room.id]), ('my chats', None, readable_rooms(user))]
+        index, scan = get_search(), ScanSearch()
+        top = 2 ** 63 - 1
+
+        self.stdout.write(f"{'scope':<10}{'query':<15}{'hits':>6}{'index p50':>11}{'index p99':>11}{'page p50':>10}{'scan ms':>10}")
+        for scope, chat_group, room_ids in scopes:
+            for name, query in queries:
+                terms = query_terms(query)
+                index_times, page_times = [], []
+                for _ in range(options['repeat']):
+                    with Timer() as timer:
+                        rows = index.search(terms, room_ids, top, PAGE_SIZE + 1)
+                    index_times.append(timer.elapsed * 1000)
+                    # with the rows loaded and the snippets marked
+                    with Timer() as timer:
+                        search_messages(user, query, chat_group)
+                    page_times.append(timer.elapsed * 1000)
+                with Timer() as timer:
+                    for _ in range(options['scan_repeat']):
+                        scan.search(terms, room_ids, top, PAGE_SIZE + 1)
+                self.stdout.write(
+                    f'{scope:<10}{name:<15}{len(rows):>6}'
+                    f'{percentile(index_times, 50):>11.2f}{percentile(index_times, 99):>11.2f}'
+                    f'{percentile(page_times, 50):>10.2f}{timer.elapsed * 1000 / options["scan_repeat"]:>10.1f}'
+                )
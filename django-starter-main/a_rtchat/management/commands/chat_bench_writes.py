@@ -0,0 +1,127 @@
+import argparse
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from a_rtchat.bench import *
+from a_rtchat.writebehind import *
+
+
+class Command(BaseCommand):
+    help = (
+        'Save chat messages from concurrent senders one transaction each and '
+        'through the write-behind, report throughput and time to acknowledge, '
+        'then kill a writer process before it saves and check nothing it '
+        'acknowledged is lost.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--senders', type=int, default=8, help='threads, like the ones behind database_sync_to_async')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=float, default=0.05)
+        parser.add_argument('--no-fsync', action='store_true')
+        parser.add_argument('--crash-child', nargs=3, type=int, metavar=('ROOM', 'USER', 'COUNT'), help=argparse.SUPPRESS)
+        parser.add_argument('--journal')
+
+    def handle(self, *args, **options):
+        if options['crash_child']:
+            return self.crash_child(options)
+        cleanup()
+        try:
+            users = seed_users(options['senders'])
+            room, = seed_rooms(1, members=users)
+            self.stdout.write(f"{'mode':<22} {'msg/s':>9} {'transactions':>13} {'ack p50 ms':>11} {'ack p99 ms':>11}")
+
+            def create(user, body):
+                GroupMessage.objects.create(group=room, author=user, body=body)
+            elapsed, acks = self.run(users, create, options)
+            self.row('transaction each', options['messages'], elapsed, options['messages'], acks)
+
+            with tempfile.TemporaryDirectory() as journal:
+                writer = MessageWriter(
+                    journal, batch_size=options['batch_size'], interval=options['interval'],
+                    fsync=not options['no_fsync'],
+                )
+
+                def add(user, body):
+                    writer.add(GroupMessage(group=room, author=user, body=body))
+                elapsed, acks = self.run(users, add, options, writer)
+                stats = writer.stats()
+                transactions = stats['batches'] + stats['reservations']
+                self.row('write-behind', options['messages'], elapsed, transactions, acks)
+
+            saved = room.chat_messages.count()
+            if saved != options['messages'] * 2:
+                raise CommandError(f"{saved} of {options['messages'] * 2} messages were saved")
+            self.crash_check(room, users[0])
+        finally:
+            cleanup()
+
+    def run(self, users, save, options, writer=None):
+        """ Send from every thread at once, returns seconds until saved and each call's time. """
+        count = options['messages'] // len(users)
+        acks = []
+        barrier = threading.Barrier(len(users) + 1)
+
+        def send(user):
+            barrier.wait()
+            try:
+                for i in range(count):
+                    start = time.perf_counter()
+                    save(user, f'bench message {i}')
+                    acks.append((time.perf_counter() - start) * 1000)
+            finally:
+                close_old_connections()
+
+        threads = [threading.Thread(target=send, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        with Timer() as timer:
+            barrier.wait()
+            for thread in threads:
+                thread.join()
+            if writer is not None:
+                writer.close()
+        return timer.elapsed, acks
+
+    def row(self, mode, messages, elapsed, transactions, acks):
+        self.stdout.write(
+            f'{mode:<22} {messages / elapsed:>9.0f} {transactions:>13} '
+            f'{percentile(acks, 50):>11.2f} {percentile(acks, 99):>11.2f}'
+        )
+
+    def crash_check(self, room, user, count=500):
+        with tempfile.TemporaryDirectory() as journal:
+            child = subprocess.Popen(
+                [sys.executable, 'manage.py', 'chat_bench_writes', '--journal', journal,
+                    '--crash-child', str(room.id), str(user.id), str(count)],
+                cwd=settings.BASE_DIR, stdout=subprocess.PIPE, text=True,
+            )
+            acknowledged = [int(child.stdout.readline()) for _ in range(count)]
+            child.send_signal(signal.SIGKILL)
+            child.wait()
+            before = GroupMessage.objects.filter(id__in=acknowledged).count()
+            recovered = recover(journal)
+        saved = GroupMessage.objects.filter(id__in=acknowledged).count()
+        self.stdout.write(
+            f'killed a writer after {count} acknowledged messages: {before} were saved, '
+            f'{recovered} read back from its journal, {saved} saved now'
+        )
+        if saved != count:
+            raise CommandError(f'{count - saved} acknowledged messages were lost')
+
+    def crash_child(self, options):
+        # never flushes on its own, everything acknowledged is only in the journal
+        room, user, count = options['crash_child']
+        writer = MessageWriter(options['journal'], interval=3600, batch_size=count + 1)
+        for i in range(count):
+            message = writer.add(GroupMessage(group_id=room, author_id=user, body=f'crash message {i}'))
+            self.stdout.write(str(message.id))
+            self.stdout.flush()
+        time.sleep(3600)
@@ -0,0 +1,18 @@
+import asyncio
+from django.core.management.base import BaseCommand
+from a_rtchat.resp import PubSubBroker
+
+
+class Command(BaseCommand):
+    help = 'Run the pub/sub stand-in for Redis that ShardedChannelLayer uses in chat_bench_cluster.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=6379)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Pub/sub broker on {options['host']}:{options['port']}")
+        try:
+            asyncio.run(PubSubBroker().serve(options['host'], options['port']))
+        except KeyboardInterrupt:
+            pass
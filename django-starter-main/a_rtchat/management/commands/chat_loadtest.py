@@ -0,0 +1,171 @@
+import asyncio
+import json
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.shortcuts import get_object_or_404
+from django.template import Template, Context
+from django.urls import path
+from django.utils.module_loading import import_string
+from channels.generic.websocket import WebsocketConsumer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from a_rtchat.bench import *
+from a_rtchat.broadcast import online_count_coalescer
+
+BASELINE = 'a_rtchat.management.commands.chat_loadtest.SyncChatroomConsumer'
+
+# chat_message_p.html as it was, rendering chat_message.html for every socket
+BASELINE_MESSAGE = Template("""
+<div id="chat_messages" hx-swap-oob="beforeend">
+<div class="fade-in-up">
+{% include 'a_rtchat/chat_message.html' %}
+</div>
+<script>scrollToBottom()</script>
+</div>
+""")
+
+
+class SyncChatroomConsumer(WebsocketConsumer):
+    """
+    The synchronous ChatroomConsumer the async one replaced, kept as the
+    baseline: every delivery loads the message again and renders it for
+    its socket. Its users_online bookkeeping went with the field, so the
+    baseline is a little faster than the original was.
+    """
+    def connect(self):
+        self.user = self.scope['user']
+        self.chatroom_name = self.scope['url_route']['kwargs']['chatroom_name']
+        self.chatroom = get_object_or_404(ChatGroup, group_name=self.chatroom_name)
+        async_to_sync(self.channel_layer.group_add)(
+            self.chatroom_name, self.channel_name
+        )
+        self.accept()
+
+    def disconnect(self, close_code):
+        async_to_sync(self.channel_layer.group_discard)(
+            self.chatroom_name, self.channel_name
+        )
+
+    def receive(self, text_data):
+        body = json.loads(text_data)['body']
+        message = GroupMessage.objects.create(
+            body=body,
+            author=self.user,
+            group=self.chatroom
+        )
+        event = {
+            'type': 'message_handler',
+            'message_id': message.id,
+        }
+        async_to_sync(self.channel_layer.group_send)(
+            self.chatroom_name, event
+        )
+
+    def message_handler(self, event):
+        message = GroupMessage.objects.get(id=event['message_id'])
+        context = {
+            'message': message,
+            'user': self.user,
+            'chat_group': self.chatroom
+        }
+        self.send(text_data=BASELINE_MESSAGE.render(Context(context)))
+
+
+class Command(BaseCommand):
+    help = (
+        'Open sockets on ws/chatroom/<name> in this process and report how many '
+        'rooms and messages per second one worker handles, for the synchronous '
+        'baseline consumer and for --consumer.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=20)
+        parser.add_argument('--clients', type=int, default=10, help='sockets per room')
+        parser.add_argument('--messages', type=int, default=20, help='messages sent per room')
+        parser.add_argument('--consumer', default='a_rtchat.consumers.ChatroomConsumer')
+        parser.add_argument('--baseline', default=BASELINE, help='consumer to compare against')
+        parser.add_argument('--no-baseline', action='store_true', help='only run --consumer')
+        parser.add_argument('--timeout', type=float, default=30)
+
+    def handle(self, *args, **options):
+        disable_rate_limit()
+        consumers = [options['consumer']]
+        if not options['no_baseline']:
+            consumers.insert(0, options['baseline'])
+        results = [self.load(consumer, options) for consumer in consumers]
+
+        self.stdout.write(f"rooms x sockets   {options['rooms']} x {options['clients']} = {options['rooms'] * options['clients']}")
+        for consumer, result in zip(consumers, results):
+            self.stdout.write(f"\nconsumer          {consumer}")
+            self.stdout.write(f"connect time      {result['connect']:.2f}s")
+            self.stdout.write(f"messages sent     {result['sent']} in {result['elapsed']:.2f}s")
+            self.stdout.write(f"messages/sec      {result['sent'] / result['elapsed']:.1f}")
+            self.stdout.write(f"deliveries/sec    {result['delivered'] / result['elapsed']:.1f}")
+            if result['missing']:
+                self.stdout.write(self.style.WARNING(f"missing deliveries {result['missing']}"))
+        merged = sum(stats['merged'] for stats in online_count_coalescer.stats().values())
+        self.stdout.write(f"online counts     {merged} presence events merged")
+        if len(results) == 2:
+            baseline, result = results
+            self.stdout.write(f"\ndeliveries/sec    {(result['delivered'] / result['elapsed']) / (baseline['delivered'] / baseline['elapsed']):.1f}x the baseline")
+
+    def load(self, consumer, options):
+        application = URLRouter([
+            path("ws/chatroom/<chatroom_name>", import_string(consumer).as_asgi()),
+        ])
+        cleanup()
+        users = seed_users(options['clients'])
+        rooms = seed_rooms(options['rooms'], members=users)
+        try:
+            return asyncio.run(self.run(application, rooms, users, options))
+        finally:
+            cleanup()
+
+    async def run(self, application, rooms, users, options):
+        sockets = []
+        with Timer() as connect:
+            for room in rooms:
+                for user in users:
+                    communicator = WebsocketCommunicator(application, f'/ws/chatroom/{room.group_name}')
+                    communicator.scope['user'] = user
+                    sockets.append((room, communicator))
+            results = await asyncio.gather(*[communicator.connect() for room, communicator in sockets])
+        if not all(connected for connected, subprotocol in results):
+            raise RuntimeError('Not every socket could connect')
+
+        expected = options['messages']
+        with Timer() as timer:
+            senders = {}
+            for room, communicator in sockets:
+                senders.setdefault(room.id, communicator)
+            receivers = [
+                self.receive_messages(communicator, expected, options['timeout'])
+                for room, communicator in sockets
+            ]
+            sends = [self.send_messages(communicator, expected) for communicator in senders.values()]
+            received = (await asyncio.gather(*receivers, *sends))[:len(receivers)]
+
+        await asyncio.gather(*[communicator.disconnect() for room, communicator in sockets])
+        delivered = sum(received)
+        return {
+            'connect': connect.elapsed,
+            'elapsed': timer.elapsed,
+            'sent': expected * len(senders),
+            'delivered': delivered,
+            'missing': expected * len(sockets) - delivered,
+        }
+
+    async def send_messages(self, communicator, count):
+        for i in range(count):
+            await communicator.send_to(text_data=json.dumps({'body': f'load test {i}'}))
+
+    async def receive_messages(self, communicator, expected, timeout):
+        received = 0
+        while received < expected:
+            try:
+                frame = await communicator.receive_from(timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+            if 'chat_messages' in frame:
+                received += 1
+        return received
@@ -0,0 +1,113 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from a_rtchat.bench import *
+from a_rtchat.broadcast import *
+from a_rtchat.history import encode_cursor, messages_after
+from a_rtchat.queryplans import *
+from a_rtchat.roomcache import RoomContext
+from a_rtchat.search import PAGE_SIZE as SEARCH_PAGE_SIZE, ScanSearch, readable_rooms
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a large chat dataset, run every view and consumer query, EXPLAIN '
+        'each one and fail if any plan uses a sequential scan or a filesort. '
+        'Search is planned on this database\'s backend and on ScanSearch, the '
+        'fallback for databases without a full-text index.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=20_000, help='messages per room')
+        parser.add_argument('--users', type=int, default=2_000)
+        parser.add_argument('--rooms', type=int, default=1_000, help='extra group chats of a few members each')
+        parser.add_argument('--verbose-plans', action='store_true', help='print every plan, not only failures')
+
+    def handle(self, *args, **options):
+        cleanup()
+        try:
+            scenarios = self.seed(options)
+            failures = self.check_plans(scenarios, options['verbose_plans'])
+        finally:
+            cleanup()
+
+        if failures:
+            raise CommandError(f'{failures} queries scan a table or sort without an index')
+        self.stdout.write(self.style.SUCCESS('All query plans use indexes'))
+
+    def seed(self, options):
+        users = seed_users(options['users'])
+        user, other_user = users[0], users[1]
+        rooms = seed_rooms(options['rooms'] + 2)
+        public_room, group_room = rooms[:2]
+        ChatGroup.objects.filter(id=public_room.id).update(groupchat_name=None)
+        public_room.refresh_from_db()
+        group_room.members.add(*users[:20])
+        # spread memberships so the planner sees realistic selectivity
+        Membership = ChatGroup.members.through
+        Membership.objects.bulk_create([
+            Membership(chatgroup=room, user=users[(i * 7 + j) % len(users)])
+            for i, room in enumerate(rooms[2:])
+            for j in range(5)
+        ], ignore_conflicts=True)
+        private_room = seed_room(group_name=f'{RUN_PREFIX}private', is_private=True)
+        private_room.members.add(user, other_user)
+        for room in (public_room, group_room, private_room):
+            seed_messages(room, users, options['messages'])
+        with connection.cursor() as cursor:
+            if connection.vendor in ('sqlite', 'postgresql'):
+                cursor.execute('ANALYZE')
+
+        client = Client()
+        client.force_login(user)
+        message = public_room.chat_messages.first()
+        # a cursor past the live messages, the page reads on into the archive
+        oldest = public_room.chat_messages.order_by('created', 'id').first()
+        # a socket resuming 50 messages behind
+        last_seen = public_room.chat_messages.all()[50]
+        room_context = RoomContext.load(group_room.group_name)
+        search_url = reverse('chat-search')
+        room_search_url = reverse('chatroom-search', args=[public_room.group_name])
+        room_ids = readable_rooms(user)
+
+        return [
+            ('chat_view public', lambda: client.get(reverse('chatroom', args=[public_room.group_name]))),
+            ('chat_view group', lambda: client.get(reverse('chatroom', args=[group_room.group_name]))),
+            ('chat_view private', lambda: client.get(reverse('chatroom', args=[private_room.group_name]))),
+            ('chat_history_view', lambda: client.get(reverse('chatroom-history', args=[public_room.group_name]))),
+            ('chat_history_view json', lambda: client.get(reverse('chatroom-history', args=[public_room.group_name]), {'format': 'json'})),
+            ('chat_history_view archive', lambda: client.get(reverse('chatroom-history', args=[public_room.group_name]), {'before': encode_cursor(oldest)})),
+            ('messages_after', lambda: messages_after(public_room, last_seen.id)),
+            # 'message' is in every body, the most rows a search can match
+            ('chat_search_view', lambda: client.get(search_url, {'q': 'bench message'})),
+            ('chat_search_view prefix', lambda: client.get(search_url, {'q': 'mess'})),
+            ('chat_search_view rare', lambda: client.get(search_url, {'q': '12345'})),
+            ('chat_search_view next page', lambda: client.get(search_url, {'q': 'message', 'before': last_seen.id})),
+            ('chat_search_view room', lambda: client.get(room_search_url, {'q': 'message'})),
+            ('ScanSearch', lambda: ScanSearch().search(['message'], room_ids, 2 ** 63 - 1, SEARCH_PAGE_SIZE + 1)),
+            ('chat_presence_view', lambda: client.get(reverse('chat-presence'), {'room': [public_room.group_name, group_room.group_name]})),
+            ('get_or_create_chatroom', lambda: client.get(reverse('start-chat', args=[other_user.username]))),
+            ('chat_message_event', lambda: chat_message_event(message.id)),
+            ('RoomContext.load', lambda: RoomContext.load(group_room.group_name)),
+            ('online_count_event', lambda: online_count_event(room_context)),
+            ('online_status_html', lambda: online_status_html(user)),
+        ]
+
+    def check_plans(self, scenarios, verbose):
+        failures = 0
+        setup_test_environment()
+        try:
+            for name, sql, plan, problems in planned_queries(scenarios):
+                failures += len(problems)
+                if problems or verbose:
+                    style = self.style.ERROR if problems else self.style.SQL_TABLE
+                    self.stdout.write(style(f'[{name}] {sql[:200]}'))
+                    for line in format_plan(plan):
+                        self.stdout.write(f'    {line}')
+                    for problem in problems:
+                        self.stdout.write(self.style.ERROR(f'    !! {problem}'))
+        finally:
+            teardown_test_environment()
+        return failures
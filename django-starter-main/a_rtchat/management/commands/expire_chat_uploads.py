@@ -0,0 +1,14 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from a_rtchat.uploads import *
+
+
+class Command(BaseCommand):
+    help = 'Discard chunked uploads that were abandoned part way.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24)
+
+    def handle(self, *args, **options):
+        count = expire_uploads(timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(f'Discarded {count} uploads'))
@@ -0,0 +1,19 @@
+from concurrent.futures import wait
+from django.core.management.base import BaseCommand
+from a_users.models import Profile
+from a_rtchat.models import *
+from a_rtchat.derivatives import *
+
+
+class Command(BaseCommand):
+    help = 'Create resized variants for image messages and avatars that have none yet.'
+
+    def handle(self, *args, **options):
+        pipeline = get_pipeline()
+        futures = []
+        for message in GroupMessage.objects.filter(is_image=True, file_variants={}).only('id', 'file').iterator():
+            futures.append(pipeline.schedule(message, 'file', 'file_variants', CHAT_IMAGE_WIDTHS))
+        for profile in Profile.objects.exclude(image='').filter(image__isnull=False, image_variants={}).only('id', 'image').iterator():
+            futures.append(pipeline.schedule(profile, 'image', 'image_variants', AVATAR_WIDTHS))
+        wait(futures)
+        self.stdout.write(self.style.SUCCESS(f'Processed {len(futures)} images'))
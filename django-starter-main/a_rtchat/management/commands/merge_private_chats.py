@@ -0,0 +1,67 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+from a_rtchat.models import *
+from a_rtchat.retention import unarchive
+
+
+class Command(BaseCommand):
+    help = (
+        'Give every private chat its private_key and merge duplicate rooms of '
+        'the same pair of users into one, moving their messages, archives, '
+        'uploads and read cursors along.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        pairs = defaultdict(list)
+        skipped = 0
+        rooms = ChatGroup.objects.filter(is_private=True).prefetch_related('members').order_by('id')
+        for room in rooms.iterator(chunk_size=2000):
+            members = list(room.members.all())
+            if len(members) != 2:
+                skipped += 1
+                continue
+            pairs[ChatGroup.private_key_for(*members)].append(room)
+
+        merged = keyed = 0
+        for key, rooms in pairs.items():
+            # a room that already has the key wins, otherwise the oldest one
+            rooms.sort(key=lambda room: (room.private_key != key, room.id))
+            keeper, *duplicates = rooms
+            if not duplicates and keeper.private_key == key:
+                continue
+            merged += len(duplicates)
+            keyed += keeper.private_key != key
+            if options['dry_run']:
+                continue
+            with transaction.atomic():
+                if duplicates:
+                    self.merge(keeper, duplicates)
+                if keeper.private_key != key:
+                    ChatGroup.objects.filter(id=keeper.id).update(private_key=key)
+
+        prefix = 'Would merge' if options['dry_run'] else 'Merged'
+        self.stdout.write(f'{prefix} {merged} duplicate rooms, keyed {keyed} rooms, skipped {skipped} rooms without exactly two members')
+
+    def merge(self, keeper, duplicates):
+        rooms = [keeper, *duplicates]
+        GroupMessage.objects.filter(group__in=duplicates).update(group=keeper)
+        # the rooms' archives would overlap, they go back to live messages
+        # and archive_chat_messages archives them again in order
+        unarchive(keeper, ArchivedMessages.objects.filter(group__in=rooms))
+        ChatUpload.objects.filter(group__in=duplicates).update(group=keeper)
+        # each user keeps the cursor furthest behind, so nothing unread in
+        # any of the rooms is hidden
+        behind = dict(
+            ReadCursor.objects.filter(group__in=rooms)
+            .values('user').annotate(last_read_id=Min('last_read_id')).values_list('user', 'last_read_id')
+        )
+        ReadCursor.objects.filter(group__in=duplicates).delete()
+        for user_id, last_read_id in behind.items():
+            ReadCursor.objects.update_or_create(user_id=user_id, group=keeper, defaults={'last_read_id': last_read_id})
+        # nothing is left for the delete to cascade to but the memberships
+        ChatGroup.all_objects.filter(id__in=[room.id for room in duplicates]).delete()
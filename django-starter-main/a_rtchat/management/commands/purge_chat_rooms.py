@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from a_rtchat.models import *
+from a_rtchat.retention import *
+
+
+class Command(BaseCommand):
+    help = 'Finish purging deleted chat rooms, for purges a restart cut short.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH)
+
+    def handle(self, *args, **options):
+        rooms = ChatGroup.all_objects.filter(deleted__isnull=False).values_list('id', flat=True)
+        count = deleted = 0
+        for group_id in list(rooms):
+            deleted += purge_room(group_id, options['batch_size'])
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Purged {count} rooms with {deleted} messages'))
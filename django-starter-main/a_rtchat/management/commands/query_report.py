@@ -0,0 +1,52 @@
+import json
+import os
+from collections import defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Summarise QUERY_COUNT_LOG: views and consumer events with the most queries and duplicate statements.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=15)
+        parser.add_argument('--clear', action='store_true', help='empty the log after reporting')
+
+    def handle(self, *args, **options):
+        path = getattr(settings, 'QUERY_COUNT_LOG', None)
+        if not path:
+            raise CommandError('Set QUERY_COUNT_LOG to collect query counts')
+        # the rotated files as well, oldest first
+        backups = getattr(settings, 'QUERY_COUNT_LOG_BACKUPS', 3)
+        paths = [f'{path}.{i}' for i in range(backups, 0, -1)] + [str(path)]
+        entries = []
+        for log_path in paths:
+            try:
+                with open(log_path) as log:
+                    entries += [json.loads(line) for line in log if line.strip()]
+            except FileNotFoundError:
+                pass
+
+        labels = defaultdict(lambda: {'calls': 0, 'queries': 0, 'max': 0, 'duplicates': 0, 'worst': {}})
+        for entry in entries:
+            stats = labels[entry['label']]
+            stats['calls'] += 1
+            stats['queries'] += entry['queries']
+            stats['max'] = max(stats['max'], entry['queries'])
+            stats['duplicates'] = max(stats['duplicates'], entry['duplicates'])
+            for sql, count in entry['worst']:
+                stats['worst'][sql] = max(stats['worst'].get(sql, 0), count)
+
+        ranked = sorted(labels.items(), key=lambda item: (item[1]['max'], item[1]['duplicates']), reverse=True)
+        self.stdout.write(f"{'label':<45} {'calls':>6} {'avg':>6} {'max':>6} {'dupes':>6}")
+        for label, stats in ranked[:options['limit']]:
+            average = stats['queries'] / stats['calls']
+            self.stdout.write(f"{label:<45} {stats['calls']:>6} {average:>6.1f} {stats['max']:>6} {stats['duplicates']:>6}")
+            for sql, count in sorted(stats['worst'].items(), key=lambda item: item[1], reverse=True)[:2]:
+                self.stdout.write(f'    {count}x {sql[:110]}')
+
+        if options['clear']:
+            open(path, 'w').close()
+            for log_path in paths[:-1]:
+                if os.path.exists(log_path):
+                    os.remove(log_path)
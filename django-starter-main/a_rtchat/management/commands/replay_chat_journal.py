@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from a_rtchat.writebehind import recover
+
+
+class Command(BaseCommand):
+    help = 'Save chat messages left in the write-behind journal by processes that stopped before writing them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--journal', help='defaults to the journal in CHAT_WRITE_BEHIND')
+
+    def handle(self, *args, **options):
+        journal = options['journal'] or (getattr(settings, 'CHAT_WRITE_BEHIND', None) or {}).get('journal')
+        if not journal:
+            raise CommandError('CHAT_WRITE_BEHIND is off, pass --journal')
+        count = recover(journal)
+        self.stdout.write(self.style.SUCCESS(f'Recovered {count} messages'))
@@ -0,0 +1,102 @@
+"""
+Which rooms each user is a member of, from a cache, so access checks in
+views and consumers don't read the membership table.
+
+A user's rooms are one cache entry, written together with the user's
+version. Every change to ChatGroup.members bumps the version of the users
+it touches (see signals.members_membership). A lookup reads the version
+and the entry in one MGET and reloads when they don't match, so a load
+that raced a change and wrote the old rooms is never served.
+
+The cache is shared by every worker process through Redis, and runs
+against LocalRedis without a url::
+
+    CHAT_MEMBERSHIP = {
+        'url': 'redis://localhost:6379/0',
+        'timeout': 3600,
+    }
+
+Versions are kept without expiry, one small key per user whose rooms
+ever changed. Entries expire after ``timeout`` seconds.
+"""
+import threading
+from collections import Counter
+from django.conf import settings
+from .models import *
+
+
+class MembershipCache:
+    def __init__(self, url=None, prefix='membership', timeout=3600, client=None):
+        if client is None:
+            if url:
+                import redis
+                client = redis.Redis.from_url(url, decode_responses=True)
+            else:
+                from .localredis import LocalRedis
+                client = LocalRedis()
+        self.client = client
+        self.prefix = prefix
+        self.timeout = timeout
+        self.metrics = Counter()
+        self.lock = threading.Lock()
+
+    def version_key(self, user_id):
+        return f'{self.prefix}:version:{user_id}'
+
+    def rooms_key(self, user_id):
+        return f'{self.prefix}:rooms:{user_id}'
+
+    def rooms(self, user_id):
+        """ Ids of the rooms ``user_id`` is a member of, as a frozenset. """
+        version, entry = self.client.mget([self.version_key(user_id), self.rooms_key(user_id)])
+        version = version or '0'
+        if entry is not None:
+            entry_version, _, room_ids = entry.partition(':')
+            if entry_version == version:
+                self.count('hits')
+                return frozenset(int(room_id) for room_id in room_ids.split(',') if room_id)
+        self.count('misses')
+        Membership = ChatGroup.members.through
+        room_ids = frozenset(Membership.objects.filter(user_id=user_id).values_list('chatgroup_id', flat=True))
+        self.client.set(self.rooms_key(user_id), f"{version}:{','.join(map(str, sorted(room_ids)))}", ex=self.timeout)
+        return room_ids
+
+    def is_member(self, user_id, group_id):
+        return user_id is not None and group_id in self.rooms(user_id)
+
+    def changed(self, user_ids):
+        """ Make the cached rooms of ``user_ids`` stale, after the change is committed. """
+        for user_id in user_ids:
+            self.client.incr(self.version_key(user_id))
+        if user_ids:
+            self.client.delete(*[self.rooms_key(user_id) for user_id in user_ids])
+            self.count('changes', len(user_ids))
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.metrics[key] += amount
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics)
+
+
+_membership = None
+
+
+def get_membership():
+    global _membership
+    if _membership is None:
+        _membership = MembershipCache(**getattr(settings, 'CHAT_MEMBERSHIP', {}))
+    return _membership
+
+
+def is_member(user, chat_group):
+    return get_membership().is_member(user.id, chat_group.id)
+
+
+def can_read(user, chat_group):
+    """ Public chats are open to everyone, private and group chats to their members. """
+    if not (chat_group.is_private or chat_group.groupchat_name):
+        return True
+    return is_member(user, chat_group)
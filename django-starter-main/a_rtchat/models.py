@@ -1,32 +1,79 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import shortuuid
 from PIL import Image
+import mimetypes
 import os
 
+class ChatGroupManager(models.Manager):
+    # rooms being purged in the background are gone for everything else,
+    # see a_rtchat.retention
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted__isnull=True)
+
+
 class ChatGroup(models.Model):
     group_name = models.CharField(max_length=128, unique=True, blank=True)
     groupchat_name = models.CharField(max_length=128, null=True, blank=True)
     admin = models.ForeignKey(User, related_name='groupchats', blank=True, null=True, on_delete=models.SET_NULL)
-    users_online = models.ManyToManyField(User, related_name='online_in_groups', blank=True)
     members = models.ManyToManyField(User, related_name='chat_groups', blank=True)
     is_private = models.BooleanField(default=False)
+    # ordered member id pair of a private chat, one room per pair
+    private_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    # days messages stay in GroupMessage before they're archived, None for
+    # CHAT_RETENTION_DAYS, see a_rtchat.retention
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    deleted = models.DateTimeField(null=True, blank=True, editable=False)
+    
+    objects = ChatGroupManager()
+    all_objects = models.Manager()
+    
+    class Meta:
+        indexes = [
+            # public rooms are the ones without a groupchat_name, search
+            # looks them up
+            models.Index(fields=['groupchat_name'], name='chatgroup_groupchat_name_idx'),
+        ]
     
     def __str__(self):
         return self.group_name
+    
+    @staticmethod
+    def private_key_for(*users):
+        return ':'.join(str(user_id) for user_id in sorted(user.id for user in users))
+
+    # only ever moved by UPDATEs, saving a row loaded earlier would bring
+    # a deleted room back
+    UPDATED_ONLY = ('deleted',)
 
     def save(self, *args, **kwargs):
         if not self.group_name:
             self.group_name = shortuuid.uuid()
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.UPDATED_ONLY
+            ]
         super().save(*args, **kwargs)
     
     
 class GroupMessage(models.Model):
-    group = models.ForeignKey(ChatGroup, related_name='chat_messages', on_delete=models.CASCADE)
+    # indexed by groupmessage_history_idx, which starts with group
+    group = models.ForeignKey(ChatGroup, related_name='chat_messages', on_delete=models.CASCADE, db_index=False)
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     body = models.CharField(max_length=300, blank=True, null=True)
     file = models.FileField(upload_to='files/', blank=True, null=True)
-    created = models.DateTimeField(auto_now_add=True)
+    # worked out once when the file is uploaded, see read_file_metadata
+    is_image = models.BooleanField(default=False)
+    file_mime = models.CharField(max_length=100, blank=True)
+    file_size = models.PositiveBigIntegerField(null=True, blank=True)
+    file_width = models.PositiveIntegerField(null=True, blank=True)
+    file_height = models.PositiveIntegerField(null=True, blank=True)
+    # resized copies made in the background, {format: {width: name}}
+    file_variants = models.JSONField(default=dict, blank=True)
+    # set by the write-behind before the row exists, see a_rtchat.writebehind
+    created = models.DateTimeField(default=timezone.now, editable=False)
     
     @property
     def filename(self):
@@ -42,13 +89,85 @@ class GroupMessage(models.Model):
             return f'{self.author.username} : {self.filename}'
     
     class Meta:
-        ordering = ['-created']
+        ordering = ['-created', '-id']
+        indexes = [
+            # history pages are keyset scans over one room, newest first
+            models.Index(fields=['group', '-created', '-id'], name='groupmessage_history_idx'),
+            # unread counts are the messages after a read cursor's id, see a_rtchat.unread
+            models.Index(fields=['group', 'id', 'author'], name='groupmessage_unread_idx'),
+        ]
         
-    @property    
-    def is_image(self):
+    def read_file_metadata(self):
+        """
+        Fill in the file fields from the file itself. Called on upload while
+        the file is still local, so templates never have to open it.
+        """
+        self.file_size = self.file.size
+        self.file_mime = mimetypes.guess_type(self.file.name)[0] or 'application/octet-stream'
+        self.is_image = False
+        self.file_width = self.file_height = None
         try:
-            image = Image.open(self.file) 
+            self.file.seek(0)
+            image = Image.open(self.file)
+            self.file_width, self.file_height = image.size
+            self.file_mime = Image.MIME.get(image.format, self.file_mime)
             image.verify()
-            return True 
-        except:
-            return False
+            self.is_image = True
+        except Exception:
+            self.file_width = self.file_height = None
+        finally:
+            self.file.seek(0)
+
+
+class ChatUpload(models.Model):
+    """ A chunked upload in progress, see a_rtchat.uploads """
+    key = models.CharField(max_length=32, unique=True, default=shortuuid.uuid)
+    group = models.ForeignKey(ChatGroup, related_name='uploads', on_delete=models.CASCADE)
+    author = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    mime = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    # set while a request writes the next chunk, see uploads.claim_chunk
+    claim = models.CharField(max_length=32, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f'{self.author.username} : {self.filename}'
+
+
+class ReadCursor(models.Model):
+    """ How far a user has read a room, see a_rtchat.unread """
+    user = models.ForeignKey(User, related_name='read_cursors', on_delete=models.CASCADE)
+    group = models.ForeignKey(ChatGroup, related_name='read_cursors', on_delete=models.CASCADE)
+    # the newest message of the room when they last read it
+    last_read_id = models.PositiveBigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f'{self.user.username} : {self.group.group_name}'
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'group'], name='readcursor_user_group'),
+        ]
+
+
+class ArchivedMessages(models.Model):
+    """ A run of a room's oldest messages, compressed into one row, see a_rtchat.retention """
+    group = models.ForeignKey(ChatGroup, related_name='archives', on_delete=models.CASCADE, db_index=False)
+    # runs are archived oldest first and don't overlap, so history pages
+    # find theirs by the first message alone
+    first_created = models.DateTimeField()
+    last_created = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    
+    def __str__(self):
+        return f'{self.group.group_name} : {self.count} messages'
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', '-first_created'], name='archive_history_idx'),
+        ]
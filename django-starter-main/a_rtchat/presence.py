@@ -0,0 +1,319 @@
+"""
+Who is connected to which chat room.
+
+Presence changes on every websocket connect and disconnect, so it is kept
+out of the database. Every connection is counted on its own: a user is
+online in a room while at least one of their connections (tabs) is, and
+connections that stop sending heartbeats expire after ``timeout`` seconds.
+Reads never count an expired connection. Each worker runs sweep() every
+heartbeat interval and broadcasts the users that went offline, whichever
+call expired them (see broadcast.sweep_presence).
+
+The backend is chosen like a channel layer::
+
+    CHAT_PRESENCE = {
+        'BACKEND': 'a_rtchat.presence.InMemoryPresence',
+        'CONFIG': {'timeout': 60},
+    }
+"""
+import threading
+import time
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class BasePresence:
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        # (room, user_id) pairs expired since the last sweep
+        self.expired = []
+        self.expired_lock = threading.Lock()
+
+    @property
+    def heartbeat_interval(self):
+        return self.timeout / 3
+
+    def join(self, room, user_id, channel_name):
+        """ Register a connection. True if the user just came online in the room. """
+        raise NotImplementedError
+
+    def leave(self, room, user_id, channel_name):
+        """ Drop a connection. True if it was the user's last one in the room. """
+        raise NotImplementedError
+
+    def heartbeat(self, room, user_id, channel_name):
+        raise NotImplementedError
+
+    def expire(self):
+        """ Drop stale connections, returning the (room, user_id) pairs that went offline. """
+        raise NotImplementedError
+
+    def went_offline(self, offline):
+        with self.expired_lock:
+            self.expired += offline
+        return offline
+
+    def sweep(self):
+        """ Expire, and return every pair that went offline since the last sweep. """
+        self.expire()
+        with self.expired_lock:
+            offline, self.expired = self.expired, []
+        return offline
+
+    def online(self, room):
+        """ The user ids online in ``room``, a frozenset. """
+        raise NotImplementedError
+
+    def count(self, room):
+        raise NotImplementedError
+
+    def is_online(self, room, user_id):
+        raise NotImplementedError
+
+    def others_online(self, room, user_id):
+        return self.count(room) - self.is_online(room, user_id) > 0
+
+    async def ajoin(self, room, user_id, channel_name):
+        return await sync_to_async(self.join, thread_sensitive=False)(room, user_id, channel_name)
+
+    async def aleave(self, room, user_id, channel_name):
+        return await sync_to_async(self.leave, thread_sensitive=False)(room, user_id, channel_name)
+
+    async def aheartbeat(self, room, user_id, channel_name):
+        return await sync_to_async(self.heartbeat, thread_sensitive=False)(room, user_id, channel_name)
+
+    async def acount(self, room):
+        return await sync_to_async(self.count, thread_sensitive=False)(room)
+
+    async def aothers_online(self, room, user_id):
+        return await sync_to_async(self.others_online, thread_sensitive=False)(room, user_id)
+
+    async def asweep(self):
+        return await sync_to_async(self.sweep, thread_sensitive=False)()
+
+
+class InMemoryPresence(BasePresence):
+    """ Single process presence for development. """
+
+    def __init__(self, timeout=60):
+        super().__init__(timeout)
+        self.rooms = {}
+        # (room, user_id, channel_name) -> last heartbeat, oldest first
+        self.connections = OrderedDict()
+        self.lock = threading.RLock()
+
+    def join(self, room, user_id, channel_name):
+        with self.lock:
+            self.expire()
+            key = (room, user_id, channel_name)
+            if key in self.connections:
+                self.touch(key)
+                return False
+            self.connections[key] = time.monotonic()
+            users = self.rooms.setdefault(room, {})
+            users[user_id] = users.get(user_id, 0) + 1
+            return users[user_id] == 1
+
+    def leave(self, room, user_id, channel_name):
+        with self.lock:
+            self.expire()
+            if self.connections.pop((room, user_id, channel_name), None) is None:
+                return False
+            return self.release(room, user_id)
+
+    def heartbeat(self, room, user_id, channel_name):
+        with self.lock:
+            key = (room, user_id, channel_name)
+            if key in self.connections:
+                self.touch(key)
+
+    def touch(self, key):
+        self.connections[key] = time.monotonic()
+        self.connections.move_to_end(key)
+
+    def release(self, room, user_id):
+        users = self.rooms[room]
+        users[user_id] -= 1
+        if users[user_id]:
+            return False
+        del users[user_id]
+        if not users:
+            del self.rooms[room]
+        return True
+
+    def expire(self):
+        with self.lock:
+            deadline = time.monotonic() - self.timeout
+            offline = []
+            while self.connections:
+                key, seen = next(iter(self.connections.items()))
+                if seen > deadline:
+                    break
+                self.connections.popitem(last=False)
+                room, user_id, channel_name = key
+                if self.release(room, user_id):
+                    offline.append((room, user_id))
+            return self.went_offline(offline)
+
+    def online(self, room):
+        with self.lock:
+            self.expire()
+            return frozenset(self.rooms.get(room, ()))
+
+    def count(self, room):
+        with self.lock:
+            self.expire()
+            return len(self.rooms.get(room, ()))
+
+    def is_online(self, room, user_id):
+        with self.lock:
+            self.expire()
+            return user_id in self.rooms.get(room, ())
+
+    # nothing here blocks, so the async variants skip the thread hop
+
+    async def ajoin(self, room, user_id, channel_name):
+        return self.join(room, user_id, channel_name)
+
+    async def aleave(self, room, user_id, channel_name):
+        return self.leave(room, user_id, channel_name)
+
+    async def aheartbeat(self, room, user_id, channel_name):
+        return self.heartbeat(room, user_id, channel_name)
+
+    async def acount(self, room):
+        return self.count(room)
+
+    async def aothers_online(self, room, user_id):
+        return self.others_online(room, user_id)
+
+    async def asweep(self):
+        return self.sweep()
+
+
+class RedisPresence(BasePresence):
+    """
+    Presence shared by every worker process. Each room is a hash of
+    user id -> connection count, so count and membership are single HLEN
+    and HEXISTS calls. Heartbeats live in one sorted set scored by time.
+
+    A join or leave changes the sorted set and the room's count in one
+    script, like RedisRateLimit's buckets, so a leave racing a join on
+    another worker can't leave the count out of step with the connections.
+    Without a url it runs against LocalRedis, which has no scripts and
+    runs the same steps under its lock.
+    """
+    join_script = """
+        if redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1]) == 0 then
+            return 0
+        end
+        if redis.call('HINCRBY', KEYS[2], ARGV[2], 1) == 1 then
+            return 1
+        end
+        return 0
+    """
+    leave_script = """
+        if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+            return 0
+        end
+        if redis.call('HINCRBY', KEYS[2], ARGV[2], -1) > 0 then
+            return 0
+        end
+        redis.call('HDEL', KEYS[2], ARGV[2])
+        return 1
+    """
+
+    def __init__(self, url=None, prefix='presence', timeout=60, client=None):
+        super().__init__(timeout)
+        if client is None:
+            if url:
+                import redis
+                client = redis.Redis.from_url(url, decode_responses=True)
+            else:
+                from .localredis import LocalRedis
+                client = LocalRedis()
+        self.client = client
+        self.prefix = prefix
+        self.connections_key = f'{prefix}:connections'
+        self.expired_at = 0
+        self.scripts = hasattr(client, 'register_script')
+        if self.scripts:
+            self.join_script = client.register_script(self.join_script)
+            self.leave_script = client.register_script(self.leave_script)
+
+    def room_key(self, room):
+        return f'{self.prefix}:room:{room}'
+
+    def member(self, room, user_id, channel_name):
+        return f'{room}|{user_id}|{channel_name}'
+
+    def join(self, room, user_id, channel_name):
+        self.expire()
+        member = self.member(room, user_id, channel_name)
+        key = self.room_key(room)
+        if self.scripts:
+            return bool(self.join_script(keys=[self.connections_key, key], args=[member, user_id, time.time()]))
+        with self.client.lock:
+            if not self.client.zadd(self.connections_key, {member: time.time()}):
+                return False
+            return self.client.hincrby(key, user_id, 1) == 1
+
+    def leave(self, room, user_id, channel_name):
+        return self.disconnect(self.member(room, user_id, channel_name), room, user_id)
+
+    def disconnect(self, member, room, user_id):
+        """ Drop a connection and its count. True if it was the user's last one in the room. """
+        key = self.room_key(room)
+        if self.scripts:
+            return bool(self.leave_script(keys=[self.connections_key, key], args=[member, user_id]))
+        with self.client.lock:
+            if not self.client.zrem(self.connections_key, member):
+                return False
+            if self.client.hincrby(key, user_id, -1) > 0:
+                return False
+            self.client.hdel(key, user_id)
+            return True
+
+    def heartbeat(self, room, user_id, channel_name):
+        self.client.zadd(self.connections_key, {self.member(room, user_id, channel_name): time.time()}, xx=True)
+
+    def expire(self):
+        offline = []
+        for member in self.client.zrangebyscore(self.connections_key, '-inf', time.time() - self.timeout):
+            room, user_id, channel_name = member.split('|', 2)
+            if self.disconnect(member, room, int(user_id)):
+                offline.append((room, int(user_id)))
+        self.expired_at = time.monotonic()
+        return self.went_offline(offline)
+
+    def expire_due(self):
+        # reads expire too, at most once a second per process so a read
+        # stays one or two round trips
+        if time.monotonic() - self.expired_at >= 1:
+            self.expire()
+
+    def online(self, room):
+        self.expire_due()
+        return frozenset(int(user_id) for user_id in self.client.hkeys(self.room_key(room)))
+
+    def count(self, room):
+        self.expire_due()
+        return self.client.hlen(self.room_key(room))
+
+    def is_online(self, room, user_id):
+        self.expire_due()
+        return bool(self.client.hexists(self.room_key(room), user_id))
+
+
+_presence = None
+
+
+def get_presence():
+    global _presence
+    if _presence is None:
+        config = getattr(settings, 'CHAT_PRESENCE', {})
+        backend = import_string(config.get('BACKEND', 'a_rtchat.presence.InMemoryPresence'))
+        _presence = backend(**config.get('CONFIG', {}))
+    return _presence
@@ -0,0 +1,78 @@
+"""
+Wire formats for the chat websockets.
+
+By default every event goes out as an html fragment that htmx swaps in
+out of band. A client can ask for compact events instead by offering the
+'chat.json' or 'chat.msgpack' websocket subprotocol, and render them
+itself:
+
+    {"t": "message", "message": {...}}                   see message_json
+    {"t": "presence", "count": 2, "joined": [4], "left": [9]}
+    {"t": "online_users", "count": 12}
+    {"t": "chat_status", "room": "...", "active": true, "any": true}
+    {"t": "unread", "room": "...", "count": 3}
+    {"t": "status", "online_users": 12, "active_chats": [...], "unread": {...}, "chats": [...]}
+    {"t": "throttled", "retry": 2}                       see a_rtchat.ratelimit
+    {"t": "resync", "messages": [...], "next": "..."}    see a_rtchat.backpressure
+    {"t": "resume", "messages": [...], "replace": false, "next": null, "presence": {...}}
+
+The first presence event on a socket carries "online" with every online
+id in place of joined and left. msgpack is only offered when the package
+is installed. Clients send {"body": ...} in either format.
+
+A client that reconnected sends {"resume": <id of its last message>}
+once. The resume event has the messages after it, newest first, and the
+room's presence snapshot. With "replace" the client was too far behind
+and the messages are the latest page, which replaces what it shows.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'chat.json'
+MSGPACK = 'chat.msgpack'
+
+
+def supported():
+    return [JSON, MSGPACK] if msgpack is not None else [JSON]
+
+
+def negotiate(scope):
+    """ The first compact protocol the client offered that we speak, None for html. """
+    for protocol in scope.get('subprotocols', ()):
+        if protocol in supported():
+            return protocol
+    return None
+
+
+def encode(protocol, data):
+    """ Keyword arguments for a consumer's send(). """
+    if protocol == MSGPACK:
+        return {'bytes_data': msgpack.packb(data)}
+    return {'text_data': json.dumps(data, separators=(',', ':'))}
+
+
+def decode(protocol, text_data=None, bytes_data=None):
+    if bytes_data is not None:
+        if protocol != MSGPACK:
+            raise ValueError('Binary frames need the chat.msgpack protocol')
+        return msgpack.unpackb(bytes_data)
+    return json.loads(text_data)
+
+
+def presence_delta(sent, online_ids, online_count):
+    """
+    The presence event for a socket that was last sent ``sent``, None if
+    nothing was sent yet.
+    """
+    online_ids = set(online_ids)
+    data = {'t': 'presence', 'count': online_count}
+    if sent is None:
+        data['online'] = sorted(online_ids)
+    else:
+        data['joined'] = sorted(online_ids - sent)
+        data['left'] = sorted(sent - online_ids)
+    return data, online_ids
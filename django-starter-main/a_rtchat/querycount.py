@@ -0,0 +1,192 @@
+"""
+Query counting per HTTP request and per websocket event.
+
+Every database connection gets an execute wrapper (installed from
+AppConfig.ready) that records into the scopes opened with count_queries.
+Scopes live in a context variable, which asgiref copies into the threads
+behind database_sync_to_async, so queries a consumer runs there count
+towards the event that caused them.
+
+Repeated statements with different parameters are the N+1 signature, and
+are reported as duplicates.
+
+Each scope's summary goes out as a JSON line on the
+``a_rtchat.querycount.scopes`` logger. With QUERY_COUNT_LOG set,
+start_scope_log gives that logger a QueueHandler, and a QueueListener
+thread appends the lines to the file, so a consumer event never waits on
+the disk. The file rolls over at QUERY_COUNT_LOG_MAX_BYTES, keeping
+QUERY_COUNT_LOG_BACKUPS old files beside it (10 MB and 3 by default).
+"""
+import atexit
+import json
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+scope_log = logging.getLogger(__name__ + '.scopes')
+
+_listener = None
+_listener_lock = threading.Lock()
+
+_scopes = ContextVar('query_scopes', default=())
+
+
+class QueryScope:
+    def __init__(self, label):
+        self.label = label
+        self.count = 0
+        self.statements = Counter()
+
+    @property
+    def duplicates(self):
+        return sum(count - 1 for count in self.statements.values() if count > 1)
+
+    def worst(self, limit=3):
+        return [(sql, count) for sql, count in self.statements.most_common(limit) if count > 1]
+
+    def summary(self):
+        return {
+            'label': self.label,
+            'queries': self.count,
+            'duplicates': self.duplicates,
+            'worst': self.worst(),
+        }
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def record_query(execute, sql, params, many, context):
+    for scope in _scopes.get():
+        scope.count += 1
+        scope.statements[sql] += 1
+    return execute(sql, params, many, context)
+
+
+def install(sender, connection, **kwargs):
+    # connected to connection_created, which fires again on reconnects
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def count_queries(label):
+    scope = QueryScope(label)
+    token = _scopes.set(_scopes.get() + (scope,))
+    try:
+        yield scope
+    finally:
+        _scopes.reset(token)
+        log_scope(scope)
+
+
+@contextmanager
+def query_budget(max_queries, label='block'):
+    """
+    Fail when the block runs more than max_queries queries, e.g. in a test::
+
+        with query_budget(10, 'chat_view'):
+            self.client.get(reverse('chatroom', args=[room.group_name]))
+    """
+    with count_queries(label) as scope:
+        yield scope
+    check_budget(scope, max_queries)
+
+
+def check_budget(scope, max_queries):
+    if scope.count > max_queries:
+        worst = '\n'.join(f'  {count}x {sql}' for sql, count in scope.worst())
+        raise QueryBudgetExceeded(
+            f'{scope.label} ran {scope.count} queries, budget is {max_queries} '
+            f'({scope.duplicates} duplicates)\n{worst}'
+        )
+
+
+def check_label_budget(scope):
+    """ Checks a scope against its QUERY_BUDGETS entry, if it has one. """
+    budget = getattr(settings, 'QUERY_BUDGETS', {}).get(scope.label)
+    if budget is None:
+        return
+    try:
+        check_budget(scope, budget)
+    except QueryBudgetExceeded as error:
+        if getattr(settings, 'QUERY_BUDGETS_STRICT', False):
+            raise
+        logger.warning(str(error))
+
+
+def start_scope_log():
+    """ Appends the scope summaries to QUERY_COUNT_LOG from a background thread. """
+    global _listener
+    path = getattr(settings, 'QUERY_COUNT_LOG', None)
+    with _listener_lock:
+        if not path or _listener is not None:
+            return
+        records = queue.SimpleQueue()
+        handler = RotatingFileHandler(
+            path, delay=True,
+            maxBytes=getattr(settings, 'QUERY_COUNT_LOG_MAX_BYTES', 10 * 1024 ** 2),
+            backupCount=getattr(settings, 'QUERY_COUNT_LOG_BACKUPS', 3),
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _listener = QueueListener(records, handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+        scope_log.addHandler(QueueHandler(records))
+        scope_log.setLevel(logging.INFO)
+        scope_log.propagate = False
+
+
+def log_scope(scope):
+    if scope.duplicates:
+        logger.debug('%s: %s queries, %s duplicates', scope.label, scope.count, scope.duplicates)
+    if scope.count and scope_log.isEnabledFor(logging.INFO):
+        scope_log.info(json.dumps(scope.summary()))
+
+
+def view_label(request):
+    match = request.resolver_match
+    if match is None:
+        return request.path
+    return match.func.__name__
+
+
+class QueryCountMiddleware:
+    """
+    Counts the queries of each request. With DEBUG on the totals go out in
+    X-Query-Count and X-Query-Duplicates headers. Views listed in
+    QUERY_BUDGETS are checked against their budget: over budget is a
+    warning, or a QueryBudgetExceeded error with QUERY_BUDGETS_STRICT.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with count_queries(request.path) as scope:
+            response = self.get_response(request)
+            scope.label = view_label(request)
+
+        if settings.DEBUG:
+            response['X-Query-Count'] = scope.count
+            response['X-Query-Duplicates'] = scope.duplicates
+
+        check_label_budget(scope)
+        return response
+
+
+class QueryCountMixin:
+    """
+    Counts the queries of every event a consumer handles, and checks the
+    events listed in QUERY_BUDGETS, e.g. 'ChatroomConsumer.websocket.receive'.
+    """
+    async def dispatch(self, message):
+        with count_queries(f"{type(self).__name__}.{message['type']}") as scope:
+            await super().dispatch(message)
+        check_label_budget(scope)
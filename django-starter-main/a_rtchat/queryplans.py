@@ -0,0 +1,78 @@
+"""
+EXPLAIN helpers for the query plan regression check.
+
+A plan is flagged when the database reads a whole table (sequential scan)
+or sorts rows itself instead of reading them in index order (filesort).
+An FTS5 table answering a MATCH shows as a SCAN of the virtual table, with
+an M in its index string, and is the full-text index at work.
+"""
+import re
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+# tiny lookup tables that every backend is right to scan
+SCAN_ALLOWED = {'django_site', 'django_content_type', 'django_migrations'}
+FTS_MATCH = re.compile(r'VIRTUAL TABLE INDEX \d+:\S*M')
+
+
+def explain(sql):
+    vendor = connection.vendor
+    with connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[-1] for row in cursor.fetchall()]
+        if vendor == 'postgresql':
+            cursor.execute(f'EXPLAIN {sql}')
+            return [row[0] for row in cursor.fetchall()]
+        if vendor == 'mysql':
+            cursor.execute(f'EXPLAIN {sql}')
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    raise NotImplementedError(f'No plan parser for {vendor}')
+
+
+def plan_problems(plan):
+    vendor = connection.vendor
+    problems = []
+    for line in plan:
+        if vendor == 'sqlite':
+            if line.startswith('SCAN ') and ' USING ' not in line and 'CONSTANT ROW' not in line and not FTS_MATCH.search(line):
+                table = line.split()[1]
+                if table not in SCAN_ALLOWED:
+                    problems.append(f'sequential scan: {line}')
+            if 'TEMP B-TREE FOR ORDER BY' in line:
+                problems.append(f'filesort: {line}')
+        elif vendor == 'postgresql':
+            node = line.strip().lstrip('->').strip()
+            if node.startswith('Seq Scan on '):
+                table = node.split()[3]
+                if table not in SCAN_ALLOWED:
+                    problems.append(f'sequential scan: {node}')
+            if node.startswith('Sort ') or node.startswith('Incremental Sort '):
+                problems.append(f'filesort: {node}')
+        elif vendor == 'mysql':
+            if line.get('type') == 'ALL' and line.get('table') not in SCAN_ALLOWED:
+                problems.append(f"sequential scan: {line.get('table')}")
+            if 'filesort' in (line.get('Extra') or ''):
+                problems.append(f"filesort: {line.get('table')}")
+    return problems
+
+
+def planned_queries(scenarios):
+    """
+    Runs each (name, callable) scenario and yields (name, sql, plan,
+    problems) for every SELECT it ran.
+    """
+    for name, run in scenarios:
+        with CaptureQueriesContext(connection) as captured:
+            run()
+        for query in captured.captured_queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith('SELECT'):
+                continue
+            plan = explain(sql)
+            yield name, sql, plan, plan_problems(plan)
+
+
+def format_plan(plan):
+    return [str(line) for line in plan]
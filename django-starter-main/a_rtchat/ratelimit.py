@@ -0,0 +1,186 @@
+"""
+Token buckets for what clients send over the chat websockets.
+
+Every message a ChatroomConsumer receives takes a token from three
+buckets at once: its connection's, its user's (across tabs and workers)
+and its room's. A bucket refills at ``rate`` tokens a second up to
+``burst``. The message goes through only if all three have a token, and
+then all three lose one, so a throttled message doesn't cost the buckets
+that had room for it.
+
+The backend is chosen like presence::
+
+    CHAT_RATE_LIMIT = {
+        'BACKEND': 'a_rtchat.ratelimit.RedisRateLimit',
+        'CONFIG': {
+            'url': 'redis://localhost:6379/0',
+            'rates': {
+                'connection': (2, 10),
+                'user': (3, 20),
+                'room': (20, 60),
+            },
+        },
+    }
+
+A scope left out of ``rates``, or set to None, isn't limited.
+InMemoryRateLimit keeps the buckets in the process, which only limits
+users and rooms per worker. RedisRateLimit shares them through one
+script call per message.
+"""
+import math
+import threading
+import time
+from collections import Counter
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_RATES = {
+    'connection': (2, 10),
+    'user': (3, 20),
+    'room': (20, 60),
+}
+
+
+class BaseRateLimit:
+    def __init__(self, rates=None):
+        self.rates = {**DEFAULT_RATES, **(rates or {})}
+        self.metrics = Counter()
+        self.lock = threading.Lock()
+
+    def limits(self, scopes):
+        return [
+            (f'{scope}:{key}', *self.rates[scope], scope)
+            for scope, key in scopes.items() if self.rates.get(scope)
+        ]
+
+    def allow(self, **scopes):
+        """
+        Take a token for each of ``scopes``, e.g. connection=channel_name,
+        user=user_id, room=group_name. Returns 0 when allowed, otherwise the
+        seconds until the emptiest bucket has a token again.
+        """
+        limits = self.limits(scopes)
+        retry_after, scope = self.take(limits) if limits else (0, None)
+        with self.lock:
+            if retry_after:
+                self.metrics[f'throttled.{scope}'] += 1
+            else:
+                self.metrics['allowed'] += 1
+        return retry_after
+
+    async def aallow(self, **scopes):
+        return await sync_to_async(self.allow, thread_sensitive=False)(**scopes)
+
+    def take(self, limits):
+        """ (retry_after, scope of the bucket it waits on) for [(key, rate, burst, scope)] """
+        raise NotImplementedError
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics)
+
+
+class InMemoryRateLimit(BaseRateLimit):
+    def __init__(self, rates=None):
+        super().__init__(rates)
+        # key -> [tokens, at]
+        self.buckets = {}
+        self.swept = time.monotonic()
+
+    def take(self, limits):
+        now = time.monotonic()
+        with self.lock:
+            self.sweep(now)
+            waits = []
+            for key, rate, burst, scope in limits:
+                tokens, at = self.buckets.get(key, (burst, now))
+                tokens = min(burst, tokens + (now - at) * rate)
+                self.buckets[key] = [tokens, now]
+                if tokens < 1:
+                    waits.append(((1 - tokens) / rate, scope))
+            if waits:
+                return max(waits)
+            for key, rate, burst, scope in limits:
+                self.buckets[key][0] -= 1
+            return 0, None
+
+    def sweep(self, now):
+        # a bucket idle long enough to be full again is the same as none
+        if now - self.swept < 60:
+            return
+        self.swept = now
+        refill = max(burst / rate for rate, burst in filter(None, self.rates.values()))
+        for key, (tokens, at) in list(self.buckets.items()):
+            if now - at > refill:
+                del self.buckets[key]
+
+    # nothing here blocks, so the async variant skips the thread hop
+
+    async def aallow(self, **scopes):
+        return self.allow(**scopes)
+
+
+class RedisRateLimit(BaseRateLimit):
+    """
+    The same buckets as hashes in Redis, checked and taken by one script
+    so that workers racing for the last token can't both get it. Time is
+    the Redis server's, the workers' clocks don't matter.
+    """
+    script = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local tokens, wait, waits_on = {}, 0, 0
+        for i, key in ipairs(KEYS) do
+            local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+            local bucket = redis.call('HMGET', key, 'tokens', 'at')
+            local at = tonumber(bucket[2]) or now
+            tokens[i] = math.min(burst, (tonumber(bucket[1]) or burst) + math.max(0, now - at) * rate)
+            if tokens[i] < 1 and (1 - tokens[i]) / rate > wait then
+                wait, waits_on = (1 - tokens[i]) / rate, i
+            end
+        end
+        for i, key in ipairs(KEYS) do
+            local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+            if wait == 0 then
+                tokens[i] = tokens[i] - 1
+            end
+            redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'at', tostring(now))
+            redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+        end
+        return {tostring(wait), waits_on}
+    """
+
+    def __init__(self, url=None, prefix='ratelimit', rates=None, client=None):
+        super().__init__(rates)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url or 'redis://localhost:6379/0', decode_responses=True)
+        self.client = client
+        self.prefix = prefix
+        self.take_script = client.register_script(self.script)
+
+    def take(self, limits):
+        keys = [f'{self.prefix}:{key}' for key, rate, burst, scope in limits]
+        args = [value for key, rate, burst, scope in limits for value in (rate, burst)]
+        wait, waits_on = self.take_script(keys=keys, args=args)
+        if not float(wait):
+            return 0, None
+        return float(wait), limits[int(waits_on) - 1][3]
+
+
+_rate_limit = None
+
+
+def get_rate_limit():
+    global _rate_limit
+    if _rate_limit is None:
+        config = getattr(settings, 'CHAT_RATE_LIMIT', {})
+        backend = import_string(config.get('BACKEND', 'a_rtchat.ratelimit.InMemoryRateLimit'))
+        _rate_limit = backend(**config.get('CONFIG', {}))
+    return _rate_limit
+
+
+def retry_seconds(retry_after):
+    """ What a client is told to wait, in whole seconds. """
+    return max(1, math.ceil(retry_after))
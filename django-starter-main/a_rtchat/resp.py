@@ -0,0 +1,208 @@
+"""
+Just enough of the Redis protocol (RESP2) for pub/sub: a client
+connection used by the sharded channel layer, and a stand-in broker that
+answers PING, PUBLISH, SUBSCRIBE and UNSUBSCRIBE. The stand-in lets the
+channel layer and the cluster benchmark run without a Redis server, a
+real Redis works in its place.
+
+It's for the benchmark: there is no reconnect, command timeout, AUTH or
+TLS, so a dropped connection leaves pending commands waiting.
+"""
+import asyncio
+import logging
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def encode_command(*args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, int):
+            arg = str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+class RespError(Exception):
+    pass
+
+
+async def read_reply(reader):
+    line = await reader.readuntil(b'\r\n')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest.decode()
+    if kind == b'-':
+        return RespError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RespError(f'Unexpected reply {line!r}')
+
+
+def parse_url(url):
+    parsed = urlparse(url if '://' in url else f'redis://{url}')
+    # the benchmark's brokers are local and open, refuse what this can't speak
+    if parsed.scheme != 'redis' or parsed.password or parsed.path.strip('/') not in ('', '0'):
+        raise ValueError(f'{url}: no TLS, AUTH or database selection, use channels_redis for real hosts')
+    return parsed.hostname or 'localhost', parsed.port or 6379
+
+
+class RespConnection:
+    """
+    A pipelined client connection. Replies are matched to commands in
+    order, so many commands can be in flight without waiting on each.
+    """
+    def __init__(self, url):
+        self.host, self.port = parse_url(url)
+        self.reader = self.writer = None
+        self.waiting = deque()
+        self.reader_task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.reader_task = asyncio.create_task(self.read_replies())
+
+    async def read_replies(self):
+        try:
+            while True:
+                reply = await read_reply(self.reader)
+                future = self.waiting.popleft()
+                if not future.done():
+                    if isinstance(reply, RespError):
+                        future.set_exception(reply)
+                    else:
+                        future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            while self.waiting:
+                future = self.waiting.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError(str(e)))
+
+    def execute(self, *args):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append(future)
+        self.writer.write(encode_command(*args))
+        return future
+
+    async def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+class Subscription:
+    """
+    A connection in subscribe mode. Messages are handed to ``on_message``
+    as (topic, payload) bytes.
+    """
+    def __init__(self, url, on_message):
+        self.host, self.port = parse_url(url)
+        self.on_message = on_message
+        self.writer = None
+        self.reader_task = None
+
+    async def connect(self):
+        reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.reader_task = asyncio.create_task(self.read_messages(reader))
+
+    async def read_messages(self, reader):
+        try:
+            while True:
+                reply = await read_reply(reader)
+                if isinstance(reply, list) and reply[0] == b'message':
+                    self.on_message(reply[1], reply[2])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning('Subscription to %s:%s closed', self.host, self.port)
+
+    def subscribe(self, *topics):
+        self.writer.write(encode_command('SUBSCRIBE', *topics))
+
+    def unsubscribe(self, *topics):
+        self.writer.write(encode_command('UNSUBSCRIBE', *topics))
+
+    async def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+class PubSubBroker:
+    """ The stand-in server, one per shard. """
+    def __init__(self):
+        self.topics = defaultdict(set)
+        self.metrics = {'published': 0, 'delivered': 0}
+
+    async def serve(self, host='127.0.0.1', port=6379):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        subscribed = set()
+        try:
+            while True:
+                command = await read_reply(reader)
+                if not isinstance(command, list) or not command:
+                    break
+                name = command[0].upper()
+                args = command[1:]
+                if name == b'PUBLISH':
+                    writer.write(b':%d\r\n' % self.publish(args[0], args[1]))
+                elif name == b'SUBSCRIBE':
+                    for topic in args:
+                        self.topics[topic].add(writer)
+                        subscribed.add(topic)
+                        writer.write(encode_command('subscribe', topic, len(subscribed)))
+                elif name == b'UNSUBSCRIBE':
+                    for topic in args or list(subscribed):
+                        self.drop(topic, writer)
+                        subscribed.discard(topic)
+                        writer.write(encode_command('unsubscribe', topic, len(subscribed)))
+                elif name == b'PING':
+                    writer.write(b'+PONG\r\n')
+                elif name == b'QUIT':
+                    writer.write(b'+OK\r\n')
+                    break
+                else:
+                    writer.write(b'-ERR unknown command\r\n')
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for topic in subscribed:
+                self.drop(topic, writer)
+            writer.close()
+
+    def publish(self, topic, payload):
+        subscribers = self.topics.get(topic, ())
+        if subscribers:
+            message = encode_command('message', topic, payload)
+            for subscriber in subscribers:
+                subscriber.write(message)
+        self.metrics['published'] += 1
+        self.metrics['delivered'] += len(subscribers)
+        return len(subscribers)
+
+    def drop(self, topic, writer):
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self.topics[topic]
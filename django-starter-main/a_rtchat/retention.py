@@ -0,0 +1,220 @@
+"""
+How long messages stay in GroupMessage, and how rooms go away.
+
+A room keeps its messages in GroupMessage for ``retention_days``, or
+CHAT_RETENTION_DAYS when it has none (None keeps them there for good).
+archive_chat_messages, run from cron, moves older ones into
+ArchivedMessages: a run of up to ARCHIVE_BATCH messages becomes one row
+of zlib-compressed json, in one transaction with deleting them. The
+rows go without delete signals, so their files stay. history_page reads
+on into the archive when a room's live messages run out, with the same
+cursors. Archived messages are no longer found by search. unarchive puts
+them back, for merge_private_chats.
+
+Deleting a room hides it and drops its members in one short transaction
+(ChatGroup.objects skips deleted rooms), then a background thread
+deletes its messages, archive and files PURGE_BATCH at a time and the
+room last. purge_chat_rooms finishes purges a restart cut short.
+"""
+import json
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import *
+from .derivatives import delete_variants
+from .uploads import discard_upload
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_BATCH = 1000
+PURGE_BATCH = 1000
+# fields kept for an archived message, the room is the archive row's
+ARCHIVED_FIELDS = (
+    'id', 'author_id', 'body', 'file', 'is_image', 'file_mime', 'file_size',
+    'file_width', 'file_height', 'file_variants', 'created',
+)
+
+
+def pack(messages):
+    records = []
+    for message in messages:
+        record = {field: getattr(message, field) for field in ARCHIVED_FIELDS}
+        record['file'] = message.file.name or None
+        record['created'] = message.created.isoformat()
+        records.append(record)
+    return zlib.compress(json.dumps(records, separators=(',', ':')).encode())
+
+
+def unpack(data):
+    records = json.loads(zlib.decompress(bytes(data)))
+    for record in records:
+        record['created'] = datetime.fromisoformat(record['created'])
+    return records
+
+
+def retention_days(chat_group):
+    if chat_group.retention_days is not None:
+        return chat_group.retention_days
+    return getattr(settings, 'CHAT_RETENTION_DAYS', None)
+
+
+def archive_room(chat_group, before, batch_size=ARCHIVE_BATCH):
+    """ Move the room's messages created before ``before`` to the archive, returns how many. """
+    moved = 0
+    while True:
+        with transaction.atomic():
+            messages = list(
+                GroupMessage.objects.filter(group=chat_group, created__lt=before)
+                .order_by('created', 'id')[:batch_size]
+            )
+            if not messages:
+                return moved
+            ArchivedMessages.objects.create(
+                group=chat_group,
+                first_created=messages[0].created,
+                last_created=messages[-1].created,
+                count=len(messages),
+                data=pack(messages),
+            )
+            # no delete signals, the files belong to the archived messages now
+            ids = [message.id for message in messages]
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {GroupMessage._meta.db_table} WHERE id IN ({", ".join(["%s"] * len(ids))})', ids,
+                )
+        moved += len(messages)
+
+
+def unarchive(chat_group, runs):
+    """
+    Put the messages of the archive ``runs`` back in GroupMessage, in
+    ``chat_group``, and delete the runs. Rooms being merged would have
+    runs overlapping each other's and the live messages; archive_due
+    archives them again in order. Returns how many came back.
+    """
+    restored = 0
+    for run_id in list(runs.values_list('id', flat=True)):
+        with transaction.atomic():
+            run = ArchivedMessages.objects.get(id=run_id)
+            records = unpack(run.data)
+            # messages of deleted users stay gone, as they do in history pages
+            authors = set(User.objects.filter(id__in={record['author_id'] for record in records}).values_list('id', flat=True))
+            messages = [GroupMessage(group=chat_group, **record) for record in records if record['author_id'] in authors]
+            GroupMessage.objects.bulk_create(messages, ignore_conflicts=True)
+            run.delete()
+        restored += len(messages)
+    return restored
+
+
+def archive_due(now=None, batch_size=ARCHIVE_BATCH):
+    """ Archive every room's messages older than its retention, returns {group_name: moved} """
+    now = now or timezone.now()
+    rooms = ChatGroup.objects.all()
+    if getattr(settings, 'CHAT_RETENTION_DAYS', None) is None:
+        rooms = rooms.filter(retention_days__isnull=False)
+    moved = {}
+    for chat_group in rooms.iterator():
+        days = retention_days(chat_group)
+        if days is None:
+            continue
+        count = archive_room(chat_group, now - timedelta(days=days), batch_size)
+        if count:
+            moved[chat_group.group_name] = count
+    return moved
+
+
+def archived_messages(chat_group, before=None, limit=30):
+    """
+    Up to ``limit`` archived messages older than ``before``, a (created,
+    id) position, newest first. They're unsaved GroupMessages with their
+    authors and profiles, messages of deleted users are left out.
+    """
+    runs = ArchivedMessages.objects.filter(group=chat_group).order_by('-first_created')
+    if before:
+        # the run holding the position, and the older ones
+        runs = runs.filter(first_created__lte=before[0])
+    records = []
+    for run in runs.iterator(chunk_size=4):
+        records += [
+            record for record in unpack(run.data)
+            if not before or (record['created'], record['id']) < before
+        ]
+        if len(records) >= limit:
+            break
+    records.sort(key=lambda record: (record['created'], record['id']), reverse=True)
+    records = records[:limit]
+
+    authors = User.objects.select_related('profile').in_bulk({record['author_id'] for record in records})
+    messages = []
+    for record in records:
+        if record['author_id'] in authors:
+            message = GroupMessage(group=chat_group, **record)
+            message.author = authors[record['author_id']]
+            messages.append(message)
+    return messages
+
+
+def delete_room(chat_group):
+    """ Hide the room now and purge it in the background. """
+    with transaction.atomic():
+        ChatGroup.all_objects.filter(pk=chat_group.pk).update(deleted=timezone.now(), private_key=None)
+        # its cursors, cached memberships and rooms go with the members
+        chat_group.members.clear()
+    group_id = chat_group.pk
+    transaction.on_commit(lambda: schedule_purge(group_id))
+
+
+def purge_room(group_id, batch_size=PURGE_BATCH):
+    """ Delete a deleted room's messages, archive and files a batch at a time, then the room. """
+    deleted = 0
+    while True:
+        ids = list(GroupMessage.objects.filter(group_id=group_id).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        # with the delete signals, which take the files and their variants
+        with transaction.atomic():
+            GroupMessage.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+    while True:
+        runs = list(ArchivedMessages.objects.filter(group_id=group_id).order_by('id')[:max(1, batch_size // ARCHIVE_BATCH)])
+        if not runs:
+            break
+        # files first, a purge cut short starts again from the rows
+        for run in runs:
+            for record in unpack(run.data):
+                if record['file']:
+                    default_storage.delete(record['file'])
+                    delete_variants(record['file_variants'])
+            deleted += run.count
+        ArchivedMessages.objects.filter(id__in=[run.id for run in runs]).delete()
+    for upload in ChatUpload.objects.filter(group_id=group_id):
+        discard_upload(upload)
+    ChatGroup.all_objects.filter(pk=group_id).delete()
+    return deleted
+
+
+def run_purge(group_id):
+    try:
+        deleted = purge_room(group_id)
+        logger.info('Purged chat room %s with %s messages', group_id, deleted)
+    except Exception:
+        # left for purge_chat_rooms
+        logger.exception('Could not purge chat room %s', group_id)
+    finally:
+        connection.close()
+
+
+_purger = None
+
+
+def schedule_purge(group_id):
+    global _purger
+    if _purger is None:
+        _purger = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-purge')
+    return _purger.submit(run_purge, group_id)
@@ -0,0 +1,167 @@
+"""
+Per-process cache of what a room's fragments are rendered from: the
+chatroom row, its members and connected users with their profiles, the
+authors of its latest messages and its online set.
+
+A room is kept while a consumer in this process is connected to it, so
+steady-state events render without database reads. Signals drop a room
+when its row, memberships or a user's profile change, locally and in
+other processes through the room's channel group.
+"""
+import threading
+import uuid
+from collections import Counter, deque
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from .models import *
+from .presence import get_presence
+
+RECENT_AUTHORS = 30
+
+
+class RoomContext:
+    def __init__(self, chatroom, members, recent, online_ids):
+        self.chatroom = chatroom
+        self.member_ids = [member.id for member in members]
+        self.users = {member.id: member for member in members}
+        # newest first, like the messages on the page
+        self.recent_authors = deque((author_id for message_id, author_id in recent), maxlen=RECENT_AUTHORS)
+        # every consumer of the room hears each message, and with the
+        # write-behind ids from different processes arrive out of order
+        self.recent_ids = deque((message_id for message_id, author_id in recent), maxlen=RECENT_AUTHORS)
+        self.online_ids = online_ids
+
+    @property
+    def members(self):
+        return [self.users[user_id] for user_id in self.member_ids]
+
+    @property
+    def author_ids(self):
+        return set(self.recent_authors)
+
+    def user(self, user_id):
+        """ A user with profile, connected users of public rooms aren't members. """
+        if user_id not in self.users:
+            self.users[user_id] = User.objects.select_related('profile').get(id=user_id)
+        return self.users[user_id]
+
+    @classmethod
+    def load(cls, group_name):
+        chatroom = ChatGroup.objects.get(group_name=group_name)
+        members = list(chatroom.members.select_related('profile'))
+        recent = list(chatroom.chat_messages.values_list('id', 'author_id')[:RECENT_AUTHORS])
+        return cls(chatroom, members, recent, get_presence().online(group_name))
+
+
+class RoomCache:
+    def __init__(self):
+        self.rooms = {}
+        self.refs = Counter()
+        # bumped by invalidate, a load that raced one isn't stored
+        self.generations = Counter()
+        self.seen_tokens = set()
+        self.lock = threading.RLock()
+        self.metrics = Counter()
+
+    def acquire(self, group_name, user):
+        """
+        Hold a room for a connected consumer, loading it on first use, and
+        make sure the consumer's own user is there to render its messages.
+        """
+        with self.lock:
+            self.refs[group_name] += 1
+        try:
+            room = self.get(group_name, store=True)
+            room.user(user.id)
+        except Exception:
+            self.release(group_name)
+            raise
+        return room
+
+    def release(self, group_name):
+        with self.lock:
+            self.refs[group_name] -= 1
+            if self.refs[group_name] <= 0:
+                del self.refs[group_name]
+                self.rooms.pop(group_name, None)
+
+    def get(self, group_name, store=False):
+        """
+        The cached room, or a fresh load. Rooms with no local consumer are
+        not kept, nothing would tell this process when they change. The
+        load runs outside the lock, so one slow room doesn't hold up the
+        others.
+        """
+        with self.lock:
+            room = self.rooms.get(group_name)
+            if room is not None:
+                self.metrics['hits'] += 1
+                return room
+            self.metrics['misses'] += 1
+            generation = self.generations[group_name]
+        room = RoomContext.load(group_name)
+        with self.lock:
+            # another thread may have loaded it meanwhile
+            cached = self.rooms.get(group_name)
+            if cached is not None:
+                return cached
+            if (store or self.refs[group_name]) and self.generations[group_name] == generation:
+                self.rooms[group_name] = room
+            return room
+
+    def invalidate(self, group_name, token=None):
+        with self.lock:
+            # every consumer of the room in this process hears the same
+            # invalidation, only the first one counts
+            if token is not None:
+                if (token, group_name) in self.seen_tokens:
+                    return
+                self.seen_tokens.add((token, group_name))
+                if len(self.seen_tokens) > 10_000:
+                    self.seen_tokens.clear()
+            self.generations[group_name] += 1
+            if self.rooms.pop(group_name, None) is not None:
+                self.metrics['invalidations'] += 1
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for group_name, room in list(self.rooms.items()):
+                if user_id in room.users:
+                    self.invalidate(group_name)
+
+    def message_sent(self, group_name, message_id, author_id):
+        with self.lock:
+            room = self.rooms.get(group_name)
+            if room is None or message_id in room.recent_ids:
+                return
+            room.recent_ids.appendleft(message_id)
+            room.recent_authors.appendleft(author_id)
+
+    def online_changed(self, group_name, online_ids):
+        with self.lock:
+            room = self.rooms.get(group_name)
+            if room is not None:
+                room.online_ids = set(online_ids)
+
+    def stats(self):
+        return {**self.metrics, 'rooms': len(self.rooms)}
+
+
+room_cache = RoomCache()
+
+
+def broadcast_invalidation(group_names):
+    """
+    Drop rooms here right away and tell the other processes through each
+    room's channel group. Runs after the change is committed.
+    """
+    token = uuid.uuid4().hex
+    channel_layer = get_channel_layer()
+    for group_name in group_names:
+        room_cache.invalidate(group_name, token)
+        async_to_sync(channel_layer.group_send)(group_name, {
+            'type': 'room_cache_handler',
+            'room': group_name,
+            'token': token,
+        })
@@ -0,0 +1,195 @@
+"""
+Full-text search over message bodies.
+
+The index lives in the database and is kept up to date by the database
+itself, so messages saved any way (save(), bulk_create from the
+write-behind, deletes cascading from a room) are searchable as soon as
+they are committed:
+
+    sqlite      an FTS5 table over GroupMessage with triggers on insert,
+                update and delete
+    postgresql  a GIN index on to_tsvector('simple', body)
+
+Both are created by install_index() after migrate. Neither stems words,
+so a query matches the same messages in development and production.
+
+A search is only ever run over rooms the user can read, and the room ids
+go into the index query itself: FTS5 matches them as tokens of its
+group_id column, Postgres ANDs the GIN index with the group's. Results
+come newest first, a page at a time, with the matched words marked in a
+snippet of the body.
+"""
+import re
+from django.db import connection, connections
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from .models import *
+from .membership import get_membership
+
+PAGE_SIZE = 20
+# words kept from a query, more only make it slower
+MAX_TERMS = 8
+# the last word is matched as a prefix while it is this long, which the
+# prefix index answers, longer words are matched whole
+PREFIX_LENGTHS = (3, 4)
+
+# what the backends mark matched words with, before the snippet is escaped
+START, STOP = '\x02', '\x03'
+
+
+def query_terms(query):
+    """ The words of a query, the only part of it the backends see. """
+    return [term.lower() for term in re.findall(r'\w+', query or '')][:MAX_TERMS]
+
+
+def readable_rooms(user):
+    """ Ids of the rooms ``user`` can read, their own and the public ones. """
+    public = ChatGroup.objects.filter(Q(groupchat_name__isnull=True) | Q(groupchat_name=''), is_private=False)
+    return sorted(get_membership().rooms(user.id) | set(public.values_list('id', flat=True)))
+
+
+def highlight(snippet):
+    """ The snippet as html, with the matched words in <mark>. """
+    marked = re.sub(f'{START}(.*?){STOP}', r'<mark>\1</mark>', escape(snippet or ''), flags=re.S)
+    return mark_safe(marked.replace(START, '').replace(STOP, ''))
+
+
+class SqliteSearch:
+    table = 'a_rtchat_groupmessage_fts'
+
+    def install(self, cursor):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [self.table])
+        if cursor.fetchone():
+            return
+        # external content, the bodies are only stored once. Without the
+        # prefix index a prefix reads the lists of every word it starts
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE {self.table} USING fts5("
+            "body, group_id, content='a_rtchat_groupmessage', content_rowid='id', "
+            f"tokenize='unicode61 remove_diacritics 2', prefix='{' '.join(map(str, PREFIX_LENGTHS))}')"
+        )
+        cursor.execute(
+            f"CREATE TRIGGER {self.table}_insert AFTER INSERT ON a_rtchat_groupmessage BEGIN "
+            f"INSERT INTO {self.table}(rowid, body, group_id) VALUES (new.id, new.body, new.group_id); END"
+        )
+        cursor.execute(
+            f"CREATE TRIGGER {self.table}_delete AFTER DELETE ON a_rtchat_groupmessage BEGIN "
+            f"INSERT INTO {self.table}({self.table}, rowid, body, group_id) VALUES ('delete', old.id, old.body, old.group_id); END"
+        )
+        cursor.execute(
+            f"CREATE TRIGGER {self.table}_update AFTER UPDATE OF body, group_id ON a_rtchat_groupmessage BEGIN "
+            f"INSERT INTO {self.table}({self.table}, rowid, body, group_id) VALUES ('delete', old.id, old.body, old.group_id); "
+            f"INSERT INTO {self.table}(rowid, body, group_id) VALUES (new.id, new.body, new.group_id); END"
+        )
+        # messages from before the index existed
+        cursor.execute(f"INSERT INTO {self.table}({self.table}) VALUES ('rebuild')")
+
+    def match(self, terms, room_ids):
+        words = [f'"{term}"' for term in terms]
+        if len(terms[-1]) in PREFIX_LENGTHS:
+            words[-1] += '*'
+        rooms = ' OR '.join(f'"{room_id}"' for room_id in room_ids)
+        return f"group_id:({rooms}) AND body:({' '.join(words)})"
+
+    def search(self, terms, room_ids, before, limit):
+        sql = (
+            f"SELECT rowid, snippet({self.table}, 0, %s, %s, '…', 16) FROM {self.table} "
+            f"WHERE {self.table} MATCH %s AND rowid < %s ORDER BY rowid DESC LIMIT %s"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [START, STOP, self.match(terms, room_ids), before, limit])
+            return cursor.fetchall()
+
+
+class PostgresSearch:
+    index = 'groupmessage_search_idx'
+    # must be the indexed expression exactly, or the planner won't use it
+    document = "to_tsvector('simple', coalesce(body, ''))"
+
+    def install(self, cursor):
+        # on a large table, create it CONCURRENTLY by hand before migrating
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.index} ON a_rtchat_groupmessage USING gin (({self.document}))")
+
+    def tsquery(self, terms):
+        # a prefix merges the GIN lists of every word it starts
+        words = list(terms)
+        if len(words[-1]) in PREFIX_LENGTHS:
+            words[-1] += ':*'
+        return ' & '.join(words)
+
+    def search(self, terms, room_ids, before, limit):
+        # headlines are expensive, only the page gets them
+        sql = (
+            "WITH page AS ("
+            f"SELECT id, body FROM a_rtchat_groupmessage WHERE {self.document} @@ to_tsquery('simple', %s) "
+            "AND group_id = ANY(%s) AND id < %s ORDER BY id DESC LIMIT %s"
+            ") SELECT id, ts_headline('simple', coalesce(body, ''), to_tsquery('simple', %s), %s) FROM page ORDER BY id DESC"
+        )
+        tsquery = self.tsquery(terms)
+        options = f'StartSel="{START}", StopSel="{STOP}", MaxWords=24, MinWords=12, MaxFragments=1'
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [tsquery, list(room_ids), before, limit, tsquery, options])
+            return cursor.fetchall()
+
+
+class ScanSearch:
+    """ Unindexed, for databases with neither of the above. """
+    def install(self, cursor):
+        pass
+
+    def search(self, terms, room_ids, before, limit):
+        messages = GroupMessage.objects.filter(group_id__in=room_ids, id__lt=before)
+        for term in terms:
+            messages = messages.filter(body__icontains=term)
+        pattern = re.compile('|'.join(re.escape(term) for term in terms), re.I)
+        return [
+            (message_id, pattern.sub(lambda match: f'{START}{match.group()}{STOP}', body))
+            for message_id, body in messages.order_by('-id').values_list('id', 'body')[:limit]
+        ]
+
+
+def get_search(vendor=None):
+    vendor = vendor or connection.vendor
+    if vendor == 'sqlite':
+        return SqliteSearch()
+    if vendor == 'postgresql':
+        return PostgresSearch()
+    return ScanSearch()
+
+
+def install_index(using='default', **kwargs):
+    """ post_migrate receiver, creating the index is a no-op once it exists. """
+    with connections[using].cursor() as cursor:
+        get_search(connections[using].vendor).install(cursor)
+
+
+def search_messages(user, query, chat_group=None, before=None, limit=PAGE_SIZE):
+    """
+    Up to ``limit`` messages matching ``query`` in ``chat_group``, or in
+    every room ``user`` can read, older than the ``before`` message id.
+    Returns them newest first with a ``snippet`` each, and the cursor for
+    the next page or None on the last one. ``before`` that isn't an id
+    raises ValueError.
+    """
+    terms = query_terms(query)
+    room_ids = [chat_group.id] if chat_group else readable_rooms(user)
+    if not terms or not room_ids:
+        return [], None
+    before = int(before) if before else 2 ** 63 - 1
+
+    rows = get_search().search(terms, room_ids, before, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][0]
+    # in the index's order, a message deleted since is left out. Unordered,
+    # the lookup would sort the page for nothing
+    messages = GroupMessage.objects.select_related('author__profile', 'group').order_by().in_bulk([message_id for message_id, snippet in rows])
+    page = []
+    for message_id, snippet in rows:
+        if message_id in messages:
+            message = messages[message_id]
+            message.snippet = highlight(snippet)
+            page.append(message)
+    return page, next_cursor
@@ -0,0 +1,129 @@
+from django.dispatch import receiver
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete, m2m_changed
+from django.contrib.auth.models import User
+from a_users.models import Profile
+from .models import *
+from .derivatives import *
+from .membership import get_membership
+from .roomcache import broadcast_invalidation
+from .unread import open_cursors
+
+
+@receiver(post_save, sender=GroupMessage)
+def message_postsave(sender, instance, created, **kwargs):
+    if created and instance.is_image:
+        transaction.on_commit(lambda: get_pipeline().schedule(instance, 'file', 'file_variants', CHAT_IMAGE_WIDTHS))
+
+
+@receiver(post_delete, sender=GroupMessage)
+def message_postdelete(sender, instance, **kwargs):
+    delete_variants(instance.file_variants)
+
+
+@receiver(pre_save, sender=Profile)
+def profile_presave(sender, instance, **kwargs):
+    # a new avatar makes the old variants stale
+    if instance.pk is None:
+        return
+    old = Profile.objects.filter(pk=instance.pk).values('image', 'image_variants').first()
+    if old and old['image'] != instance.image.name:
+        delete_variants(old['image_variants'])
+        instance.image_variants = {}
+
+
+@receiver(post_save, sender=Profile)
+def profile_postsave(sender, instance, **kwargs):
+    if instance.image and not instance.image_variants:
+        transaction.on_commit(lambda: get_pipeline().schedule(instance, 'image', 'image_variants', AVATAR_WIDTHS))
+    invalidate_user_rooms(instance.user_id)
+
+
+@receiver(post_delete, sender=Profile)
+def profile_postdelete(sender, instance, **kwargs):
+    delete_variants(instance.image_variants)
+
+
+# room cache, see a_rtchat.roomcache
+
+def invalidate_rooms(group_names):
+    group_names = list(group_names)
+    if group_names:
+        transaction.on_commit(lambda: broadcast_invalidation(group_names))
+
+
+def invalidate_user_rooms(user_id):
+    # the user's own rooms, and public rooms where anyone can be shown
+    rooms = ChatGroup.objects.filter(
+        Q(members=user_id) | Q(is_private=False, groupchat_name__isnull=True) | Q(is_private=False, groupchat_name='')
+    ).values_list('group_name', flat=True).distinct()
+    invalidate_rooms(rooms)
+
+
+@receiver(post_save, sender=ChatGroup)
+@receiver(post_delete, sender=ChatGroup)
+def chatgroup_changed(sender, instance, created=False, **kwargs):
+    if not created:
+        invalidate_rooms([instance.group_name])
+
+
+@receiver(m2m_changed, sender=ChatGroup.members.through)
+def members_cursors(sender, instance, action, reverse, pk_set, **kwargs):
+    # read cursors, see a_rtchat.unread
+    if action == 'post_add':
+        group_ids, user_ids = (pk_set, [instance.id]) if reverse else ([instance.id], pk_set)
+        open_cursors(group_ids, user_ids)
+    elif action == 'post_remove':
+        group_ids, user_ids = (pk_set, [instance.id]) if reverse else ([instance.id], pk_set)
+        ReadCursor.objects.filter(group_id__in=group_ids, user_id__in=user_ids).delete()
+    elif action == 'post_clear' and reverse:
+        # their public chat cursor isn't a membership
+        ReadCursor.objects.filter(Q(group__is_private=True) | Q(group__groupchat_name__gt=''), user=instance).delete()
+    elif action == 'post_clear':
+        ReadCursor.objects.filter(group=instance).delete()
+
+
+# membership cache, see a_rtchat.membership
+
+def membership_changed(user_ids):
+    user_ids = list(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: get_membership().changed(user_ids))
+
+
+@receiver(m2m_changed, sender=ChatGroup.members.through)
+def members_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        membership_changed([instance.id])
+    elif action in ('post_add', 'post_remove'):
+        membership_changed(pk_set)
+    elif action == 'pre_clear' and not reverse:
+        # the members are gone by post_clear
+        membership_changed(instance.members.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=ChatGroup)
+def chatgroup_predelete(sender, instance, **kwargs):
+    # the memberships cascade without m2m_changed
+    membership_changed(instance.members.values_list('id', flat=True))
+
+
+@receiver(m2m_changed, sender=ChatGroup.members.through)
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # a user leaving all their rooms, find them while they're still there
+        invalidate_user_rooms(instance.id)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            invalidate_rooms([instance.group_name])
+        elif pk_set:
+            invalidate_rooms(ChatGroup.objects.filter(pk__in=pk_set).values_list('group_name', flat=True))
+
+
+@receiver(post_save, sender=User)
+def user_postsave(sender, instance, created, update_fields=None, **kwargs):
+    # logins only touch last_login, which no fragment shows
+    if created or update_fields == frozenset(['last_login']):
+        return
+    invalidate_user_rooms(instance.id)
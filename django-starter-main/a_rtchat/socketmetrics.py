@@ -0,0 +1,74 @@
+"""
+Counts of what the chat sockets send: frames, raw bytes and the bytes
+left after permessage-deflate, per consumer and per event the consumer
+was handling when the frame went out. Served by chat_metrics_view.
+
+Compressed sizes come from the DeflateMeter on the sampled fraction of
+deflate sockets (see a_rtchat.deflate), and sockets without deflate
+count their raw size. measured_bytes is the raw size of the frames whose
+compressed size is known, and the ratio is taken over those. The counts
+belong to the process, every worker keeps its own.
+"""
+import threading
+from collections import Counter, defaultdict
+from .deflate import deflate_offered, meter_for
+
+
+class SocketMetrics:
+    def __init__(self):
+        self.counts = defaultdict(Counter)
+        self.sockets_opened = Counter()
+        # recorded on the event loop, read from the metrics view's thread
+        self.lock = threading.Lock()
+
+    def opened(self, consumer, compressed, metered):
+        with self.lock:
+            self.sockets_opened[consumer] += 1
+            if compressed:
+                self.sockets_opened[f'{consumer}.deflate'] += 1
+            if metered:
+                self.sockets_opened[f'{consumer}.metered'] += 1
+
+    def record(self, consumer, event, raw, compressed):
+        """ compressed is None when the socket deflates but isn't metered. """
+        with self.lock:
+            counts = self.counts[consumer, event]
+            counts['frames'] += 1
+            counts['raw_bytes'] += raw
+            if compressed is not None:
+                counts['measured_bytes'] += raw
+                counts['compressed_bytes'] += compressed
+
+    def stats(self):
+        with self.lock:
+            consumers = {}
+            for (consumer, event), counts in sorted(self.counts.items()):
+                consumers.setdefault(consumer, {})[event] = {
+                    **counts,
+                    'ratio': round(counts['compressed_bytes'] / counts['measured_bytes'], 3) if counts['measured_bytes'] else None,
+                }
+            return {'sockets_opened': dict(self.sockets_opened), 'consumers': consumers}
+
+
+socket_metrics = SocketMetrics()
+
+
+class SocketMetricsMixin:
+    """ Counts every frame a consumer sends, see socket_metrics. """
+    async def dispatch(self, message):
+        if not hasattr(self, 'deflate_meter'):
+            self.deflated = bool(deflate_offered(self.scope))
+            self.deflate_meter = meter_for(self.scope) if self.deflated else None
+            socket_metrics.opened(type(self).__name__, self.deflated, self.deflate_meter is not None)
+        self.current_event = message['type']
+        await super().dispatch(message)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        data = bytes_data if bytes_data is not None else text_data.encode() if text_data is not None else None
+        if data is not None:
+            if self.deflate_meter:
+                compressed = self.deflate_meter.size(data)
+            else:
+                compressed = None if self.deflated else len(data)
+            socket_metrics.record(type(self).__name__, self.current_event, len(data), compressed)
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
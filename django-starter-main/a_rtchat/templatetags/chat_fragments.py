@@ -0,0 +1,15 @@
+from django import template
+from a_rtchat.fragments import render_messages
+
+register = template.Library()
+
+
+@register.filter
+def message_fragments(messages):
+    """ The cached chat_message.html of each message, see a_rtchat.fragments """
+    return render_messages(messages)
+
+
+@register.filter
+def message_fragment(message):
+    return render_messages([message])[0]
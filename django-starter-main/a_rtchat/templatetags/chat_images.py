@@ -0,0 +1,9 @@
+from django import template
+from a_rtchat import derivatives
+
+register = template.Library()
+
+
+@register.filter
+def srcset(variants, format='webp'):
+    return derivatives.srcset(variants, format)
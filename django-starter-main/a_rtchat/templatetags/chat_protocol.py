@@ -0,0 +1,10 @@
+from django import template
+from django.conf import settings
+
+register = template.Library()
+
+
+@register.simple_tag
+def client_rendering():
+    """ Whether pages render websocket events themselves, see a_rtchat.protocols """
+    return getattr(settings, 'CHAT_CLIENT_RENDERING', False)
@@ -0,0 +1,1065 @@
+import asyncio
+import json
+import os
+import tempfile
+import tracemalloc
+from concurrent.futures import Future
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from PIL import Image
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import DataError, OperationalError, connection
+from django.template.loader import render_to_string
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import resolve, reverse
+from django.utils import timezone
+from a_rtchat import deflate, fragments, membership, protocols, routing, uploads, writebehind
+from a_rtchat.backpressure import BackpressureMixin, EventQueue
+from a_rtchat.bench import cleanup, disable_rate_limit, seed_rooms, seed_users
+from a_rtchat.broadcast import Coalescer
+from a_rtchat.derivatives import DerivativePipeline
+from a_rtchat.history import history_page, messages_after
+from a_rtchat.imaging import render_variants
+from a_rtchat.management.commands.chat_queryplans import Command as QueryPlanCommand
+from a_rtchat.membership import MembershipCache, can_read
+from a_rtchat.models import ArchivedMessages, ChatGroup, ChatUpload, GroupMessage, ReadCursor
+from a_rtchat.presence import RedisPresence, get_presence
+from a_rtchat.queryplans import format_plan, planned_queries
+from a_rtchat.querycount import QueryBudgetExceeded, count_queries, query_budget
+from a_rtchat.ratelimit import InMemoryRateLimit
+from a_rtchat.retention import archive_room, delete_room
+from a_rtchat.roomcache import RoomCache, RoomContext, room_cache
+from a_rtchat.search import ScanSearch
+from a_rtchat.socketmetrics import SocketMetrics
+from a_rtchat.unread import mark_read, unread_counts
+from a_rtchat.uploads import BLOCK_SIZE, ChunkSizeLimit, write_chunk
+from a_rtchat.writebehind import MessageWriter, recover, save_messages, valid_body
+
+
+class FreshCaches:
+    """ The process's caches outlive each test's rollback, and the ids in them get reused. """
+    def setUp(self):
+        super().setUp()
+        membership._membership = None
+        fragments._fragments = None
+        for group_name in list(room_cache.rooms):
+            room_cache.invalidate(group_name)
+
+
+def make_room(name, users, messages=0):
+    room = ChatGroup.objects.create(group_name=name, groupchat_name=name)
+    for i in range(messages):
+        GroupMessage.objects.create(group=room, author=users[i % len(users)], body=f'message {i}')
+    room.members.add(*users)
+    room_cache.invalidate(name)
+    return room
+
+
+async def open_socket(path, user, subprotocols=None):
+    communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), path, subprotocols=subprotocols)
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+async def drain(communicator, wait=0.3):
+    """ The frames a socket gets until it has been quiet for ``wait`` seconds. """
+    frames = []
+    while not await communicator.receive_nothing(wait):
+        output = await communicator.receive_output()
+        frames.append(output.get('text') or output.get('bytes'))
+    return frames
+
+
+class QueryBudgetTests(TestCase):
+    def test_counts_duplicates(self):
+        with count_queries('users') as scope:
+            for i in range(3):
+                User.objects.filter(id=i).exists()
+        self.assertEqual(scope.count, 3)
+        self.assertEqual(scope.duplicates, 2)
+
+    def test_over_budget_fails(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(1, 'users'):
+                list(User.objects.all())
+                list(User.objects.all())
+
+    def test_scopes_are_logged(self):
+        with self.assertLogs('a_rtchat.querycount.scopes', 'INFO') as logs:
+            with count_queries('users'):
+                list(User.objects.all())
+        self.assertEqual(json.loads(logs.records[0].getMessage())['label'], 'users')
+
+
+    def test_report_reads_rotated_logs(self):
+        path = os.path.join(tempfile.mkdtemp(), 'querycount.jsonl')
+        for name, queries in ((path + '.1', 4), (path, 6)):
+            with open(name, 'w') as log:
+                log.write(json.dumps({'label': 'chat_view', 'queries': queries, 'duplicates': 0, 'worst': []}) + '\n')
+        out = StringIO()
+        with override_settings(QUERY_COUNT_LOG=path, QUERY_COUNT_LOG_BACKUPS=2):
+            call_command('query_report', clear=True, stdout=out)
+        self.assertRegex(out.getvalue(), r'chat_view\s+2\s+5.0\s+6')
+        self.assertFalse(os.path.exists(path + '.1'))
+
+
+class ChatViewQueryTests(FreshCaches, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username=f'viewer-{i}') for i in range(3)]
+        cls.room = make_room('view-room', cls.users, messages=40)
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.users[0])
+
+    def test_chat_view_within_budget(self):
+        url = reverse('chatroom', args=[self.room.group_name])
+        with query_budget(settings.QUERY_BUDGETS['chat_view'], 'chat_view'):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_chat_view_doesnt_grow_with_authors(self):
+        # one more author mustn't cost one more query per message
+        url = reverse('chatroom', args=[self.room.group_name])
+        with count_queries('chat_view') as before:
+            self.client.get(url)
+        author = User.objects.create(username='viewer-new')
+        self.room.members.add(author)
+        GroupMessage.objects.create(group=self.room, author=author, body='hello')
+        room_cache.invalidate(self.room.group_name)
+        with count_queries('chat_view') as after:
+            self.client.get(url)
+        self.assertLessEqual(after.count, before.count)
+
+
+class HistoryTests(FreshCaches, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='reader')
+        self.room = make_room('history-room', [self.user])
+        # one timestamp for all, the pages are told apart by id
+        created = timezone.now()
+        GroupMessage.objects.bulk_create([
+            GroupMessage(group=self.room, author=self.user, body=f'message {i}', created=created) for i in range(70)
+        ])
+        self.client.force_login(self.user)
+
+    def test_pages_cover_the_room_once(self):
+        url = reverse('chatroom-history', args=[self.room.group_name])
+        ids, sizes, cursor = [], [], None
+        while True:
+            data = self.client.get(url, {'format': 'json', **({'before': cursor} if cursor else {})}).json()
+            ids += [message['id'] for message in data['messages']]
+            sizes.append(len(data['messages']))
+            cursor = data['next']
+            if cursor is None:
+                break
+        self.assertEqual(sizes, [30, 30, 10])
+        self.assertEqual(ids, sorted(self.room.chat_messages.values_list('id', flat=True), reverse=True))
+
+    def test_bad_cursor_is_refused(self):
+        url = reverse('chatroom-history', args=[self.room.group_name])
+        self.assertEqual(self.client.get(url, {'before': 'not-a-cursor'}).status_code, 400)
+
+
+class ChatViewConstantQueryTests(FreshCaches, TestCase):
+    def test_a_full_page_of_authors_costs_no_more(self):
+        viewer = User.objects.create(username='viewer')
+        authors = [User.objects.create(username=f'author-{i}') for i in range(30)]
+        quiet = make_room('quiet-room', [viewer, authors[0]], messages=2)
+        busy = make_room('busy-room', [viewer, *authors], messages=30)
+        self.client.force_login(viewer)
+        # the first view loads the viewer's rooms into the membership cache
+        self.client.get(reverse('chatroom', args=[quiet.group_name]))
+        counts = []
+        for room in (quiet, busy):
+            with count_queries('chat_view') as scope:
+                response = self.client.get(reverse('chatroom', args=[room.group_name]))
+            self.assertEqual(response.status_code, 200)
+            counts.append(scope.count)
+        self.assertEqual(counts[0], counts[1])
+        self.assertContains(response, 'author-29')
+
+
+class ChatConsumerQueryTests(FreshCaches, TransactionTestCase):
+    # the consumer queries from database_sync_to_async threads, which
+    # don't see a TestCase's open transaction
+
+    def setUp(self):
+        super().setUp()
+        disable_rate_limit()
+        self.users = [User.objects.create(username=f'sender-{i}') for i in range(2)]
+        self.room = make_room('consumer-room', self.users)
+
+    def tearDown(self):
+        room_cache.invalidate(self.room.group_name)
+
+    def test_receive_within_budget(self):
+        label = 'ChatroomConsumer.websocket.receive'
+        with self.assertLogs('a_rtchat.querycount.scopes', 'INFO') as logs:
+            async_to_sync(self.send_messages)(3)
+        counts = [entry['queries'] for entry in map(json.loads, (record.getMessage() for record in logs.records)) if entry['label'] == label]
+        self.assertEqual(len(counts), 3)
+        self.assertLessEqual(max(counts), settings.QUERY_BUDGETS[label])
+        # the first message pays for the cache misses, the rest mustn't add to it
+        self.assertLessEqual(counts[-1], counts[0])
+
+    async def send_messages(self, count):
+        communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), f'/ws/chatroom/{self.room.group_name}')
+        communicator.scope['user'] = self.users[0]
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        for i in range(count):
+            await communicator.send_to(text_data=json.dumps({'body': f'hello {i}'}))
+            while not await communicator.receive_nothing(0.2):
+                await communicator.receive_output()
+        await communicator.disconnect()
+
+
+class MessageFanOutTests(FreshCaches, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        disable_rate_limit()
+        self.users = [User.objects.create(username=f'reader-{i}') for i in range(3)]
+        self.room = make_room('fanout-room', self.users)
+
+    def tearDown(self):
+        room_cache.invalidate(self.room.group_name)
+
+    def test_rendered_once_for_every_socket(self):
+        with mock.patch('a_rtchat.broadcast.render_to_string', wraps=render_to_string) as render:
+            received = async_to_sync(self.send_to_room)('hello all')
+        templates = [call.args[0] for call in render.call_args_list]
+        self.assertEqual(templates.count('a_rtchat/partials/chat_message_p.html'), 1)
+        for frames in received:
+            self.assertTrue(any('hello all' in frame for frame in frames))
+
+    async def send_to_room(self, body):
+        sockets = [await open_socket(f'/ws/chatroom/{self.room.group_name}', user) for user in self.users]
+        for socket in sockets:
+            await drain(socket)
+        await sockets[0].send_to(text_data=json.dumps({'body': body}))
+        received = [await drain(socket) for socket in sockets]
+        for socket in sockets:
+            await socket.disconnect()
+        return received
+
+
+class OnlineStatusTests(FreshCaches, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [User.objects.create(username=f'status-{i}') for i in range(2)]
+        self.room = make_room('status-room', self.users)
+
+    def tearDown(self):
+        room_cache.invalidate(self.room.group_name)
+
+    def test_sends_only_flips(self):
+        events = async_to_sync(self.open_room_twice)()
+        self.assertEqual(events[0]['t'], 'status')
+        self.assertEqual(events[0]['active_chats'], [])
+        statuses = [event for event in events if event['t'] == 'chat_status']
+        # a second tab and the first tab closing change nothing
+        self.assertEqual(
+            [(event['room'], event['active']) for event in statuses],
+            [('status-room', True), ('status-room', False)],
+        )
+
+    async def open_room_twice(self):
+        status = await open_socket('/ws/online-status/', self.users[0], [protocols.JSON])
+        events = await drain(status)
+        room_path = f'/ws/chatroom/{self.room.group_name}'
+        tabs = [await open_socket(room_path, self.users[1]) for i in range(2)]
+        events += await drain(status)
+        for tab in tabs:
+            await tab.disconnect()
+            events += await drain(status)
+        await status.disconnect()
+        return [json.loads(frame) for frame in events]
+
+
+class ResumeTests(FreshCaches, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [User.objects.create(username=f'resume-{i}') for i in range(2)]
+        self.room = make_room('resume-room', self.users, messages=5)
+        self.ids = list(self.room.chat_messages.order_by('created', 'id').values_list('id', flat=True))
+
+    def tearDown(self):
+        room_cache.invalidate(self.room.group_name)
+
+    def test_missed_messages_and_presence(self):
+        data = async_to_sync(self.resume)(self.ids[1])
+        self.assertFalse(data['replace'])
+        self.assertEqual([message['id'] for message in data['messages']], self.ids[:1:-1])
+        self.assertEqual(data['presence']['online'], [self.users[0].id])
+        self.assertEqual(data['presence']['count'], 0)
+
+    def test_unknown_message_gets_the_latest_page(self):
+        data = async_to_sync(self.resume)(0)
+        self.assertTrue(data['replace'])
+        self.assertEqual([message['id'] for message in data['messages']], self.ids[::-1])
+        self.assertIsNone(data['next'])
+
+    def test_too_far_behind_is_none(self):
+        self.assertEqual([message.id for message in messages_after(self.room, self.ids[0], limit=4)], self.ids[:0:-1])
+        self.assertIsNone(messages_after(self.room, self.ids[0], limit=3))
+
+    async def resume(self, message_id):
+        socket = await open_socket(f'/ws/chatroom/{self.room.group_name}', self.users[0], [protocols.JSON])
+        await drain(socket)
+        await socket.send_to(text_data=json.dumps({'resume': message_id}))
+        events = [json.loads(frame) for frame in await drain(socket)]
+        await socket.disconnect()
+        return next(event for event in events if event['t'] == 'resume')
+
+
+class PresenceViewTests(FreshCaches, TestCase):
+    def test_only_readable_rooms(self):
+        ana, bo = [User.objects.create(username=name) for name in ('ana', 'bo')]
+        shared = make_room('shared-room', [ana, bo])
+        hidden = make_room('hidden-room', [bo])
+        presence = get_presence()
+        for room in (shared, hidden):
+            presence.join(room.group_name, bo.id, 'tab')
+            self.addCleanup(presence.leave, room.group_name, bo.id, 'tab')
+        self.client.force_login(ana)
+        data = self.client.get(reverse('chat-presence'), {'room': ['shared-room', 'hidden-room']}).json()
+        self.assertEqual(data['rooms'], {'shared-room': {'count': 1, 'online': [bo.id]}})
+
+
+class QueryPlanTests(FreshCaches, TestCase):
+    """ chat_queryplans on a small dataset, so manage.py test catches a scan. """
+    def test_planned_queries_use_indexes(self):
+        self.addCleanup(cleanup)
+        # enough users that the online list is a small share of them,
+        # with a few dozen the planner is right to scan the profiles
+        scenarios = QueryPlanCommand().seed({'messages': 300, 'users': 500, 'rooms': 30})
+        problems = [
+            '\n'.join([f'[{name}] {sql}', *format_plan(plan), *found])
+            for name, sql, plan, found in planned_queries(scenarios) if found
+        ]
+        self.assertEqual(problems, [], '\n\n'.join(problems))
+
+
+class LoadTestCommandTests(FreshCaches, TransactionTestCase):
+    def test_runs_baseline_and_consumer(self):
+        out = StringIO()
+        call_command('chat_loadtest', rooms=2, clients=3, messages=3, timeout=5, stdout=out)
+        output = out.getvalue()
+        self.assertIn('SyncChatroomConsumer', output)
+        self.assertIn('a_rtchat.consumers.ChatroomConsumer', output)
+        self.assertIn('x the baseline', output)
+        self.assertNotIn('missing deliveries', output)
+
+
+class RoomCacheTests(FreshCaches, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='member')
+        make_room('cached-room', [self.user])
+        self.cache = RoomCache()
+
+    def test_kept_while_held(self):
+        self.cache.get('cached-room')
+        self.assertNotIn('cached-room', self.cache.rooms)
+        self.cache.acquire('cached-room', self.user)
+        self.cache.acquire('cached-room', self.user)
+        self.cache.release('cached-room')
+        self.assertIn('cached-room', self.cache.rooms)
+        self.cache.release('cached-room')
+        self.assertNotIn('cached-room', self.cache.rooms)
+
+    def test_load_racing_an_invalidation_isnt_stored(self):
+        load = RoomContext.load
+
+        def invalidated_meanwhile(group_name):
+            room = load(group_name)
+            self.cache.invalidate(group_name)
+            return room
+
+        with mock.patch.object(RoomContext, 'load', invalidated_meanwhile):
+            self.cache.acquire('cached-room', self.user)
+        self.assertNotIn('cached-room', self.cache.rooms)
+        self.cache.get('cached-room')
+        self.assertIn('cached-room', self.cache.rooms)
+
+    def test_each_token_invalidates_once(self):
+        self.cache.acquire('cached-room', self.user)
+        self.cache.invalidate('cached-room', 'token')
+        self.cache.get('cached-room')
+        # the same broadcast heard by a second consumer
+        self.cache.invalidate('cached-room', 'token')
+        self.assertIn('cached-room', self.cache.rooms)
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+
+class MembershipCacheTests(FreshCaches, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='joiner')
+        self.room = make_room('club-room', [])
+        self.cache = membership.get_membership()
+
+    def test_second_lookup_is_a_hit(self):
+        self.cache.rooms(self.user.id)
+        with self.assertNumQueries(0):
+            self.assertFalse(self.cache.is_member(self.user.id, self.room.id))
+        self.assertEqual(self.cache.stats(), {'misses': 1, 'hits': 1})
+
+    def test_changes_from_either_side(self):
+        self.assertFalse(can_read(self.user, self.room))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.members.add(self.user)
+        self.assertTrue(can_read(self.user, self.room))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.chat_groups.remove(self.room)
+        self.assertFalse(can_read(self.user, self.room))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.chat_groups.add(self.room)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.members.clear()
+        self.assertFalse(can_read(self.user, self.room))
+
+    def test_raced_load_isnt_served(self):
+        cache = MembershipCache()
+        cache.rooms(self.user.id)
+        self.room.members.add(self.user)
+        cache.changed([self.user.id])
+        # a load that started before the change writes the old rooms late
+        cache.client.set(cache.rooms_key(self.user.id), '0:', ex=60)
+        self.assertTrue(cache.is_member(self.user.id, self.room.id))
+
+    def test_public_rooms_are_open(self):
+        public = ChatGroup.objects.create(group_name='open-room')
+        with self.assertNumQueries(0):
+            self.assertTrue(can_read(self.user, public))
+
+
+class BenchCleanupTests(TestCase):
+    def test_deletes_only_what_it_seeded(self):
+        real_user = User.objects.create(username='bench-user-0')
+        real_room = ChatGroup.objects.create(group_name='bench-room-0')
+        users = seed_users(2)
+        rooms = seed_rooms(2, members=users)
+        cleanup()
+        self.assertTrue(User.objects.filter(id=real_user.id).exists())
+        self.assertTrue(ChatGroup.objects.filter(id=real_room.id).exists())
+        self.assertFalse(User.objects.filter(id__in=[user.id for user in users]).exists())
+        self.assertFalse(ChatGroup.all_objects.filter(id__in=[room.id for room in rooms]).exists())
+
+
+class BlockStream:
+    """ ``size`` bytes that only exist a read at a time. """
+    def __init__(self, size):
+        self.left = size
+
+    def read(self, count):
+        count = min(count, self.left)
+        self.left -= count
+        return b'x' * count
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), CHAT_UPLOAD_DIR=None, CHAT_UPLOAD_CHUNK_SIZE=4)
+class ChunkedUploadTests(FreshCaches, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username=f'uploader-{i}') for i in range(2)]
+        cls.room = make_room('upload-room', cls.users)
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.users[0])
+        response = self.client.post(reverse('chat-upload-start', args=[self.room.group_name]), {'filename': 'notes.txt', 'size': 6})
+        self.url = reverse('chat-upload-chunk', args=[self.room.group_name, response.json()['upload']])
+
+    def put(self, data, offset):
+        return self.client.put(self.url, data, content_type='application/octet-stream', headers={'Upload-Offset': str(offset)})
+
+    def test_finishes_once(self):
+        self.assertEqual(self.put(b'abcd', 0).json()['offset'], 4)
+        self.assertEqual(self.put(b'ef', 4).status_code, 201)
+        # a retried or empty request at the end mustn't finish it again
+        self.assertEqual(self.put(b'', 6).status_code, 404)
+        self.assertEqual(GroupMessage.objects.filter(group=self.room).count(), 1)
+
+    def test_removed_member_cant_continue(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.members.remove(self.users[0])
+        self.assertEqual(self.put(b'abcd', 0).status_code, 404)
+        self.assertEqual(ChatUpload.objects.get().received, 0)
+
+    def test_no_transaction_while_writing(self):
+        depth = len(connection.atomic_blocks)
+        seen = []
+
+        def watched(*args):
+            seen.append(len(connection.atomic_blocks))
+            return write_chunk(*args)
+
+        with mock.patch('a_rtchat.views.write_chunk', watched):
+            self.put(b'abcd', 0)
+        self.assertEqual(seen, [depth])
+
+    def test_claimed_chunk_is_refused(self):
+        upload = ChatUpload.objects.get()
+        uploads.claim_chunk(upload, 0, 4)
+        self.assertEqual(self.put(b'abcd', 0).status_code, 409)
+
+    def test_memory_stays_within_blocks(self):
+        # a chunk of 64 blocks is streamed a block at a time
+        upload = ChatUpload.objects.get()
+        size = 64 * BLOCK_SIZE
+        upload.size = size
+        tracemalloc.start()
+        try:
+            write_chunk(upload, 0, BlockStream(size), size)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 4 * BLOCK_SIZE)
+        self.assertEqual(os.path.getsize(uploads.partial_path(upload)), size)
+
+    def test_oversized_chunk_refused_before_body(self):
+        async def receive():
+            raise AssertionError('the body was read')
+
+        async def app(scope, receive, send):
+            raise AssertionError('the request reached Django')
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'PUT', 'path': self.url, 'headers': [(b'content-length', b'5')]}
+        async_to_sync(ChunkSizeLimit(app))(scope, receive, send)
+        self.assertEqual(sent[0]['status'], 413)
+
+
+class InlinePool:
+    """ Runs the resizing in the test's thread instead of a worker process. """
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+@mock.patch('a_rtchat.derivatives.close_old_connections', lambda: None)
+class DerivativeTests(FreshCaches, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(override_settings(MEDIA_ROOT=tempfile.mkdtemp()))
+        user = User.objects.create(username='photographer')
+        room = make_room('photo-room', [user])
+        image = BytesIO()
+        Image.new('RGB', (800, 400), 'teal').save(image, 'PNG')
+        self.message = GroupMessage(group=room, author=user)
+        self.message.file.save('photo.png', ContentFile(image.getvalue()), save=False)
+        self.message.read_file_metadata()
+        self.message.save()
+        self.pipeline = DerivativePipeline()
+        self.pipeline.pool = InlinePool()
+
+    def run_pipeline(self):
+        self.pipeline.run(GroupMessage, self.message.pk, 'file', 'file_variants', (320, 640, 1280))
+        self.message.refresh_from_db()
+
+    def test_narrower_copies_are_recorded(self):
+        self.run_pipeline()
+        variants = self.message.file_variants
+        self.assertEqual({format: sorted(names, key=int) for format, names in variants.items()}, {
+            'webp': ['320', '640'], 'jpeg': ['320', '640'],
+        })
+        with default_storage.open(variants['jpeg']['320']) as file:
+            self.assertEqual(Image.open(file).size, (320, 160))
+
+    def test_replaced_file_drops_the_copies(self):
+        def replaced_meanwhile(*args):
+            GroupMessage.objects.filter(pk=self.message.pk).update(file='files/other.png')
+            return render_variants(*args)
+
+        with mock.patch('a_rtchat.derivatives.render_variants', replaced_meanwhile):
+            self.run_pipeline()
+        self.assertEqual(self.message.file_variants, {})
+        self.assertEqual(default_storage.listdir('files')[1], ['photo.png'])
+
+
+class DeflateMeterTests(TestCase):
+    scope = {'headers': [(b'sec-websocket-extensions', b'permessage-deflate; client_max_window_bits')]}
+
+    def meter(self, sample):
+        saved = deflate._options
+        deflate._options = {'window_bits': 11, 'mem_level': 4, 'meter_sample': sample}
+        try:
+            return deflate.meter_for(self.scope)
+        finally:
+            deflate._options = saved
+
+    def test_sampled_sockets_only(self):
+        self.assertIsNone(self.meter(0))
+        self.assertIsNotNone(self.meter(1))
+
+    def test_ratio_over_measured_frames(self):
+        metrics = SocketMetrics()
+        metrics.record('ChatroomConsumer', 'chat_message', 1000, 200)
+        metrics.record('ChatroomConsumer', 'chat_message', 1000, None)
+        counts = metrics.stats()['consumers']['ChatroomConsumer']['chat_message']
+        self.assertEqual(counts['raw_bytes'], 2000)
+        self.assertEqual(counts['ratio'], 0.2)
+
+
+class FragmentCacheTests(FreshCaches, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='ana')
+        room = make_room('room', [self.user])
+        self.message = GroupMessage.objects.create(group=room, author=self.user, file='files/photo.png')
+        self.cache = fragments.FragmentCache()
+
+    def test_file_metadata_renders_again(self):
+        self.cache.render([self.message])
+        self.cache.render([self.message])
+        self.assertEqual(self.cache.metrics['renders'], 1)
+        self.message.is_image = True
+        self.message.file_width, self.message.file_height = 640, 480
+        html, = self.cache.render([self.message])
+        self.assertEqual(self.cache.metrics['renders'], 2)
+        self.assertIn('width="640"', html)
+
+    def test_other_files_render_a_download_link(self):
+        self.message.file_width, self.message.file_height = 640, 480
+        html, = self.cache.render([self.message])
+        self.assertIn('download>photo.png</a>', html)
+        self.assertNotIn('Uploaded Image', html)
+        self.assertNotIn('width="640"', html)
+
+    def test_template_is_part_of_the_key(self):
+        self.assertNotEqual(self.cache.key(self.message, 'old'), self.cache.key(self.message, 'new'))
+
+
+class UnreadTests(FreshCaches, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader, cls.writer = [User.objects.create(username=f'unread-{i}') for i in range(2)]
+        cls.room = make_room('unread-room', [cls.reader, cls.writer], messages=2)
+
+    def post(self, count, author=None):
+        return [GroupMessage.objects.create(group=self.room, author=author or self.writer, body='hi') for _ in range(count)]
+
+    def unread(self, user):
+        return unread_counts(user).get(self.room.group_name)
+
+    def test_members_join_at_the_end(self):
+        self.assertEqual(self.unread(self.reader), 0)
+
+    def test_others_messages_are_unread(self):
+        self.post(3)
+        self.post(1, author=self.reader)
+        self.assertEqual(self.unread(self.reader), 3)
+        self.assertEqual(self.unread(self.writer), 1)
+
+    def test_mark_read(self):
+        newest = self.post(3)[-1]
+        mark_read(self.reader.id, self.room.id, newest.id)
+        self.assertEqual(self.unread(self.reader), 0)
+        self.post(2)
+        self.assertEqual(self.unread(self.reader), 2)
+
+    def test_viewing_reads(self):
+        self.post(3)
+        self.client.force_login(self.reader)
+        self.client.get(reverse('chatroom', args=[self.room.group_name]))
+        self.assertEqual(self.unread(self.reader), 0)
+
+    def test_capped(self):
+        self.post(5)
+        with mock.patch('a_rtchat.unread.UNREAD_CAP', 3):
+            self.assertEqual(self.unread(self.reader), 3)
+
+    def test_sending_writes_only_the_message(self):
+        with self.assertNumQueries(1):
+            self.post(1)
+
+
+class PrivateChatTests(FreshCaches, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username=f'private-{i}') for i in range(2)]
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.users[0])
+
+    def open_chat(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(reverse('start-chat', args=[self.users[1].username]))
+        return self.client.get(response.url)
+
+    def test_reopen_after_leaving(self):
+        self.assertEqual(self.open_chat().status_code, 200)
+        room = ChatGroup.objects.get(is_private=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('chatroom-leave', args=[room.group_name]))
+        self.assertEqual(self.open_chat().status_code, 200)
+        self.assertEqual(set(room.members.all()), set(self.users))
+        self.assertEqual(ChatGroup.objects.filter(is_private=True).count(), 1)
+
+    def test_merge_keeps_history(self):
+        rooms = []
+        for i in range(2):
+            room = ChatGroup.objects.create(is_private=True)
+            room.members.add(*self.users)
+            for j in range(3):
+                GroupMessage.objects.create(group=room, author=self.users[j % 2], body=f'room {i} message {j}')
+            rooms.append(room)
+        keeper, duplicate = rooms
+        archive_room(duplicate, timezone.now())
+        ChatUpload.objects.create(group=duplicate, author=self.users[0], filename='a.txt', mime='text/plain', size=1)
+
+        call_command('merge_private_chats', stdout=StringIO())
+        self.assertFalse(ChatGroup.all_objects.filter(id=duplicate.id).exists())
+        self.assertEqual(GroupMessage.objects.filter(group=keeper).count(), 6)
+        self.assertFalse(ArchivedMessages.objects.exists())
+        self.assertEqual(ChatUpload.objects.get().group, keeper)
+        self.assertEqual(ReadCursor.objects.filter(group=keeper).count(), 2)
+        # the duplicate's messages came after the keeper's cursors
+        self.assertEqual(unread_counts(self.users[0])[keeper.group_name], 2)
+
+
+class RetentionTests(FreshCaches, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='keeper')
+        self.room = make_room('retention-room', [self.user])
+        # a message a day, the oldest first, half a day off any cutoff
+        now = timezone.now()
+        GroupMessage.objects.bulk_create([
+            GroupMessage(group=self.room, author=self.user, body=f'day {i}', created=now - timedelta(days=9 - i, hours=12)) for i in range(10)
+        ])
+        self.ids = list(self.room.chat_messages.order_by('-created').values_list('id', flat=True))
+
+    def test_archives_past_the_room_retention(self):
+        ChatGroup.objects.filter(id=self.room.id).update(retention_days=5)
+        call_command('archive_chat_messages', '--batch-size', '2', stdout=StringIO())
+        self.assertEqual(list(self.room.chat_messages.order_by('-created').values_list('id', flat=True)), self.ids[:5])
+        runs = ArchivedMessages.objects.filter(group=self.room)
+        self.assertEqual(sorted(runs.values_list('count', flat=True)), [1, 2, 2])
+
+    def test_kept_without_a_retention(self):
+        with self.settings(CHAT_RETENTION_DAYS=None):
+            call_command('archive_chat_messages', stdout=StringIO())
+        self.assertEqual(self.room.chat_messages.count(), 10)
+
+    def test_history_reads_on_into_the_archive(self):
+        archive_room(self.room, timezone.now() - timedelta(days=3), batch_size=3)
+        ids, cursor = [], None
+        while True:
+            page, cursor = history_page(self.room, cursor, limit=4)
+            ids += [message.id for message in page]
+            if cursor is None:
+                break
+        self.assertEqual(ids, self.ids)
+
+    def test_deleted_room_is_purged(self):
+        archive_room(self.room, timezone.now() - timedelta(days=5))
+        with mock.patch('a_rtchat.retention.schedule_purge') as schedule_purge:
+            with self.captureOnCommitCallbacks(execute=True):
+                delete_room(self.room)
+        schedule_purge.assert_called_once_with(self.room.id)
+        self.assertFalse(ChatGroup.objects.filter(id=self.room.id).exists())
+        self.assertFalse(self.room.members.exists())
+
+        # as if the process restarted before the purge ran
+        call_command('purge_chat_rooms', stdout=StringIO())
+        self.assertFalse(ChatGroup.all_objects.filter(id=self.room.id).exists())
+        self.assertFalse(GroupMessage.objects.filter(group_id=self.room.id).exists())
+        self.assertFalse(ArchivedMessages.objects.filter(group_id=self.room.id).exists())
+
+
+class RedisPresenceTests(TestCase):
+    """ Against LocalRedis, the same steps the join and leave scripts run. """
+    def test_counts_follow_connections(self):
+        presence = RedisPresence(timeout=60)
+        self.assertTrue(presence.join('room', 1, 'tab-a'))
+        self.assertFalse(presence.join('room', 1, 'tab-b'))
+        self.assertFalse(presence.join('room', 1, 'tab-a'))
+        self.assertFalse(presence.leave('room', 1, 'tab-a'))
+        self.assertFalse(presence.leave('room', 1, 'tab-a'))
+        self.assertTrue(presence.is_online('room', 1))
+        self.assertTrue(presence.leave('room', 1, 'tab-b'))
+        self.assertEqual(presence.count('room'), 0)
+
+    def test_expired_connections_go_offline(self):
+        presence = RedisPresence(timeout=60)
+        presence.join('room', 2, 'tab')
+        presence.timeout = -1
+        self.assertEqual(presence.sweep(), [('room', 2)])
+        self.assertFalse(presence.leave('room', 2, 'tab'))
+        self.assertEqual(presence.count('room'), 0)
+
+
+class ProtocolTests(TestCase):
+    event = {'t': 'presence', 'count': 2, 'joined': [4], 'left': [9], 'name': 'Zoë'}
+
+    def test_negotiates_first_supported(self):
+        scope = {'subprotocols': ['chat.cbor', protocols.MSGPACK, protocols.JSON]}
+        self.assertEqual(protocols.negotiate(scope), protocols.MSGPACK)
+        self.assertIsNone(protocols.negotiate({'subprotocols': ['chat.cbor']}))
+        self.assertIsNone(protocols.negotiate({}))
+
+    def test_json_round_trip(self):
+        frame = protocols.encode(protocols.JSON, self.event)
+        self.assertEqual(protocols.decode(protocols.JSON, **frame), self.event)
+
+    def test_msgpack_round_trip(self):
+        frame = protocols.encode(protocols.MSGPACK, self.event)
+        self.assertEqual(list(frame), ['bytes_data'])
+        self.assertEqual(protocols.decode(protocols.MSGPACK, **frame), self.event)
+
+    def test_binary_frame_needs_msgpack(self):
+        with self.assertRaises(ValueError):
+            protocols.decode(protocols.JSON, bytes_data=b'\x80')
+
+    def test_without_msgpack_only_json_is_offered(self):
+        with mock.patch.object(protocols, 'msgpack', None):
+            self.assertEqual(protocols.negotiate({'subprotocols': [protocols.MSGPACK, protocols.JSON]}), protocols.JSON)
+
+
+class SearchTests(FreshCaches, TestCase):
+    def setUp(self):
+        super().setUp()
+        ana, bo, cy = [User.objects.create(username=name) for name in ('ana', 'bo', 'cy')]
+        shared = make_room('shared-room', [ana, bo])
+        hidden = make_room('hidden-room', [bo, cy])
+        for room, body in ((shared, 'hello world'), (hidden, 'hello secret'), (shared, 'help wanted'), (shared, 'goodbye')):
+            GroupMessage.objects.create(group=room, author=bo, body=body)
+        self.client.force_login(ana)
+
+    def search(self, query, **params):
+        return self.client.get(reverse('chat-search'), {'q': query, 'format': 'json', **params}).json()
+
+    def bodies(self, query):
+        return [result['body'] for result in self.search(query)['results']]
+
+    def test_only_readable_rooms(self):
+        results = self.search('hello')['results']
+        self.assertEqual([result['body'] for result in results], ['hello world'])
+        self.assertEqual(results[0]['snippet'], '<mark>hello</mark> world')
+
+    def test_short_last_word_is_a_prefix(self):
+        self.assertEqual(self.bodies('hel'), ['help wanted', 'hello world'])
+        self.assertEqual(self.bodies('hello wor'), ['hello world'])
+
+    def test_pages_and_deletes(self):
+        room = ChatGroup.objects.get(group_name='shared-room')
+        author = User.objects.get(username='bo')
+        pings = [GroupMessage.objects.create(group=room, author=author, body=f'ping {i}') for i in range(25)]
+        pings[-1].delete()
+        first = self.search('ping')
+        second = self.search('ping', before=first['next'])
+        self.assertEqual(len(first['results']), 20)
+        self.assertEqual([result['body'] for result in second['results']], [f'ping {i}' for i in range(3, -1, -1)])
+        self.assertIsNone(second['next'])
+
+    def test_scan_fallback_agrees(self):
+        indexed = self.bodies('hel')
+        with mock.patch('a_rtchat.search.get_search', ScanSearch):
+            self.assertEqual(self.bodies('hel'), indexed)
+
+
+class WriteBehindTests(FreshCaches, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='writer')
+        self.room = make_room('busy-room', [self.user])
+        self.writer = MessageWriter(tempfile.mkdtemp(), batch_size=10, fsync=False)
+        # flushed by hand, no writer thread
+        self.writer.thread = mock.Mock()
+
+    def add(self, count):
+        return [self.writer.add(GroupMessage(group=self.room, author=self.user, body=f'message {i}')) for i in range(count)]
+
+    def journal(self):
+        return list(self.writer.directory.glob('*.journal'))
+
+    def test_refused_row_is_dropped_by_halving(self):
+        messages = self.add(8)
+        bad = messages[5]
+        insert = writebehind.insert_messages
+        batches = []
+
+        def refuse_bad(batch):
+            batches.append(len(batch))
+            if bad in batch:
+                raise DataError('value too long')
+            insert(batch)
+
+        with mock.patch('a_rtchat.writebehind.insert_messages', refuse_bad), self.assertLogs('a_rtchat.writebehind', 'ERROR'):
+            save_messages(messages)
+        self.assertEqual(batches, [8, 4, 4, 2, 1, 1, 2])
+        saved = set(GroupMessage.objects.values_list('id', flat=True))
+        self.assertEqual(saved, {message.id for message in messages} - {bad.id})
+
+    def test_failed_batch_is_retried_from_the_journal(self):
+        self.add(3)
+        failing = mock.patch('a_rtchat.writebehind.save_messages', side_effect=OperationalError('database is down'))
+        with failing, self.assertLogs('a_rtchat.writebehind', 'ERROR'):
+            self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(len(self.writer.pending), 3)
+        self.assertEqual(len(self.journal()), 1)
+        self.add(1)
+        self.assertEqual(self.writer.flush(), 4)
+        self.assertEqual(GroupMessage.objects.count(), 4)
+        self.assertEqual(self.journal(), [])
+
+    def test_abandoned_batch_is_recovered(self):
+        self.add(3)
+        failing = mock.patch('a_rtchat.writebehind.save_messages', side_effect=OperationalError('database is down'))
+        with failing, self.assertLogs('a_rtchat.writebehind', 'ERROR'):
+            for attempt in range(writebehind.MAX_ATTEMPTS):
+                self.writer.flush()
+        self.assertEqual(self.writer.stats()['abandoned'], 3)
+        self.assertEqual(self.writer.pending, [])
+        self.assertEqual(recover(self.writer.directory), 3)
+        self.assertEqual(GroupMessage.objects.count(), 3)
+        self.assertEqual(self.journal(), [])
+
+
+class RateLimitTests(TestCase):
+    def test_burst_then_throttled(self):
+        limit = InMemoryRateLimit(rates={'connection': (1, 3), 'user': None, 'room': None})
+        self.assertEqual([limit.allow(connection='socket') for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(limit.allow(connection='socket'), 1, places=1)
+        self.assertEqual(limit.allow(connection='other-socket'), 0)
+        self.assertEqual(limit.stats(), {'allowed': 4, 'throttled.connection': 1})
+
+    def test_refills_over_time(self):
+        limit = InMemoryRateLimit(rates={'connection': (2, 2)})
+        with mock.patch('a_rtchat.ratelimit.time.monotonic', return_value=1000.0) as clock:
+            limit.allow(connection='socket')
+            limit.allow(connection='socket')
+            self.assertTrue(limit.allow(connection='socket'))
+            clock.return_value += 0.5
+            self.assertEqual(limit.allow(connection='socket'), 0)
+
+    def test_throttled_message_costs_no_bucket(self):
+        limit = InMemoryRateLimit(rates={'connection': (1, 3), 'user': (1, 2), 'room': None})
+        with mock.patch('a_rtchat.ratelimit.time.monotonic', return_value=1000.0):
+            for i in range(2):
+                limit.allow(connection='tab-a', user=1)
+            # the user's bucket is empty, tab-a's still has its last token
+            self.assertTrue(limit.allow(connection='tab-a', user=1))
+            self.assertEqual(limit.allow(connection='tab-a', user=2), 0)
+        self.assertEqual(limit.stats()['throttled.user'], 1)
+
+
+class RecordingConsumer:
+    def __init__(self):
+        self.handled = []
+        self.resyncs = 0
+
+    async def dispatch(self, message):
+        self.handled.append(message)
+
+
+class QueuedConsumer(BackpressureMixin, RecordingConsumer):
+    merged_events = {'count_handler': ('room',)}
+
+    async def resync(self):
+        self.resyncs += 1
+
+
+class BackpressureTests(TestCase):
+    def test_newer_state_replaces_the_queued_one(self):
+        queue = EventQueue(10, QueuedConsumer().merge_key)
+        outcomes = [queue.put(event) for event in (
+            {'type': 'count_handler', 'room': 'a', 'count': 1},
+            {'type': 'message_handler', 'id': 1},
+            {'type': 'count_handler', 'room': 'b', 'count': 5},
+            {'type': 'count_handler', 'room': 'a', 'count': 2},
+        )]
+        self.assertEqual(outcomes, ['queued', 'queued', 'queued', 'merged'])
+        events = [asyncio.run(queue.get()) for i in range(3)]
+        self.assertEqual([event.get('id') or (event['room'], event['count']) for event in events], [1, ('b', 5), ('a', 2)])
+
+    @override_settings(CHAT_EVENT_BACKLOG=2)
+    def test_drops_past_the_backlog_then_resyncs(self):
+        consumer = QueuedConsumer()
+
+        async def flood():
+            for i in range(5):
+                await consumer.dispatch({'type': 'message_handler', 'id': i})
+            for i in range(3):
+                await consumer.dispatch({'type': 'count_handler', 'room': 'a', 'count': i})
+            await asyncio.sleep(0.01)
+            consumer.event_worker.cancel()
+
+        asyncio.run(flood())
+        self.assertEqual(consumer.handled, [
+            {'type': 'message_handler', 'id': 0},
+            {'type': 'message_handler', 'id': 1},
+            {'type': 'count_handler', 'room': 'a', 'count': 2},
+        ])
+        self.assertEqual(consumer.resyncs, 1)
+
+
+class MessageBodyTests(TestCase):
+    def test_valid_body(self):
+        self.assertTrue(valid_body('hello'))
+        self.assertFalse(valid_body('   '))
+        self.assertFalse(valid_body(None))
+        self.assertFalse(valid_body(['hello']))
+        self.assertFalse(valid_body('x' * 301))
+
+
+class CoalescerTests(TestCase):
+    def test_failed_callback_is_logged_and_counted(self):
+        coalescer = Coalescer(0)
+        calls = []
+
+        async def failing():
+            raise RuntimeError('layer down')
+
+        async def working():
+            calls.append('sent')
+
+        async def run():
+            with self.assertLogs('a_rtchat.broadcast', 'ERROR'):
+                coalescer.schedule('room', failing)
+                coalescer.schedule('room', failing)
+                await coalescer.pending['room']
+            coalescer.schedule('room', working)
+            await coalescer.pending['room']
+
+        asyncio.run(run())
+        self.assertEqual(calls, ['sent'])
+        self.assertEqual(coalescer.stats()['room'], {'events': 3, 'broadcasts': 2, 'failures': 1, 'merged': 1})
+
+    def test_metrics_view_has_rooms_and_totals(self):
+        staff = User.objects.create(username='staff', is_staff=True)
+        self.client.force_login(staff)
+        with mock.patch('a_rtchat.views.online_count_coalescer', Coalescer(0)) as coalescer:
+            coalescer.metrics['room-a'].update(events=3, broadcasts=1)
+            coalescer.metrics['room-b'].update(events=2, broadcasts=2)
+            data = self.client.get(reverse('chat-metrics')).json()['online_counts']
+        self.assertEqual(data['rooms']['room-a']['merged'], 2)
+        self.assertEqual(data['total'], {'events': 5, 'broadcasts': 3, 'merged': 2, 'failures': 0})
+
+
+class UrlTests(TestCase):
+    def test_usernames_dont_collide(self):
+        for username in ('search', 'metrics', 'presence'):
+            self.assertEqual(resolve(f'/chat/{username}').url_name, 'start-chat')
+        self.assertEqual(resolve(reverse('chat-search')).url_name, 'chat-search')
@@ -0,0 +1,67 @@
+"""
+Unread counts without a counter to keep.
+
+Message ids only go up, the write-behind reserves them in the order
+messages are sent, so a room's unread messages for a user are the ones
+after the newest id they had read, written by someone else. A user's
+ReadCursor holds that id. Sending a message writes nothing but the
+message, and the counts for all of a user's rooms are one query, each
+an index range on groupmessage_unread_idx. A count stops at UNREAD_CAP,
+past which the badge only says 99+, so a room far behind costs no more
+than one just over the cap.
+
+A user without a cursor has nothing unread there. Members get one when
+they join, at the end of the room, and anyone gets one for the public
+chat the first time they open it. Viewing a room moves the cursor to
+its newest message in one upsert.
+
+OnlineStatusConsumer loads the counts once on connect and keeps them
+itself from the unread and read events, see broadcast_unread.
+"""
+from django.db import connection
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from .models import *
+
+UNREAD_CAP = 100
+# past any id, for a room with fewer than UNREAD_CAP unread
+MAX_ID = 2 ** 63 - 1
+
+
+def mark_read(user_id, group_id, last_read_id=0):
+    """ Move the user's cursor to ``last_read_id``, the room's newest message. """
+    # MySQL upserts on any unique key and takes no conflict target
+    unique_fields = ['user', 'group'] if connection.features.supports_update_conflicts_with_target else None
+    ReadCursor.objects.bulk_create(
+        [ReadCursor(user_id=user_id, group_id=group_id, last_read_id=last_read_id)],
+        update_conflicts=True, unique_fields=unique_fields, update_fields=['last_read_id', 'updated'],
+    )
+
+
+def open_cursors(group_ids, user_ids):
+    """ Cursors for new members, at the end so a room's history doesn't arrive unread. """
+    newest = dict(
+        GroupMessage.objects.order_by().filter(group_id__in=group_ids)
+        .values('group').annotate(newest=Max('id')).values_list('group', 'newest')
+    )
+    ReadCursor.objects.bulk_create([
+        ReadCursor(user_id=user_id, group_id=group_id, last_read_id=newest.get(group_id, 0))
+        for group_id in group_ids for user_id in user_ids
+    ], ignore_conflicts=True)
+
+
+def unread_counts(user):
+    """ {group_name: unread} for every room the user has a cursor in, at most UNREAD_CAP each. """
+    others = GroupMessage.objects.order_by().exclude(author_id=user.id)
+    # the UNREAD_CAP-th unread message, nothing after it is counted
+    last_counted = (
+        others.filter(group_id=OuterRef(OuterRef('group_id')), id__gt=OuterRef(OuterRef('last_read_id')))
+        .order_by('id').values('id')[UNREAD_CAP - 1:UNREAD_CAP]
+    )
+    unread = (
+        others.filter(group_id=OuterRef('group_id'), id__gt=OuterRef('last_read_id'),
+                      id__lte=Coalesce(Subquery(last_counted), Value(MAX_ID)))
+        .values('group_id').annotate(unread=Count('id')).values('unread')
+    )
+    counts = ReadCursor.objects.filter(user=user).values_list('group__group_name', Subquery(unread))
+    return {group_name: count or 0 for group_name, count in counts}
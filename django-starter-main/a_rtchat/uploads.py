@@ -0,0 +1,221 @@
+"""
+Resumable chunked uploads for chat attachments.
+
+A client declares the file first, so size and type limits are checked
+before any data is sent. It then sends the file as raw request bodies of
+at most CHAT_UPLOAD_CHUNK_SIZE bytes, each tagged with the offset it
+starts at. Chunks are streamed onto a partial file under CHAT_UPLOAD_DIR
+in small blocks, and after an interruption the client asks for the
+offset and carries on from there. Once the last byte is in, the partial
+file goes to storage and the message is created and broadcast.
+
+No transaction is open while a chunk streams in, which on SQLite would
+hold the database's write lock for as long as the client takes. A
+request claims the chunk with one conditional UPDATE, writes it, and
+moves the offset on in a second short one, releasing the claim. Only
+the request holding the claim moves the offset, and the one that
+completes the file finishes it, in the same transaction that deletes
+the upload, so an upload is finished once.
+
+Django's ASGI handler reads a whole request body before the view runs,
+so the view's chunk size check only comes after the chunk arrived.
+ChunkSizeLimit wraps the http application and refuses a chunk from its
+Content-Length header, before any of the body is received.
+"""
+import json
+import mimetypes
+import os
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+from django.core.files import File
+from .models import *
+
+BLOCK_SIZE = 64 * 1024
+# a claim older than this was left by a request that died
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def upload_dir():
+    return getattr(settings, 'CHAT_UPLOAD_DIR', None) or os.path.join(settings.MEDIA_ROOT, 'uploads')
+
+
+def partial_path(upload):
+    return os.path.join(upload_dir(), f'{upload.key}.part')
+
+
+def max_size():
+    return getattr(settings, 'CHAT_UPLOAD_MAX_SIZE', 1024 ** 3)
+
+
+def chunk_size():
+    return getattr(settings, 'CHAT_UPLOAD_CHUNK_SIZE', 8 * 1024 ** 2)
+
+
+def check_type(filename, content_type=''):
+    """ The mime type to store, raises UploadError if it's not allowed. """
+    mime = mimetypes.guess_type(filename)[0] or content_type or 'application/octet-stream'
+    allowed = getattr(settings, 'CHAT_UPLOAD_TYPES', None)
+    if allowed and not any(mime.startswith(prefix) for prefix in allowed):
+        raise UploadError(f'Files of type {mime} are not allowed', status=415)
+    return mime
+
+
+def start_upload(chat_group, author, filename, size, content_type=''):
+    filename = os.path.basename(filename or '').strip()
+    if not filename:
+        raise UploadError('Missing filename')
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError('Missing size')
+    if size <= 0:
+        raise UploadError('Empty file')
+    if size > max_size():
+        raise UploadError(f'Files are limited to {max_size()} bytes', status=413)
+    mime = check_type(filename, content_type)
+    
+    os.makedirs(upload_dir(), exist_ok=True)
+    upload = ChatUpload.objects.create(group=chat_group, author=author, filename=filename, mime=mime, size=size)
+    open(partial_path(upload), 'wb').close()
+    return upload
+
+
+def claim_chunk(upload, offset, length):
+    """
+    Claim the chunk at ``offset``, which has to be where the previous
+    chunk ended, for this request and return the claim. Raises
+    UploadError while another request holds it, and DoesNotExist once
+    the upload is finished or discarded.
+    """
+    if length > chunk_size():
+        raise UploadError(f'Chunks are limited to {chunk_size()} bytes', status=413)
+    if offset + length > upload.size:
+        raise UploadError('Chunk goes past the declared size', status=413)
+    claim = uuid.uuid4().hex
+    now = timezone.now()
+    claimed = (
+        ChatUpload.objects.filter(pk=upload.pk, received=offset)
+        .filter(Q(claim='') | Q(updated__lt=now - CLAIM_TIMEOUT))
+        .update(claim=claim, updated=now)
+    )
+    if not claimed:
+        upload.refresh_from_db()
+        if upload.received != offset:
+            raise UploadError(f'Expected offset {upload.received}', status=409)
+        raise UploadError('Another chunk is being written', status=409)
+    return claim
+
+
+def commit_chunk(upload, claim, offset, written):
+    """ Move the offset past the chunk and release the claim, False if the claim was lost. """
+    moved = ChatUpload.objects.filter(pk=upload.pk, claim=claim).update(
+        received=offset + written, claim='', updated=timezone.now(),
+    )
+    if moved:
+        upload.received = offset + written
+    return bool(moved)
+
+
+def release_claim(upload, claim):
+    ChatUpload.objects.filter(pk=upload.pk, claim=claim).update(claim='')
+
+
+def write_chunk(upload, offset, stream, length):
+    """
+    Write ``length`` bytes read from ``stream`` at ``offset`` of the
+    partial file, for a claimed chunk. Only BLOCK_SIZE bytes are held in
+    memory at a time. Returns how many were written.
+    """
+    written = 0
+    with open(partial_path(upload), 'r+b') as partial:
+        # drop anything a broken earlier request left past the offset
+        partial.truncate(offset)
+        partial.seek(offset)
+        while written < length:
+            block = stream.read(min(BLOCK_SIZE, length - written))
+            if not block:
+                break
+            partial.write(block)
+            written += len(block)
+    if written != length:
+        raise UploadError('Chunk ended early')
+    return written
+
+
+class PartialFile(File):
+    # lets FileSystemStorage move the partial file instead of copying it
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def finish_upload(upload):
+    """ Move the complete file to storage and create its message. """
+    message = GroupMessage(author_id=upload.author_id, group_id=upload.group_id)
+    with open(partial_path(upload), 'rb') as partial:
+        message.file.save(upload.filename, PartialFile(partial, name=upload.filename), save=False)
+    if os.path.exists(partial_path(upload)):
+        os.remove(partial_path(upload))
+    message.read_file_metadata()
+    if not message.is_image:
+        message.file_mime = upload.mime
+    message.save()
+    upload.delete()
+    return message
+
+
+class ChunkSizeLimit:
+    """ ASGI middleware, answers 411 or 413 for a chunk it can't take without reading it. """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'PUT' and is_chunk_path(scope['path']):
+            length = dict(scope['headers']).get(b'content-length')
+            if length is None or not length.isdigit():
+                return await refuse(send, 411, 'Content-Length is required')
+            if int(length) > chunk_size():
+                return await refuse(send, 413, f'Chunks are limited to {chunk_size()} bytes')
+        await self.app(scope, receive, send)
+
+
+def is_chunk_path(path):
+    try:
+        return resolve(path).url_name == 'chat-upload-chunk'
+    except Resolver404:
+        return False
+
+
+async def refuse(send, status, error):
+    body = json.dumps({'error': error}).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def discard_upload(upload):
+    if os.path.exists(partial_path(upload)):
+        os.remove(partial_path(upload))
+    upload.delete()
+
+
+def expire_uploads(age=timedelta(days=1)):
+    """ Discard uploads that haven't had a chunk for ``age``. """
+    stale = ChatUpload.objects.filter(updated__lt=timezone.now() - age)
+    count = 0
+    for upload in stale.iterator():
+        discard_upload(upload)
+        count += 1
+    return count
@@ -3,11 +3,19 @@ from .views import *
 
 urlpatterns = [
     path('', chat_view, name="home"),
+    # under chat/-/ so they can't shadow chat/<username>, no username has a slash
+    path('chat/-/search', chat_search_view, name="chat-search"),
+    path('chat/-/metrics', chat_metrics_view, name="chat-metrics"),
+    path('chat/-/presence', chat_presence_view, name="chat-presence"),
     path('chat/<username>', get_or_create_chatroom, name="start-chat"),
     path('chat/room/<chatroom_name>', chat_view, name="chatroom"),
+    path('chat/room/<chatroom_name>/history', chat_history_view, name="chatroom-history"),
+    path('chat/room/<chatroom_name>/search', chat_search_view, name="chatroom-search"),
     path('chat/new_groupchat/', create_groupchat, name="new-groupchat"),
     path('chat/edit/<chatroom_name>', chatroom_edit_view, name="edit-chatroom"),
     path('chat/delete/<chatroom_name>', chatroom_delete_view, name="chatroom-delete"),
     path('chat/leave/<chatroom_name>', chatroom_leave_view, name="chatroom-leave"),
     path('chat/fileupload/<chatroom_name>', chat_file_upload, name="chat-file-upload"),
+    path('chat/upload/<chatroom_name>', chat_upload_start, name="chat-upload-start"),
+    path('chat/upload/<chatroom_name>/<upload_key>', chat_upload_chunk, name="chat-upload-chunk"),
 ]
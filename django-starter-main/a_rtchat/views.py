@@ -2,35 +2,64 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, JsonResponse
 from django.contrib import messages
 from django.http import Http404
+from django.db import transaction
 from .models import *
 from .forms import *
+from .broadcast import chat_message_event, broadcast_read, broadcast_unread, online_count_coalescer
+from .history import *
+from .backpressure import backpressure_metrics
+from .fragments import get_fragments
+from .membership import can_read, get_membership, is_member
+from .presence import get_presence
+from .ratelimit import get_rate_limit
+from .retention import delete_room
+from .search import search_messages
+from .uploads import *
+from .roomcache import room_cache
+from .socketmetrics import socket_metrics
+from .writebehind import get_writer
+from .unread import mark_read
 
 @login_required
 def chat_view(request, chatroom_name='public-chat'):
     chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
-    chat_messages = chat_group.chat_messages.all()[:30]
+    chat_messages, next_cursor = history_page(chat_group)
     form = ChatmessageCreateForm()
     
-    other_user = None
+    # the access checks come from the membership cache
     if chat_group.is_private:
-        if request.user not in chat_group.members.all():
+        if not is_member(request.user, chat_group):
             raise Http404()
-        for member in chat_group.members.all():
-            if member != request.user:
-                other_user = member
-                break
             
     if chat_group.groupchat_name:
-        if request.user not in chat_group.members.all():
+        if not is_member(request.user, chat_group):
             if request.user.emailaddress_set.filter(verified=True).exists():
                 chat_group.members.add(request.user)
             else:
                 messages.warning(request, 'You need to verify your email to join the chat!')
                 return redirect('profile-settings')
     
+    # members are loaded once with their profiles for the header, only
+    # private and group chats have members
+    members = []
+    if chat_group.is_private or chat_group.groupchat_name:
+        members = list(chat_group.members.select_related('profile'))
+    
+    other_user = None
+    if chat_group.is_private:
+        for member in members:
+            if member != request.user:
+                other_user = member
+                break
+    
+    if not request.htmx:
+        # opening the room reads it, see a_rtchat.unread
+        mark_read(request.user.id, chat_group.id, chat_messages[0].id if chat_messages else 0)
+        async_to_sync(broadcast_read)(request.user.id, chatroom_name)
+    
     if request.htmx:
         form = ChatmessageCreateForm(request.POST)
         if form.is_valid:
@@ -46,34 +75,119 @@ def chat_view(request, chatroom_name='public-chat'):
     
     context = {
         'chat_messages' : chat_messages, 
+        'next_cursor' : next_cursor,
         'form' : form,
         'other_user' : other_user,
+        'members' : members,
         'chatroom_name' : chatroom_name,
         'chat_group' : chat_group
     }
     
     return render(request, 'a_rtchat/chat.html', context)
 
+@login_required
+def chat_history_view(request, chatroom_name):
+    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    if not can_read(request.user, chat_group):
+        raise Http404()
+    
+    try:
+        chat_messages, next_cursor = history_page(chat_group, before=request.GET.get('before'))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid cursor')
+    
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'messages': [message_json(message) for message in chat_messages],
+            'next': next_cursor,
+        })
+    
+    context = {
+        'chat_messages' : chat_messages,
+        'next_cursor' : next_cursor,
+        'chat_group' : chat_group
+    }
+    return render(request, 'a_rtchat/partials/chat_history.html', context)
+
+
+PRESENCE_ROOMS = 50
+
+
+@login_required
+def chat_presence_view(request):
+    """
+    Who is online in each ?room= the user can read, for clients catching
+    up after being away. Rooms they can't read are left out.
+    """
+    group_names = request.GET.getlist('room')[:PRESENCE_ROOMS]
+    presence = get_presence()
+    rooms = {}
+    for chat_group in ChatGroup.objects.filter(group_name__in=group_names):
+        if not can_read(request.user, chat_group):
+            continue
+        online_ids = set(presence.online(chat_group.group_name))
+        rooms[chat_group.group_name] = {
+            'count': len(online_ids - {request.user.id}),
+            'online': sorted(online_ids),
+        }
+    return JsonResponse({'rooms': rooms})
+
+
+@login_required
+def chat_search_view(request, chatroom_name=None):
+    # one room, or every room the user can read
+    chat_group = None
+    if chatroom_name:
+        chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+        if not can_read(request.user, chat_group):
+            raise Http404()
+    
+    query = request.GET.get('q', '')
+    before = request.GET.get('before')
+    try:
+        results, next_cursor = search_messages(request.user, query, chat_group, before=before)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid cursor')
+    
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'results': [
+                {**message_json(message), 'room': message.group.group_name, 'snippet': str(message.snippet)}
+                for message in results
+            ],
+            'next': next_cursor,
+        })
+    
+    context = {
+        'results' : results,
+        'next_cursor' : next_cursor,
+        'query' : query,
+        'before' : before,
+        'chat_group' : chat_group
+    }
+    if request.htmx:
+        return render(request, 'a_rtchat/partials/search_results.html', context)
+    return render(request, 'a_rtchat/search.html', context)
+
+
 @login_required
 def get_or_create_chatroom(request, username):
     if request.user.username == username:
         return redirect('home')
     
-    other_user = User.objects.get(username = username)
-    my_chatrooms = request.user.chat_groups.filter(is_private=True)
+    other_user = get_object_or_404(User, username=username)
     
-    
-    if my_chatrooms.exists():
-        for chatroom in my_chatrooms:
-            if other_user in chatroom.members.all():
-                chatroom = chatroom
-                break
-            else:
-                chatroom = ChatGroup.objects.create(is_private = True)
-                chatroom.members.add(other_user, request.user)
-    else:
-        chatroom = ChatGroup.objects.create(is_private = True)
-        chatroom.members.add(other_user, request.user)
+    # the unique private_key makes this a single lookup, and two requests
+    # racing to create the same room end up with the same row
+    with transaction.atomic():
+        chatroom, created = ChatGroup.objects.get_or_create(
+            private_key = ChatGroup.private_key_for(request.user, other_user),
+            defaults = {'is_private': True},
+        )
+        # either of them may have left it since, opening it brings both back
+        missing = [user for user in (request.user, other_user) if created or not is_member(user, chatroom)]
+        if missing:
+            chatroom.members.add(*missing)
         
     return redirect('chatroom', chatroom.group_name)
 
@@ -131,7 +245,8 @@ def chatroom_delete_view(request, chatroom_name):
         raise Http404()
     
     if request.method == "POST":
-        chat_group.delete()
+        # its messages go in the background, see a_rtchat.retention
+        delete_room(chat_group)
         messages.success(request, 'Chatroom deleted')
         return redirect('home')
     
@@ -141,7 +256,7 @@ def chatroom_delete_view(request, chatroom_name):
 @login_required
 def chatroom_leave_view(request, chatroom_name):
     chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
-    if request.user not in chat_group.members.all():
+    if not is_member(request.user, chat_group):
         raise Http404()
     
     if request.method == "POST":
@@ -152,20 +267,126 @@ def chatroom_leave_view(request, chatroom_name):
     
 def chat_file_upload(request, chatroom_name):
     chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    if not can_read(request.user, chat_group):
+        raise Http404()
     
     if request.htmx and request.FILES:
         file = request.FILES['file']
-        message = GroupMessage.objects.create(
+        message = GroupMessage(
             file = file,
             author = request.user, 
             group = chat_group,
         )
+        message.read_file_metadata()
+        message.save()
         channel_layer = get_channel_layer()
-        event = {
-            'type': 'message_handler',
-            'message_id': message.id,
-        }
+        event = chat_message_event(message.id)
         async_to_sync(channel_layer.group_send)(
             chatroom_name, event
         )
+        async_to_sync(broadcast_unread)(room_cache.get(chatroom_name), request.user.id)
     return HttpResponse()
+
+
+def upload_json(upload):
+    return {
+        'upload': upload.key,
+        'offset': upload.received,
+        'size': upload.size,
+        'chunk_size': chunk_size(),
+    }
+
+
+@login_required
+def chat_upload_start(request, chatroom_name):
+    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    if not can_read(request.user, chat_group):
+        raise Http404()
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    
+    try:
+        upload = start_upload(chat_group, request.user,
+            request.POST.get('filename'), request.POST.get('size'), request.POST.get('type', ''))
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    return JsonResponse(upload_json(upload), status=201)
+
+
+@login_required
+def chat_upload_chunk(request, chatroom_name, upload_key):
+    upload = get_object_or_404(ChatUpload.objects.select_related('group'), key=upload_key, group__group_name=chatroom_name, author=request.user)
+    # removed from the room since the upload started
+    if not can_read(request.user, upload.group):
+        raise Http404()
+    
+    if request.method == 'GET':
+        return JsonResponse(upload_json(upload))
+    if request.method == 'DELETE':
+        discard_upload(upload)
+        return HttpResponse(status=204)
+    if request.method != 'PUT':
+        return HttpResponseNotAllowed(['GET', 'PUT', 'DELETE'])
+    
+    try:
+        offset = int(request.headers['Upload-Offset'])
+        length = int(request.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Upload-Offset and Content-Length are required'}, status=400)
+    
+    # the chunk streams in outside any transaction, see a_rtchat.uploads
+    try:
+        claim = claim_chunk(upload, offset, length)
+    except ChatUpload.DoesNotExist:
+        raise Http404()
+    except UploadError as e:
+        return JsonResponse({**upload_json(upload), 'error': str(e)}, status=e.status)
+    try:
+        written = write_chunk(upload, offset, request, length)
+    except UploadError as e:
+        release_claim(upload, claim)
+        return JsonResponse({**upload_json(upload), 'error': str(e)}, status=e.status)
+    except BaseException:
+        release_claim(upload, claim)
+        raise
+    
+    with transaction.atomic():
+        if not commit_chunk(upload, claim, offset, written):
+            return JsonResponse({**upload_json(upload), 'error': 'The chunk was claimed again'}, status=409)
+        # the upload is deleted with finishing, a retry of the last chunk gets a 404
+        message = finish_upload(upload) if upload.received == upload.size else None
+    
+    if message is None:
+        return JsonResponse(upload_json(upload))
+    
+    channel_layer = get_channel_layer()
+    event = chat_message_event(message.id)
+    async_to_sync(channel_layer.group_send)(
+        chatroom_name, event
+    )
+    async_to_sync(broadcast_unread)(room_cache.get(chatroom_name), request.user.id)
+    return JsonResponse({**upload_json(upload), 'message': message.id}, status=201)
+
+
+@login_required
+def chat_metrics_view(request):
+    """ This process's chat counters as json, for staff. """
+    if not request.user.is_staff:
+        raise Http404()
+    rooms = online_count_coalescer.stats()
+    totals = {'events': 0, 'broadcasts': 0, 'merged': 0, 'failures': 0}
+    for stats in rooms.values():
+        for key in totals:
+            totals[key] += stats[key]
+    writer = get_writer()
+    return JsonResponse({
+        'sockets': socket_metrics.stats(),
+        'room_cache': room_cache.stats(),
+        'membership': get_membership().stats(),
+        'fragments': get_fragments().stats(),
+        'rate_limit': get_rate_limit().stats(),
+        'backpressure': backpressure_metrics.stats(),
+        'online_counts': {'rooms': rooms, 'total': totals},
+        'channel_layer': dict(getattr(get_channel_layer(), 'metrics', {})),
+        'write_behind': writer.stats() if writer else None,
+    })
@@ -0,0 +1,350 @@
+"""
+Write-behind for chat messages.
+
+With CHAT_WRITE_BEHIND set, a message sent over the websocket gets its
+id and timestamp straight away and can be broadcast at once. A thread
+saves what has built up with one bulk_create every ``interval`` seconds,
+or sooner once ``batch_size`` messages are waiting, instead of one
+transaction per message.
+
+    CHAT_WRITE_BEHIND = {
+        'journal': BASE_DIR / 'chat_journal',
+        'batch_size': 100,
+        'interval': 0.05,
+    }
+
+A message is fsynced to a local journal before add() returns, and the
+journal segment holding it is only deleted once its batch is committed.
+Each process keeps a lock on its own segments, so a segment nobody has
+locked was left by a process that died, and any writer (or the
+replay_chat_journal command) saves it. Ids are reserved up front, so a
+replay skips rows that made it in before the crash.
+
+Messages saved this way don't send GroupMessage's save signals, which
+only matter for files.
+
+A row the database refuses (DataError) is found by saving the batch in
+halves, and dropped with an error logged, so it can't hold up the
+messages after it. A batch that still fails MAX_ATTEMPTS times in a row,
+say with the database down, is left in its segments for recovery, which
+tries again every RECOVER_EVERY seconds.
+
+Ids come from the table's sequence, which needs PostgreSQL or SQLite;
+the app refuses to start with write-behind on any other database.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime
+from pathlib import Path
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DataError, IntegrityError, connection, transaction
+from django.utils import timezone
+from .models import *
+
+logger = logging.getLogger(__name__)
+
+# how often a writer looks for segments of dead processes, in seconds
+RECOVER_EVERY = 10
+# failed saves of a batch before it's left to recovery
+MAX_ATTEMPTS = 5
+# vendors reserve_ids can take ids from
+VENDORS = ('postgresql', 'sqlite')
+MAX_BODY = GroupMessage._meta.get_field('body').max_length
+
+
+def valid_body(body):
+    return isinstance(body, str) and 0 < len(body.strip()) and len(body) <= MAX_BODY
+
+
+def check_vendor():
+    """ Called when the app loads, write-behind can't run without reserve_ids. """
+    if getattr(settings, 'CHAT_WRITE_BEHIND', None) and connection.vendor not in VENDORS:
+        raise ImproperlyConfigured(
+            f'CHAT_WRITE_BEHIND needs one of {", ".join(VENDORS)}, the database is {connection.vendor}'
+        )
+
+
+def reserve_ids(model, count):
+    """
+    Take ``count`` ids from the table's sequence, so rows can be inserted
+    later with ids nothing else will be given.
+    """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [table, count],
+            )
+            return [row[0] for row in cursor.fetchall()]
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT never hands out ids at or below sqlite_sequence,
+            # move it past the block. Writing first takes the write lock.
+            with transaction.atomic():
+                cursor.execute(
+                    f'UPDATE sqlite_sequence SET seq = MAX(seq, (SELECT IFNULL(MAX(id), 0) FROM "{table}")) + %s WHERE name = %s',
+                    [count, table],
+                )
+                if not cursor.rowcount:
+                    cursor.execute(
+                        f'INSERT INTO sqlite_sequence (name, seq) SELECT %s, IFNULL(MAX(id), 0) + %s FROM "{table}"',
+                        [table, count],
+                    )
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                last = cursor.fetchone()[0]
+            return list(range(last - count + 1, last + 1))
+    raise NotImplementedError(f'Reserving ids is not supported on {connection.vendor}')
+
+
+def message_record(message):
+    return {
+        'id': message.id,
+        'group': message.group_id,
+        'author': message.author_id,
+        'body': message.body,
+        'created': message.created.isoformat(),
+    }
+
+
+def record_message(record):
+    return GroupMessage(
+        id=record['id'],
+        group_id=record['group'],
+        author_id=record['author'],
+        body=record['body'],
+        created=datetime.fromisoformat(record['created']),
+    )
+
+
+def save_messages(messages):
+    try:
+        with transaction.atomic():
+            insert_messages(messages)
+    except IntegrityError:
+        # a room or author was deleted before its messages were written
+        groups = set(ChatGroup.objects.filter(id__in={m.group_id for m in messages}).values_list('id', flat=True))
+        authors = set(User.objects.filter(id__in={m.author_id for m in messages}).values_list('id', flat=True))
+        kept = [m for m in messages if m.group_id in groups and m.author_id in authors]
+        logger.warning('Dropped %s chat messages of deleted rooms or users', len(messages) - len(kept))
+        with transaction.atomic():
+            insert_messages(kept)
+    except DataError:
+        # one row the database refuses fails the whole insert, save the
+        # halves apart until it's on its own
+        if len(messages) == 1:
+            message = messages[0]
+            logger.error('Dropped chat message %s the database refused: %r', message.id, message_record(message))
+            return
+        half = len(messages) // 2
+        save_messages(messages[:half])
+        save_messages(messages[half:])
+
+
+def insert_messages(messages):
+    # a replayed journal can hold messages that are already saved
+    GroupMessage.objects.bulk_create(messages, ignore_conflicts=True)
+
+
+def open_segment(directory, fsync):
+    segment = open(directory / f'{uuid.uuid4().hex}.journal', 'ab')
+    fcntl.flock(segment, fcntl.LOCK_EX)
+    if fsync:
+        # the new name has to survive a crash too
+        descriptor = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+    return segment
+
+
+def remove_segment(segment):
+    os.unlink(segment.name)
+    segment.close()
+
+
+def read_segment(segment):
+    messages = []
+    for line in segment.read().splitlines(keepends=True):
+        # a line cut short by a crash was never acknowledged
+        if not line.endswith(b'\n'):
+            continue
+        try:
+            messages.append(record_message(json.loads(line)))
+        except (ValueError, KeyError):
+            logger.warning('Skipped a malformed journal line in %s', segment.name)
+    return messages
+
+
+def recover(directory, batch_size=1000):
+    """
+    Save the messages of segments that no live process holds. Returns how
+    many messages were read from them.
+    """
+    count = 0
+    for path in sorted(Path(directory).glob('*.journal')):
+        try:
+            segment = open(path, 'rb')
+        except FileNotFoundError:
+            continue
+        with segment:
+            try:
+                fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            # its writer may have saved and removed it while we waited
+            if not path.exists():
+                continue
+            messages = read_segment(segment)
+            for offset in range(0, len(messages), batch_size):
+                save_messages(messages[offset:offset + batch_size])
+            os.unlink(path)
+            count += len(messages)
+            logger.info('Recovered %s chat messages from %s', len(messages), path.name)
+    return count
+
+
+class MessageWriter:
+    def __init__(self, journal, batch_size=100, interval=0.05, fsync=True, id_block=None):
+        self.directory = Path(journal)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.fsync = fsync
+        self.id_block = id_block or batch_size
+        self.ids = deque()
+        self.pending = []
+        self.segment = None
+        # segments whose messages are pending, removed once they're saved
+        self.retained = []
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.flushing = threading.Lock()
+        self.thread = None
+        self.stopped = False
+        self.attempts = 0
+        self.metrics = Counter()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.thread = threading.Thread(target=self.run, name='chat-writer', daemon=True)
+            self.thread.start()
+        atexit.register(self.close)
+
+    def add(self, message):
+        """
+        Give an unsaved GroupMessage its id and timestamp and journal it.
+        Once this returns the message will be saved, even if the process
+        dies first. Raises ValueError for a body that can't be saved.
+        """
+        if not valid_body(message.body):
+            raise ValueError(f'Message bodies are 1 to {MAX_BODY} characters')
+        if self.thread is None:
+            self.start()
+        with self.lock:
+            if not self.ids:
+                self.ids.extend(reserve_ids(GroupMessage, self.id_block))
+                self.metrics['reservations'] += 1
+            message.id = self.ids.popleft()
+            message.created = timezone.now()
+            if self.segment is None:
+                self.segment = open_segment(self.directory, self.fsync)
+            self.segment.write(json.dumps(message_record(message)).encode() + b'\n')
+            self.segment.flush()
+            if self.fsync:
+                os.fsync(self.segment.fileno())
+            self.pending.append(message)
+            self.metrics['added'] += 1
+            if len(self.pending) >= self.batch_size:
+                self.ready.notify()
+        return message
+
+    def run(self):
+        recovered_at = 0
+        while True:
+            with self.lock:
+                if len(self.pending) < self.batch_size and not self.stopped:
+                    self.ready.wait(self.interval)
+                if self.stopped:
+                    return
+            try:
+                if time.monotonic() - recovered_at > RECOVER_EVERY:
+                    recovered_at = time.monotonic()
+                    self.metrics['recovered'] += recover(self.directory)
+                self.flush()
+            except Exception:
+                logger.exception('Chat message writer failed')
+                connection.close()
+
+    def flush(self):
+        """ Save everything journaled so far, returns how many messages. """
+        with self.flushing:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                if self.segment is not None:
+                    self.retained.append(self.segment)
+                    self.segment = None
+            if not batch:
+                return 0
+            try:
+                save_messages(batch)
+            except Exception:
+                logger.exception('Could not save %s chat messages', len(batch))
+                connection.close()
+                self.metrics['failures'] += 1
+                self.attempts += 1
+                if self.attempts < MAX_ATTEMPTS:
+                    # keep the segments and try again with the next batch
+                    with self.lock:
+                        self.pending[:0] = batch
+                    return 0
+                # unlocked, recover() picks the segments up
+                logger.error('Left %s chat messages to journal recovery', len(batch))
+                for segment in self.retained:
+                    segment.close()
+                self.retained = []
+                self.attempts = 0
+                self.metrics['abandoned'] += len(batch)
+                return 0
+            self.attempts = 0
+            for segment in self.retained:
+                remove_segment(segment)
+            self.retained = []
+            self.metrics['batches'] += 1
+            self.metrics['saved'] += len(batch)
+            return len(batch)
+
+    def close(self):
+        with self.lock:
+            self.stopped = True
+            self.ready.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def stats(self):
+        return {**self.metrics, 'pending': len(self.pending)}
+
+
+_writer = None
+
+def get_writer():
+    """ This process's writer, or None when CHAT_WRITE_BEHIND is off. """
+    global _writer
+    config = getattr(settings, 'CHAT_WRITE_BEHIND', None)
+    if not config:
+        return None
+    if _writer is None:
+        _writer = MessageWriter(**config)
+    return _writer